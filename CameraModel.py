@@ -0,0 +1,167 @@
+# CameraModel: polynomial mapping from image positions to machine XY.
+#
+# The mapping is a polynomial in normalized image coordinates (x = u/width - 0.5, y = v/height - 0.5)
+# fitted by least squares to nozzle positions seen at known machine positions. Order 2 is the
+# quadratic TAMV has always used, with terms [x^2, y^2, xy, x, y, 1]; order 3 adds the cubic terms
+# [x^3, x^2y, xy^2, y^3] to follow lens distortion further away from the image center.
+#
+#   transform, residuals = fit(normalizedPixels, machineXY, order=3)
+#   lookup = PixelLookup(transform, 640, 480)
+#   dx, dy = lookup.offset(u, v)       # machine move from the image center to pixel (u,v)
+#
+# Released under The MIT License. Full text available via https://opensource.org/licenses/MIT
+#
+# Requires numpy to be installed
+
+import numpy as np
+
+# number of polynomial terms for each supported model order
+_terms = { 2: 6, 3: 10 }
+
+def modelOrder(transform):
+    # Model order of a fitted transform, from its number of terms
+    for order, count in _terms.items():
+        if len(transform) == count:
+            return order
+    raise ValueError('Unsupported camera model with ' + str(len(transform)) + ' terms.')
+
+def features(x, y, order=2):
+    # Polynomial terms for normalized coordinates x, y (scalars or arrays), stacked on the last axis
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    terms = [x**2, y**2, x*y, x, y, np.ones_like(x)]
+    if order >= 3:
+        terms += [x**3, x**2*y, x*y**2, y**3]
+    return np.stack(terms, axis=-1)
+
+def gradients(x, y, order=2):
+    # Derivatives of the polynomial terms with respect to x and y
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    zero = np.zeros_like(x)
+    one = np.ones_like(x)
+    dx = [2*x, zero, y, one, zero, zero]
+    dy = [zero, 2*y, x, zero, one, zero]
+    if order >= 3:
+        dx += [3*x**2, 2*x*y, y**2, zero]
+        dy += [zero, x**2, 2*x*y, 3*y**2]
+    return (np.stack(dx, axis=-1), np.stack(dy, axis=-1))
+
+def fit(pixels, machine, order=2):
+    # Least squares fit of machine XY (n,2) from normalized image coordinates (n,2).
+    # Returns the transform (terms,2) and the residual of every point (n,2) in machine units.
+    pixels = np.asarray(pixels, dtype=float).reshape(-1, 2)
+    machine = np.asarray(machine, dtype=float).reshape(-1, 2)
+    A = features(pixels[:,0], pixels[:,1], order)
+    transform = np.linalg.lstsq(A, machine, rcond=None)[0]
+    residuals = machine - A @ transform
+    return transform, residuals
+
+def evaluate(transform, pixels):
+    # Machine XY for normalized image coordinates (n,2)
+    pixels = np.asarray(pixels, dtype=float).reshape(-1, 2)
+    return features(pixels[:,0], pixels[:,1], modelOrder(transform)) @ transform
+
+def pixelOffset(transform, width, height, u, v):
+    # Machine offset (dx, dy) from the image center to image position(s) u, v, evaluated from the model.
+    # For a few positions of a transform that keeps changing this is much cheaper than a new PixelLookup.
+    transform = np.asarray(transform, dtype=float)
+    order = modelOrder(transform)
+    u = np.asarray(u, dtype=float)
+    v = np.asarray(v, dtype=float)
+    result = (features(u / width - 0.5, v / height - 0.5, order) - features(0, 0, order)) @ transform
+    if result.ndim == 1:
+        return (float(result[0]), float(result[1]))
+    return result
+
+class PixelLookup:
+    # Dense table of the machine offset from the image center to every pixel, evaluated once
+    # per calibration so nozzle positions anywhere in the image can be converted with a lookup.
+    def __init__(self, transform, width, height):
+        self.transform = np.asarray(transform, dtype=float)
+        self.order = modelOrder(self.transform)
+        self.width = int(width)
+        self.height = int(height)
+        x = np.arange(self.width, dtype=float) / self.width - 0.5
+        y = np.arange(self.height, dtype=float) / self.height - 0.5
+        xs, ys = np.meshgrid(x, y)
+        center = features(0, 0, self.order) @ self.transform
+        # (height, width, 2) machine offsets, row by row to keep the temporary arrays small
+        self.table = np.empty((self.height, self.width, 2), dtype=np.float32)
+        for row in range(self.height):
+            self.table[row] = features(xs[row], ys[row], self.order) @ self.transform - center
+        self._center = center
+
+    def offset(self, u, v):
+        # Machine offset (dx, dy) from the image center to sub-pixel image position(s) u, v.
+        # Positions inside the image are interpolated from the table, others use the model directly.
+        u = np.asarray(u, dtype=float)
+        v = np.asarray(v, dtype=float)
+        inside = (u >= 0) & (u <= self.width - 1) & (v >= 0) & (v <= self.height - 1)
+        u0 = np.clip(np.floor(u).astype(int), 0, self.width - 2)
+        v0 = np.clip(np.floor(v).astype(int), 0, self.height - 2)
+        fu = (np.clip(u, 0, self.width - 1) - u0)[..., np.newaxis]
+        fv = (np.clip(v, 0, self.height - 1) - v0)[..., np.newaxis]
+        top = self.table[v0, u0] * (1 - fu) + self.table[v0, u0 + 1] * fu
+        bottom = self.table[v0 + 1, u0] * (1 - fu) + self.table[v0 + 1, u0 + 1] * fu
+        result = (top * (1 - fv) + bottom * fv).astype(float)
+        if not np.all(inside):
+            direct = features(u / self.width - 0.5, v / self.height - 0.5, self.order) @ self.transform - self._center
+            result = np.where(inside[..., np.newaxis], result, direct)
+        if result.ndim == 1:
+            return (float(result[0]), float(result[1]))
+        return result
+
+def scaleAndRotation(transform, width, height):
+    # Millimeters per pixel and image rotation (degrees) of a transform at the image center
+    jacobian = np.array([ [transform[3,0]/width, transform[4,0]/height], [transform[3,1]/width, transform[4,1]/height] ])
+    scale = np.sqrt(abs(np.linalg.det(jacobian)))
+    rotation = np.degrees(np.arctan2(jacobian[1,0] - jacobian[0,1], jacobian[0,0] + jacobian[1,1]))
+    return (float(scale), float(rotation))
+
+class RecursiveRefiner:
+    # Recursive least squares refinement of a transform from moves made after the calibration.
+    # Every move gives a pair of nozzle positions in the image and the machine move between them,
+    # which constrains all terms of the model except the constant one. Old information is slowly
+    # forgotten so the transform follows drift (e.g. the camera warming up).
+    def __init__(self, transform, width, height, pixels=None, forgetting=0.98):
+        self.transform = np.array(transform, dtype=float)
+        self.order = modelOrder(self.transform)
+        self.width = int(width)
+        self.height = int(height)
+        self.forgetting = forgetting
+        count = len(self.transform)
+        # start with the information of the calibration points, if known
+        if pixels is not None and len(pixels) > 0:
+            pixels = np.asarray(pixels, dtype=float).reshape(-1, 2)
+            A = features(pixels[:,0], pixels[:,1], self.order)
+            self.P = np.linalg.inv(A.T @ A + np.eye(count) * 1e-6)
+        else:
+            self.P = np.eye(count)
+        # forgetting stops once the uncertainty is back to what it was after the calibration
+        self.trace_limit = np.trace(self.P)
+        (self.initial_scale, self.initial_rotation) = scaleAndRotation(self.transform, self.width, self.height)
+        self.updates = 0
+
+    def predict(self, p0, p1):
+        # Machine move between normalized image positions p0 and p1
+        return (features(p1[0], p1[1], self.order) - features(p0[0], p0[1], self.order)) @ self.transform
+
+    def update(self, p0, p1, move):
+        # Fold in a machine move (dx, dy) that took the nozzle from normalized image position p0 to p1.
+        # Returns the prediction error of the move before the update (machine units).
+        phi = features(p1[0], p1[1], self.order) - features(p0[0], p0[1], self.order)
+        error = np.asarray(move, dtype=float) - phi @ self.transform
+        Pphi = self.P @ phi
+        gain = Pphi / (self.forgetting + phi @ Pphi)
+        self.transform = self.transform + np.outer(gain, error)
+        self.P = self.P - np.outer(gain, Pphi)
+        if np.trace(self.P) / self.forgetting <= self.trace_limit:
+            self.P = self.P / self.forgetting
+        self.updates += 1
+        return error
+
+    def drift(self):
+        # Change of scale (fraction) and rotation (degrees) since the calibration
+        (scale, rotation) = scaleAndRotation(self.transform, self.width, self.height)
+        return (scale / self.initial_scale - 1, rotation - self.initial_rotation)
@@ -0,0 +1,190 @@
+# DetectionPool: nozzle detection in worker processes fed through shared memory.
+#
+# Captured frames are copied into a ring of shared memory slots, and one or more worker
+# processes run the detection engine (see NozzleDetector.py) on them. Workers only send back
+# the keypoints found and a small annotated preview, so detection scales across CPU cores
+# and the GUI process is left free to capture frames and handle events.
+#
+#   pool = DetectionPool(workers=3, width=640, height=480)
+#   frameID = pool.submit(frame, meta)
+#   result = pool.result()
+#   pool.close()
+#
+# Set "detection_workers" in the camera section of settings.json to enable it in TAMV.
+#
+# Released under The MIT License. Full text available via https://opensource.org/licenses/MIT
+#
+# Requires OpenCV to be installed
+
+import atexit
+import multiprocessing
+import queue
+import time
+import cv2
+import numpy as np
+from multiprocessing import shared_memory
+import NozzleDetector
+
+class DetectionResult:
+    def __init__(self, frameID, keypoints, preview, stage_times, meta):
+        self.frameID = frameID
+        # cv2.KeyPoint list in full frame coordinates, quality score in keypoint.response
+        self.keypoints = keypoints
+        # annotated frame scaled by the pool preview scale
+        self.preview = preview
+        # per-stage processing time (seconds) measured in the worker
+        self.stage_times = stage_times
+        # whatever was passed to submit() with the frame
+        self.meta = meta
+
+class DetectionPool:
+    def __init__(self, workers=2, width=640, height=480, slots=0, engine='blob', previewScale=0.5, **detectorArgs):
+        self.workers = max(1, int(workers))
+        self.width = int(width)
+        self.height = int(height)
+        # two slots per worker keeps every worker busy while the next frame is being captured
+        self.slots = int(slots) if slots > 0 else 2*self.workers
+        self.previewScale = previewScale
+        self.minCircularity = detectorArgs.get('minCircularity', 0.8)
+        # incremented by forget(): workers drop what their detector learned when they see a new value
+        self.generation = 0
+        self.slot_size = self.width * self.height * 3
+        self._memory = shared_memory.SharedMemory(create=True, size=self.slot_size*self.slots)
+        self._free = list(range(self.slots))
+        self._pending = {}
+        self._nextID = 0
+        # spawn fresh interpreters: forking a process running Qt threads is not safe
+        context = multiprocessing.get_context('spawn')
+        self._tasks = context.Queue()
+        self._results = context.Queue()
+        self._processes = []
+        for i in range(self.workers):
+            process = context.Process(target=_worker, args=(self._memory.name, self._tasks, self._results, engine, detectorArgs), daemon=True)
+            process.start()
+            self._processes.append(process)
+        # the shared memory and queues outlive the process unless released: release them at exit if close() wasn't called
+        self._closed = False
+        atexit.register(self.close)
+
+    def available(self):
+        # True if a shared memory slot is free for the next frame
+        return len(self._free) > 0
+
+    def inFlight(self):
+        return len(self._pending)
+
+    def setCircularity(self, minCircularity):
+        self.minCircularity = minCircularity
+
+    def forget(self):
+        # Make every worker call forget() on its detector before its next frame (see NozzleDetector)
+        self.generation += 1
+
+    def submit(self, frame, meta=None, xray=False):
+        # Copy a frame into a free slot and queue it for detection. Returns the frame ID, or None if the ring is full.
+        # BGR or grayscale frames, a slot holds either
+        if frame.shape[:2] != (self.height, self.width) or (len(frame.shape) > 2 and frame.shape[2] != 3) or frame.dtype != np.uint8:
+            raise ValueError('Frame does not match detection pool format ' + str(self.width) + 'x' + str(self.height) + ' BGR or grayscale')
+        if not self.available():
+            return None
+        slot = self._free.pop(0)
+        view = np.ndarray(frame.shape, dtype=np.uint8, buffer=self._memory.buf, offset=slot*self.slot_size)
+        view[:] = frame
+        frameID = self._nextID
+        self._nextID += 1
+        self._pending[frameID] = (slot, meta)
+        self._tasks.put( (frameID, slot, self.slot_size, frame.shape, self.minCircularity, xray, self.previewScale, self.generation) )
+        return frameID
+
+    def result(self, timeout=5.0):
+        # Wait for the next finished frame. Results are returned in completion order.
+        if len(self._pending) == 0:
+            return None
+        try:
+            (frameID, points, preview, stage_times) = self._results.get(timeout=timeout)
+        except queue.Empty:
+            raise Exception('Detection workers did not respond in ' + str(timeout) + ' seconds.')
+        (slot, meta) = self._pending.pop(frameID)
+        self._free.append(slot)
+        keypoints = [cv2.KeyPoint(float(x), float(y), float(size), -1, float(response)) for (x, y, size, response) in points]
+        return DetectionResult(frameID, keypoints, preview, stage_times, meta)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        atexit.unregister(self.close)
+        for process in self._processes:
+            self._tasks.put(None)
+        # workers only exit once their results have been read, so keep reading while waiting for them
+        deadline = time.time() + 2
+        for process in self._processes:
+            while process.is_alive() and time.time() < deadline:
+                self._drain()
+                process.join(timeout=0.05)
+            if process.is_alive():
+                process.terminate()
+                process.join(timeout=1)
+        self._processes = []
+        self._drain()
+        for channel in (self._tasks, self._results):
+            channel.close()
+            channel.join_thread()
+        self._pending = {}
+        try:
+            self._memory.close()
+            self._memory.unlink()
+        except Exception:
+            pass
+
+    def _drain(self):
+        # discard finished results nobody is waiting for
+        try:
+            while True:
+                self._results.get_nowait()
+        except queue.Empty:
+            pass
+        except Exception:
+            pass
+
+def _worker(memoryName, tasks, results, engine, detectorArgs):
+    memory = shared_memory.SharedMemory(name=memoryName)
+    detector = NozzleDetector.getDetector(engine, **detectorArgs)
+    generation = 0
+    parent = multiprocessing.parent_process()
+    while True:
+        try:
+            task = tasks.get(timeout=1.0)
+        except queue.Empty:
+            # stop if TAMV exited without closing the pool
+            if parent is not None and not parent.is_alive():
+                break
+            continue
+        if task is None:
+            break
+        (frameID, slot, slot_size, shape, minCircularity, xray, previewScale, taskGeneration) = task
+        frame = np.ndarray(shape, dtype=np.uint8, buffer=memory.buf, offset=slot*slot_size)
+        if taskGeneration != generation:
+            detector.forget()
+            generation = taskGeneration
+        detector.setCircularity(minCircularity)
+        keypoints, processed = detector.detect(frame)
+        stage_times = dict(detector.stage_times)
+        start = time.perf_counter()
+        # annotate a small copy of the frame for display: red for a single nozzle, white when several circles are found
+        display = detector.expand(processed, frame.shape[1], frame.shape[0]) if xray else frame
+        if previewScale != 1:
+            preview = cv2.resize(display, None, fx=previewScale, fy=previewScale, interpolation=cv2.INTER_AREA)
+        else:
+            preview = display.copy()
+        if len(preview.shape) < 3:
+            # grayscale frames and the binary x-ray view are shown in color
+            preview = cv2.cvtColor(preview, cv2.COLOR_GRAY2BGR)
+        if len(keypoints) > 0:
+            scaled = [cv2.KeyPoint(k.pt[0]*previewScale, k.pt[1]*previewScale, k.size*previewScale) for k in keypoints]
+            color = (0,0,255) if len(keypoints) == 1 else (255,255,255)
+            preview = cv2.drawKeypoints(preview, scaled, np.array([]), color, cv2.DRAW_MATCHES_FLAGS_DRAW_RICH_KEYPOINTS)
+        stage_times['preview'] = time.perf_counter() - start
+        points = [(k.pt[0], k.pt[1], k.size, k.response) for k in keypoints]
+        results.put( (frameID, points, preview, stage_times) )
+    memory.close()
@@ -0,0 +1,255 @@
+# DuetSimulator: a simulated Duet printer for running TAMV without hardware.
+#
+# SimulatedPrinter implements the subset of the DuetWebAPI interface used by TAMV, with
+# simple motion timing, tool changes and G10 offsets. Every tool has a "true" nozzle offset
+# that TAMV is expected to find. Combined with SyntheticCamera.py this allows running and
+# timing a full alignment on a plain Linux box without a printer or microscope.
+#
+# Connect to "sim://localhost" from the TAMV GUI to use it.
+#
+# Released under The MIT License. Full text available via https://opensource.org/licenses/MIT
+#
+# Requires Python3
+
+import threading
+import time
+import numpy as np
+import DuetWebAPI
+
+class SimulatedPrinter:
+    pt = 3
+    _base_url = ''
+
+    def __init__(self, base_url='sim://localhost', numTools=4, trueOffsets=None, cameraCoords=(0.0, 0.0, 0.0),
+                latency=0.02, toolChangeTime=2.0, statusDelay=0.25, seed=0):
+        self._base_url = base_url
+        self._lock = threading.RLock()
+        # machine XY(Z) position seen at the camera center, Z is the focal plane
+        self.camera_coords = cameraCoords
+        # simulated HTTP round trip time per request
+        self.latency = latency
+        # time taken for a tool change (dock + undock macros)
+        self.toolChangeTime = toolChangeTime
+        # the controller reports "idle" this long after motion has actually stopped (status refresh granularity)
+        self.statusDelay = statusDelay
+        # number of requests made to the simulated controller
+        self.request_count = 0
+        rng = np.random.default_rng(seed)
+        if trueOffsets is None:
+            trueOffsets = [ (0.0, 0.0) ] + [ tuple(np.around(rng.uniform(-0.4, 0.4, 2), 3)) for i in range(numTools-1) ]
+        # actual nozzle position relative to the carriage for each tool
+        self.true_offsets = [ {'X': float(o[0]), 'Y': float(o[1])} for o in trueOffsets ]
+        # G10 offsets currently set on the controller
+        self.g10_offsets = [ {'X': 0.0, 'Y': 0.0, 'Z': 0.0} for i in range(len(self.true_offsets)) ]
+        self.current_tool = -1
+        self.relative = False
+        self.feedrate = 6000.0
+        # motion queue: list of (start time, end time, start position, end position, arc) in machine coordinates
+        # arc is None for straight moves, or (center, radius, start angle, swept angle) for G2/G3
+        start = np.array([cameraCoords[0], cameraCoords[1], cameraCoords[2]], dtype=float)
+        self._segments = [ (0.0, 0.0, start, start, None) ]
+        print('Connecting to', base_url, '..')
+        print('Duet Firmware: Simulator - V3')
+
+####
+# DuetWebAPI interface
+####
+
+    def printerType(self):
+        return(self.pt)
+
+    def baseURL(self):
+        return(self._base_url)
+
+    def getCoords(self):
+        # the position is sampled half way through the request
+        self._request(self.latency/2)
+        with self._lock:
+            position = self._position(time.time())
+            offset = self._toolOffset()
+        time.sleep(self.latency/2)
+        return({'X': float(position[0] + offset[0]), 'Y': float(position[1] + offset[1]), 'Z': float(position[2] + offset[2])})
+
+    def getCoordsLive(self):
+        return(self.getCoords())
+
+    def getCoordsAbs(self):
+        self._request()
+        with self._lock:
+            position = self._position(time.time())
+            return({'X': float(position[0]), 'Y': float(position[1]), 'Z': float(position[2])})
+
+    def getG10ToolOffset(self,tool):
+        self._request()
+        with self._lock:
+            return(dict(self.g10_offsets[tool]))
+
+    def getNumExtruders(self):
+        return(len(self.true_offsets))
+
+    def getNumTools(self):
+        self._request()
+        return(len(self.true_offsets))
+
+    def getCurrentTool(self):
+        self._request()
+        return(self.current_tool)
+
+    def getStatus(self):
+        self._request()
+        with self._lock:
+            if time.time() < self._segments[-1][1] + self.statusDelay:
+                return('processing')
+            return('idle')
+
+    def isIdle(self):
+        return(self.getStatus() == 'idle')
+
+    def gCode(self,command):
+        self._request()
+        with self._lock:
+            for line in str(command).replace('\r','').split('\n'):
+                self._execute(line)
+        return(0)
+
+    def gCodeBatch(self,commands):
+        for command in commands:
+            self.gCode(command)
+
+    def moveTo(self, x=None, y=None, z=None, feed=None, order='XY Z'):
+        return(self.gCode('\n'.join(DuetWebAPI.DuetWebAPI.moveCommands(x, y, z, feed, order))))
+
+####
+# Simulation helpers
+####
+
+    def getNozzlePosition(self):
+        # physical position of the active nozzle in machine space, None if no tool is loaded
+        with self._lock:
+            if self.current_tool < 0:
+                return None
+            position = self._position(time.time())
+            offset = self.true_offsets[self.current_tool]
+            return (position[0] + offset['X'], position[1] + offset['Y'], position[2] - self.camera_coords[2])
+
+    def _request(self, latency=None):
+        self.request_count += 1
+        if latency is None:
+            latency = self.latency
+        if latency > 0:
+            time.sleep(latency)
+
+    def _toolOffset(self):
+        if self.current_tool < 0:
+            return (0.0, 0.0, 0.0)
+        offset = self.g10_offsets[self.current_tool]
+        return (offset['X'], offset['Y'], offset['Z'])
+
+    def _position(self, now):
+        for (t0, t1, p0, p1, arc) in reversed(self._segments):
+            if now >= t0:
+                if now >= t1 or t1 <= t0:
+                    return p1
+                fraction = (now - t0) / (t1 - t0)
+                position = p0 + (p1 - p0) * fraction
+                if arc is not None:
+                    (center, radius, angle, sweep) = arc
+                    angle += sweep * fraction
+                    position[0] = center[0] + radius * np.cos(angle)
+                    position[1] = center[1] + radius * np.sin(angle)
+                return position
+        return self._segments[0][2]
+
+    def _queue(self, target, duration, arc=None):
+        now = time.time()
+        last = self._segments[-1]
+        start = max(now, last[1])
+        self._segments.append( (start, start + duration, last[3], target, arc) )
+        # only keep recent history
+        self._segments = [s for s in self._segments if s[1] > now - 5.0] or [self._segments[-1]]
+
+    def _target(self, start, params):
+        # end point of a move in machine coordinates
+        offset = self._toolOffset()
+        target = start.copy()
+        for i, axis in enumerate('XYZ'):
+            if axis in params:
+                if self.relative:
+                    target[i] = start[i] + params[axis]
+                else:
+                    target[i] = params[axis] - offset[i]
+        return target
+
+    def _execute(self, line):
+        # tokenise a line that may contain more than one command, e.g. "G91 G1 X0.1 F1000 G90"
+        words = line.upper().split()
+        command = None
+        params = {}
+        commands = []
+        for word in words:
+            letter = word[0]
+            # G, M and T words start a new command, except T parameters of M commands (e.g. M104 T1)
+            if letter in 'GM' or (letter == 'T' and (command is None or command[0] != 'M')):
+                if command is not None:
+                    commands.append( (command, params) )
+                command = word
+                params = {}
+                continue
+            try:
+                params[letter] = float(word[1:])
+            except ValueError:
+                pass
+        if command is not None:
+            commands.append( (command, params) )
+        for (command, params) in commands:
+            self._run(command, params)
+
+    def _run(self, command, params):
+        if command == 'G90':
+            self.relative = False
+        elif command == 'G91':
+            self.relative = True
+        elif command in ['G0', 'G1']:
+            if 'F' in params:
+                self.feedrate = params['F']
+            start = self._segments[-1][3]
+            target = self._target(start, params)
+            distance = np.linalg.norm(target - start)
+            duration = distance / (self.feedrate / 60.0) + (0.02 if distance > 0 else 0)
+            self._queue(target, duration)
+        elif command in ['G2', 'G3']:
+            # arcs in the XY plane around I J (relative to the start), a full circle if the end is the start
+            if 'F' in params:
+                self.feedrate = params['F']
+            start = self._segments[-1][3]
+            target = self._target(start, params)
+            center = start[:2] + np.array([params.get('I', 0.0), params.get('J', 0.0)])
+            radius = np.linalg.norm(start[:2] - center)
+            angle = np.arctan2(start[1] - center[1], start[0] - center[0])
+            sweep = np.arctan2(target[1] - center[1], target[0] - center[0]) - angle
+            if command == 'G2':
+                # clockwise
+                while sweep >= -1e-9:
+                    sweep -= 2*np.pi
+            else:
+                while sweep <= 1e-9:
+                    sweep += 2*np.pi
+            distance = np.hypot(abs(sweep) * radius, target[2] - start[2])
+            duration = distance / (self.feedrate / 60.0) + 0.02
+            self._queue(target, duration, (center, radius, angle, sweep))
+        elif command == 'G10':
+            if 'P' in params:
+                tool = int(params['P'])
+                for axis in 'XYZ':
+                    if axis in params:
+                        self.g10_offsets[tool][axis] = params[axis]
+        elif command[0] == 'T':
+            try:
+                tool = int(command[1:])
+            except ValueError:
+                return
+            if tool != self.current_tool:
+                # tool changes run the dock/undock macros before the carriage is free again
+                end = self._segments[-1][3]
+                self._queue(end, self.toolChangeTime)
+                self.current_tool = tool
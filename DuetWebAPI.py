@@ -16,6 +16,7 @@
 
 class DuetWebAPI:
     import requests
+    import urllib.parse
     import json
     import sys
     import time
@@ -117,7 +118,46 @@ class DuetWebAPI:
                 return(ret)
         except Exception as e1:
             print('Error in getStatus: ',e1 )
-        
+
+    def getCoordsLive(self):
+        # Current user position without waiting for moves to finish, for sampling positions while moving
+        try:
+            if (self.pt == 2):
+                if not self._rrf2:
+                    #RRF 3 on a Duet Ethernet/Wifi board, open a session like getCoords (no buffer checking: nothing is queued)
+                    sessionURL = (f'{self._base_url}'+'/rr_connect?password=reprap')
+                    r = self.requests.get(sessionURL,timeout=8)
+                    if not r.ok:
+                        print('Error in getCoordsLive session: ', r)
+                URL=(f'{self._base_url}'+'/rr_status?type=2')
+                r = self.requests.get(URL,timeout=8)
+                j = self.json.loads(r.text)
+                replyURL = (f'{self._base_url}'+'/rr_reply')
+                reply = self.requests.get(replyURL,timeout=8)
+                if not self._rrf2:
+                    endsessionURL = (f'{self._base_url}'+'/rr_disconnect')
+                    r2 = self.requests.get(endsessionURL,timeout=8)
+                    if not r2.ok:
+                        print('Error in getCoordsLive end session: ', r2)
+                jc=j['coords']['xyz']
+                an=j['axisNames']
+                ret=self.json.loads('{}')
+                for i in range(0,len(jc)):
+                    ret[ an[i] ] = jc[i]
+                return(ret)
+            if (self.pt == 3):
+                URL=(f'{self._base_url}'+'/machine/status')
+                r = self.requests.get(URL,timeout=8)
+                j = self.json.loads(r.text)
+                if 'result' in j: j = j['result']
+                ja=j['move']['axes']
+                ret=self.json.loads('{}')
+                for i in range(0,len(ja)):
+                    ret[ ja[i]['letter'] ] = ja[i]['userPosition']
+                return(ret)
+        except Exception as e1:
+            print('Error in getCoordsLive: ',e1 )
+
     def getCoordsAbs(self):
         if (self.pt == 2):
             URL=(f'{self._base_url}'+'/rr_status?type=2')
@@ -337,6 +377,36 @@ class DuetWebAPI:
             endsessionURL = (f'{self._base_url}'+'/rr_disconnect')
             r2 = self.requests.get(endsessionURL,timeout=8)
 
+    @staticmethod
+    def moveCommands(x=None, y=None, z=None, feed=None, order='XY Z'):
+        # G-code lines for an absolute move. order sets the sequence of moves: axes grouped together
+        # move together, groups move one after the other. 'XY Z' moves XY first and then Z, 'Z XY'
+        # moves Z out of the way first. Axes left as None don't move.
+        target = {'X': x, 'Y': y, 'Z': z}
+        groups = order.upper().split()
+        # axes missing from order move last
+        missing = ''.join([axis for axis in 'XYZ' if axis not in ''.join(groups)])
+        if missing != '':
+            groups.append(missing)
+        commands = ['G90']
+        for group in groups:
+            words = [axis + '{:.3f}'.format(float(target[axis])) for axis in group if target.get(axis) is not None]
+            if len(words) == 0:
+                continue
+            if feed is not None:
+                words.append('F' + str(feed))
+            commands.append('G1 ' + ' '.join(words))
+        return(commands)
+
+    def moveTo(self, x=None, y=None, z=None, feed=None, order='XY Z'):
+        # Move to an absolute position with a single request (see moveCommands for order).
+        # Does not wait for the move to complete: callers poll getStatus() or watch the camera.
+        command = '\n'.join(self.moveCommands(x, y, z, feed, order))
+        if (self.pt == 2):
+            # RRF2 takes the command in the URL: quote it so the newlines between the lines reach the controller
+            command = self.urllib.parse.quote(command)
+        return(self.gCode(command))
+
     def getFilenamed(self,filename):
         if (self.pt == 2):
             URL=(f'{self._base_url}'+'/rr_download?name='+filename)
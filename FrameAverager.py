@@ -0,0 +1,58 @@
+# FrameAverager: averages the frames of a static nozzle before detection.
+#
+# Between moves the nozzle is static, so the sensor noise of the camera can be averaged out
+# over several frames before detection instead of detecting on every frame and averaging the
+# positions. FrameAverager keeps a running mean (or median) of the luma of the last N frames.
+# It is reset on every commanded move, and reports ready once N frames of the new position
+# have been collected, so a single detection on the averaged image replaces N detections.
+#
+#   averager = FrameAverager(frames=5)
+#   averager.reset()                    # for every commanded move
+#   image = averager.add(frame)
+#   if averager.ready(): detect on image
+#
+# Released under The MIT License. Full text available via https://opensource.org/licenses/MIT
+#
+# Requires OpenCV to be installed
+
+import collections
+import cv2
+import numpy as np
+
+class FrameAverager:
+    def __init__(self, frames=5, mode='mean'):
+        # number of frames averaged
+        self.frames = max(1, int(frames))
+        # 'mean' (running sum, cheapest) or 'median' (also rejects single frame outliers, e.g. flicker)
+        self.mode = mode
+        self.reset()
+
+    def reset(self):
+        # forget the frames collected so far (e.g. after a move)
+        self._window = collections.deque()
+        self._sum = None
+
+    def count(self):
+        return len(self._window)
+
+    def ready(self):
+        return len(self._window) >= self.frames
+
+    def add(self, frame):
+        # Add a frame and return the averaged luma of the frames collected so far
+        if len(frame.shape) > 2:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        if len(self._window) > 0 and self._window[0].shape != frame.shape:
+            # resolution changed, start over
+            self.reset()
+        self._window.append(frame)
+        if self.mode == 'median':
+            if len(self._window) > self.frames:
+                self._window.popleft()
+            return np.median(np.stack(self._window), axis=0).astype(np.uint8)
+        if self._sum is None:
+            self._sum = np.zeros(frame.shape, dtype=np.float32)
+        cv2.accumulate(frame, self._sum)
+        if len(self._window) > self.frames:
+            cv2.subtract(self._sum, self._window.popleft().astype(np.float32), dst=self._sum)
+        return cv2.convertScaleAbs(self._sum, alpha=1.0/len(self._window))
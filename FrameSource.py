@@ -0,0 +1,481 @@
+# FrameSource: cameras, streams, files and image directories behind one capture interface.
+#
+# A frame source hides where frames come from (USB/V4L2 camera, network stream, video file,
+# directory of images or the synthetic nozzle camera) behind one interface:
+#
+#   source = createFrameSource(video_src, width, height)
+#   ret, frame, timestamp = source.read()
+#
+# Every source handles its own reconnection, timestamps its frames (time.time() based) and
+# negotiates the capture resolution, reporting the resolution it actually delivers in
+# source.width and source.height. SharedFrameSource lets several consumers share a capture.
+#
+# Released under The MIT License. Full text available via https://opensource.org/licenses/MIT
+#
+# Requires OpenCV to be installed
+
+import os
+import sys
+import threading
+import time
+import cv2
+import numpy as np
+import SyntheticCamera
+
+image_extensions = ['.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff']
+
+class FrameSource:
+    # True for sources that can run out of frames (files, directories)
+    finite = False
+
+    def __init__(self, src, width=640, height=480, fps=0):
+        self.src = src
+        # requested resolution
+        self.requested_width = int(width)
+        self.requested_height = int(height)
+        # negotiated (actual) resolution
+        self.width = int(width)
+        self.height = int(height)
+        self.fps = fps
+        # name and index of the last frame read, used for replays and benchmarking
+        self.frame_name = ''
+        self.frame_index = -1
+        self.finished = False
+        self.reconnect_count = 0
+        # estimated time between exposure and delivery of a frame (seconds), subtracted from timestamps.
+        # This is a fixed guess per kind of source, not measured, so exposure times are approximate.
+        self.latency = 0.0
+        # minimum time between reconnection attempts
+        self.retry_delay = 0.5
+        self._last_retry = 0
+        # deliver single channel (luma) frames, see setGray
+        self.gray = False
+
+    def open(self):
+        return False
+
+    def isOpened(self):
+        return False
+
+    def grab(self):
+        # returns (ret, frame) for the next frame, implemented by each source
+        return (False, None)
+
+    def read(self):
+        # returns (ret, frame, timestamp), reconnecting once if the source dropped out
+        if self.finished:
+            return (False, None, time.time())
+        ret, frame = self.grab()
+        if not ret and not self.finished:
+            if self.reconnect():
+                ret, frame = self.grab()
+        timestamp = self.timestamp()
+        if ret and self.gray and len(frame.shape) > 2:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        if ret:
+            self.frame_index += 1
+            self.frame_name = self.frameName()
+        return (ret, frame, timestamp)
+
+    def frameName(self):
+        return str(self.frame_index)
+
+    def setGray(self, gray=True):
+        # Deliver grayscale (luma) frames. Nozzle detection only uses luma, so this saves converting
+        # and copying three channels per frame. Sources that can deliver luma directly override this.
+        self.gray = bool(gray)
+
+    def timestamp(self):
+        # exposure time of the last frame read, in time.time() units
+        return time.time() - self.latency
+
+    def reconnect(self):
+        if self.finite:
+            return False
+        # rate limit reconnection attempts
+        wait = self._last_retry + self.retry_delay - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        self._last_retry = time.time()
+        self.reconnect_count += 1
+        self.release()
+        return self.open()
+
+    def release(self):
+        return
+
+    def get(self, propId):
+        if propId == cv2.CAP_PROP_FRAME_WIDTH:
+            return float(self.width)
+        if propId == cv2.CAP_PROP_FRAME_HEIGHT:
+            return float(self.height)
+        if propId == cv2.CAP_PROP_FPS:
+            return float(self.fps)
+        return -1
+
+    def set(self, propId, value):
+        return False
+
+    def describe(self):
+        return str(self.src) + ': ' + str(float(self.width)) + 'x' + str(float(self.height)) + ' @ ' + str(float(self.get(cv2.CAP_PROP_FPS))) + 'fps'
+
+class CaptureSource(FrameSource):
+    # Frame source backed by a cv2.VideoCapture compatible object
+    def __init__(self, src, width=640, height=480, fps=0):
+        super(CaptureSource, self).__init__(src, width, height, fps)
+        self.cap = None
+        self._frame_time = time.time()
+        self.open()
+
+    def createCapture(self):
+        return cv2.VideoCapture(self.src)
+
+    def open(self):
+        try:
+            self.cap = self.createCapture()
+            self.configure()
+            return self.cap.isOpened()
+        except Exception as e1:
+            print('Error opening video source ' + str(self.src) + ': ' + str(e1))
+            return False
+
+    def configure(self):
+        # Resolution negotiation: request a resolution and keep what the device actually delivers
+        self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, self.requested_width)
+        self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, self.requested_height)
+        self.cap.set(cv2.CAP_PROP_BUFFERSIZE,1)
+        if self.fps > 0:
+            self.cap.set(cv2.CAP_PROP_FPS, self.fps)
+        width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        if width > 0 and height > 0:
+            if width != self.requested_width or height != self.requested_height:
+                print('Video source ' + str(self.src) + ' does not support ' + str(self.requested_width) + 'x' + str(self.requested_height) + ', using ' + str(width) + 'x' + str(height))
+            self.width = width
+            self.height = height
+        # one frame waiting in the driver buffer plus the exposure itself
+        fps = self.cap.get(cv2.CAP_PROP_FPS)
+        self.latency = 2.0/fps if fps > 0 else 2.0/30
+
+    def isOpened(self):
+        return self.cap is not None and self.cap.isOpened()
+
+    def grab(self):
+        if self.cap is None:
+            return (False, None)
+        ret, frame = self.cap.read()
+        self._frame_time = time.time() - self.latency
+        if ret:
+            frame = self.convert(frame)
+            ret = frame is not None
+        if ret and (frame.shape[1] != self.width or frame.shape[0] != self.height):
+            # some backends report a different resolution than they deliver
+            self.height, self.width = frame.shape[0], frame.shape[1]
+        return (ret, frame)
+
+    def convert(self, frame):
+        # frame as delivered by the capture, for sources that need to unpack it
+        return frame
+
+    def timestamp(self):
+        return self._frame_time
+
+    def release(self):
+        if self.cap is not None:
+            self.cap.release()
+
+    def get(self, propId):
+        if self.cap is None:
+            return super(CaptureSource, self).get(propId)
+        return self.cap.get(propId)
+
+    def set(self, propId, value):
+        if self.cap is None:
+            return False
+        return self.cap.set(propId, value)
+
+class CameraSource(CaptureSource):
+    # USB camera, using the V4L2 backend on Linux
+    # frames are read as unconverted YUYV (see requestLuma)
+    raw = False
+    # the driver accepted YUYV but delivered something else: don't ask again on reconnect
+    yuyv_unsupported = False
+
+    def createCapture(self):
+        src = self.src
+        if isinstance(src, str) and src.isdigit():
+            src = int(src)
+        if sys.platform.startswith('linux') and (isinstance(src, int) or str(src).startswith('/dev/video')):
+            return cv2.VideoCapture(src, cv2.CAP_V4L2)
+        return cv2.VideoCapture(src)
+
+    def configure(self):
+        super(CameraSource, self).configure()
+        self.raw = False
+        if self.gray:
+            self.requestLuma()
+
+    def setGray(self, gray=True):
+        super(CameraSource, self).setGray(gray)
+        self.raw = False
+        if self.gray and self.isOpened():
+            self.requestLuma()
+
+    def requestLuma(self):
+        # Ask the driver for unconverted YUYV frames: the Y plane is the grayscale frame, no BGR conversion needed.
+        # Cameras that don't support it deliver BGR frames, which are converted to grayscale after reading.
+        if self.yuyv_unsupported:
+            return
+        try:
+            if self.cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'YUYV')) and self.cap.set(cv2.CAP_PROP_CONVERT_RGB, 0):
+                self.raw = True
+                width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+                height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+                if width > 0 and height > 0:
+                    self.width = width
+                    self.height = height
+        except Exception as e1:
+            print('Video source ' + str(self.src) + ' can\'t deliver YUYV frames: ' + str(e1))
+            self.raw = False
+
+    def convert(self, frame):
+        if not self.raw:
+            return frame
+        if frame.size == self.width*self.height*2 and (len(frame.shape) < 3 or frame.shape[2] == 2):
+            # YUYV: the Y value of every pixel is every other byte
+            return np.ascontiguousarray(frame.reshape(self.height, self.width, 2)[:,:,0])
+        if len(frame.shape) == 3 and frame.shape[2] == 3:
+            # the driver converted the frame anyway
+            return frame
+        if len(frame.shape) == 2 and frame.shape == (self.height, self.width):
+            # the driver delivered a single plane: that is the luma
+            return frame
+        # unknown raw format: go back to converted frames for good, and read this frame again converted
+        print('Video source ' + str(self.src) + ' did not deliver YUYV frames, using color frames.')
+        self.raw = False
+        self.yuyv_unsupported = True
+        self.cap.set(cv2.CAP_PROP_CONVERT_RGB, 1)
+        ret, frame = self.cap.read()
+        if not ret or len(frame.shape) != 3:
+            return None
+        return frame
+
+class NetworkSource(CaptureSource):
+    # RTSP/HTTP network camera: reconnects with a growing delay while the stream is down
+    def __init__(self, src, width=640, height=480, fps=0):
+        super(NetworkSource, self).__init__(src, width, height, fps)
+        self.max_retry_delay = 10.0
+
+    def configure(self):
+        # network streams can't be resized, only report what they deliver
+        self.cap.set(cv2.CAP_PROP_BUFFERSIZE,1)
+        # encoding, network and decoder buffering
+        self.latency = 0.3
+        width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        if width > 0 and height > 0:
+            self.width = width
+            self.height = height
+
+    def grab(self):
+        ret, frame = super(NetworkSource, self).grab()
+        if ret:
+            self.retry_delay = 0.5
+        return (ret, frame)
+
+    def reconnect(self):
+        result = super(NetworkSource, self).reconnect()
+        if not result:
+            self.retry_delay = min(self.retry_delay * 2, getattr(self, 'max_retry_delay', 10.0))
+        return result
+
+class VideoFileSource(CaptureSource):
+    # Recorded video. Replays at full speed unless realtime is set; timestamps follow the media clock.
+    finite = True
+
+    def __init__(self, src, width=640, height=480, fps=0, realtime=False, loop=False):
+        self.realtime = realtime
+        self.loop = loop
+        self._start_time = time.time()
+        super(VideoFileSource, self).__init__(src, width, height, fps)
+
+    def configure(self):
+        self.width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self._start_time = time.time()
+
+    def grab(self):
+        ret, frame = self.cap.read()
+        if not ret and self.loop:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            self._start_time = time.time()
+            ret, frame = self.cap.read()
+        if not ret:
+            self.finished = True
+            return (False, None)
+        self._frame_time = self._start_time + self.cap.get(cv2.CAP_PROP_POS_MSEC)/1000.0
+        if self.realtime:
+            wait = self._frame_time - time.time()
+            if wait > 0:
+                time.sleep(wait)
+        return (ret, frame)
+
+class DirectorySource(FrameSource):
+    # Directory of still images, read in file name order
+    finite = True
+
+    def __init__(self, src, width=640, height=480, fps=0, loop=False):
+        super(DirectorySource, self).__init__(src, width, height, fps)
+        self.loop = loop
+        self.open()
+
+    def open(self):
+        self.filenames = sorted([f for f in os.listdir(self.src) if os.path.splitext(f)[1].lower() in image_extensions])
+        self._position = 0
+        self._frame_time = time.time()
+        return len(self.filenames) > 0
+
+    def isOpened(self):
+        return len(self.filenames) > 0
+
+    def grab(self):
+        while True:
+            if self._position >= len(self.filenames):
+                if self.loop and len(self.filenames) > 0:
+                    self._position = 0
+                else:
+                    self.finished = True
+                    return (False, None)
+            filename = self.filenames[self._position]
+            self._position += 1
+            frame = cv2.imread(os.path.join(self.src, filename))
+            if frame is None:
+                print('Skipping unreadable image: ' + filename)
+                continue
+            # pace frames if a frame rate is set, otherwise replay at full speed
+            now = time.time()
+            if self.fps > 0:
+                wait = self._frame_time + 1.0/self.fps - now
+                if wait > 0:
+                    time.sleep(wait)
+                    now = time.time()
+            self._frame_time = now
+            self._filename = filename
+            self.height, self.width = frame.shape[0], frame.shape[1]
+            return (True, frame)
+
+    def timestamp(self):
+        return self._frame_time
+
+    def frameName(self):
+        return self._filename
+
+class SyntheticSource(CaptureSource):
+    # Rendered nozzle images (see SyntheticCamera.py)
+    def createCapture(self):
+        return SyntheticCamera.SyntheticCamera(width=self.requested_width, height=self.requested_height, fps=(self.fps if self.fps > 0 else 30))
+
+    def configure(self):
+        super(SyntheticSource, self).configure()
+        # frames are rendered when they are read
+        self.latency = 0.0
+
+    def timestamp(self):
+        # the nozzle position is sampled before rendering, which takes a few milliseconds
+        return self.cap.exposure_time
+
+    def attachPrinter(self, printer):
+        self.cap.attachPrinter(printer)
+
+class SharedFrameSource(FrameSource):
+    # Runs one capture in a background thread and hands the latest frame to any number of consumers.
+    # Each consumer gets its own subscriber, so every consumer sees every new frame at most once.
+    def __init__(self, source):
+        super(SharedFrameSource, self).__init__(source.src, source.width, source.height, source.fps)
+        self.source = source
+        self.finite = source.finite
+        self._condition = threading.Condition()
+        self._frame = None
+        self._timestamp = 0
+        self._sequence = 0
+        self._running = True
+        self._thread = threading.Thread(target=self._capture, daemon=True)
+        self._thread.start()
+
+    def _capture(self):
+        while self._running:
+            ret, frame, timestamp = self.source.read()
+            with self._condition:
+                if ret:
+                    self._frame = frame
+                    self._timestamp = timestamp
+                    self._sequence += 1
+                    self.width, self.height = self.source.width, self.source.height
+                elif self.source.finished:
+                    self.finished = True
+                    self._running = False
+                self._condition.notify_all()
+
+    def subscribe(self):
+        return FrameSubscriber(self)
+
+    def latest(self, after=0, timeout=2.0):
+        # returns (ret, frame, timestamp, sequence) for the first frame newer than sequence number "after"
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._sequence > after or not self._running, timeout):
+                return (False, None, time.time(), after)
+            if self._sequence <= after:
+                return (False, None, time.time(), after)
+            return (True, self._frame, self._timestamp, self._sequence)
+
+    def read(self):
+        ret, frame, timestamp, sequence = self.latest(self._sequence)
+        return (ret, frame, timestamp)
+
+    def release(self):
+        self._running = False
+        self._thread.join(timeout=2.0)
+        self.source.release()
+
+    def get(self, propId):
+        return self.source.get(propId)
+
+    def set(self, propId, value):
+        return self.source.set(propId, value)
+
+class FrameSubscriber(FrameSource):
+    # One consumer of a SharedFrameSource
+    def __init__(self, shared):
+        super(FrameSubscriber, self).__init__(shared.src, shared.width, shared.height, shared.fps)
+        self.shared = shared
+        self._sequence = 0
+
+    def read(self):
+        ret, frame, timestamp, self._sequence = self.shared.latest(self._sequence)
+        self.width, self.height = self.shared.width, self.shared.height
+        self.finished = self.shared.finished
+        return (ret, frame, timestamp)
+
+    def get(self, propId):
+        return self.shared.get(propId)
+
+    def set(self, propId, value):
+        return self.shared.set(propId, value)
+
+def createFrameSource(src, width=640, height=480, fps=0, gray=False):
+    # Pick a frame source implementation from the video_src setting
+    if str(src).lower() == 'synthetic':
+        source = SyntheticSource('synthetic', width, height, fps)
+    elif isinstance(src, int) or str(src).isdigit() or str(src).startswith('/dev/video'):
+        source = CameraSource(src, width, height, fps)
+    elif '://' in str(src):
+        source = NetworkSource(src, width, height, fps)
+    elif os.path.isdir(str(src)):
+        source = DirectorySource(src, width, height, fps)
+    elif os.path.isfile(str(src)):
+        source = VideoFileSource(src, width, height, fps)
+    else:
+        source = CameraSource(src, width, height, fps)
+    if gray:
+        source.setGray(True)
+    return source
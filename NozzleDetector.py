@@ -0,0 +1,459 @@
+# NozzleDetector: the nozzle detection engines, usable with or without the GUI.
+#
+# The detection pipeline used to live inside CalibrateNozzles.analyzeFrame(). It is kept
+# here so the same preprocessing and detector code can be run by the GUI, and headless
+# by the benchmark script without a camera, printer or Qt event loop.
+#
+# Engines (select one with "detection_engine" in settings.json):
+#    blob        OpenCV SimpleBlobDetector on the adaptive thresholded luma
+#    hough       Hough circle transform, centers refined from the nozzle darkness
+#    template    blob detection once, then normalized cross-correlation with the nozzle image
+#                in a small window around its last position
+#
+#   detector = getDetector('hough', scale=0.5)
+#   keypoints, processed = detector.detect(frame)
+#
+# Released under The MIT License. Full text available via https://opensource.org/licenses/MIT
+#
+# Requires OpenCV to be installed
+
+import cv2
+import numpy as np
+import time
+
+def detectionRegion(frame, scale=1.0, roi=1.0):
+    # Part of the frame detection runs on: the central roi fraction of the frame, binned by scale.
+    # Returns the region and the position of its top left corner in the frame.
+    x0 = y0 = 0
+    if roi < 1.0:
+        height, width = frame.shape[0], frame.shape[1]
+        x0 = int((width - width*roi)/2)
+        y0 = int((height - height*roi)/2)
+        frame = frame[y0:height-y0, x0:width-x0]
+    if scale != 1.0:
+        frame = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return frame, (x0, y0)
+
+def frameKeypoints(keypoints, scale=1.0, origin=(0, 0)):
+    # Keypoints found in a detection region, in full frame coordinates. Pixel centers are at
+    # integer coordinates, so a binned pixel i covers frame pixels i/scale .. (i+1)/scale - 1.
+    if scale == 1.0 and origin == (0, 0):
+        return keypoints
+    return [cv2.KeyPoint((k.pt[0] + 0.5)/scale - 0.5 + origin[0], (k.pt[1] + 0.5)/scale - 0.5 + origin[1], k.size/scale, k.angle, k.response) for k in keypoints]
+
+def detectionQuality(luma, keypoint):
+    # Quality score (0..1) of a detected nozzle from the image around it, as the geometric mean of:
+    #    contrast to noise ratio between the nozzle and its surroundings
+    #    edge sharpness (steepest gradient relative to the contrast, i.e. 1/edge width)
+    #    circularity of the thresholded nozzle outline
+    # Returns the score and its components.
+    r = max(2.0, keypoint.size/2)
+    (u, v) = keypoint.pt
+    half = int(np.ceil(r*1.8)) + 2
+    x0 = int(round(u)) - half
+    y0 = int(round(v)) - half
+    if x0 < 0 or y0 < 0 or x0 + 2*half >= luma.shape[1] or y0 + 2*half >= luma.shape[0]:
+        # too close to the image border to judge
+        return 0.5, {}
+    patch = luma[y0:y0+2*half+1, x0:x0+2*half+1].astype(np.float32)
+    ys, xs = np.mgrid[0:patch.shape[0], 0:patch.shape[1]]
+    distance = np.hypot(xs - (u - x0), ys - (v - y0))
+    inside = patch[distance < 0.7*r].mean()
+    outside = patch[(distance > 1.3*r) & (distance < 1.7*r)].mean()
+    contrast = abs(outside - inside)
+    noise = max(0.5, float(np.std(patch[distance < 0.5*r])))
+    smooth = cv2.GaussianBlur(patch, (3,3), 0)
+    gradient = np.hypot(cv2.Sobel(smooth, cv2.CV_32F, 1, 0, ksize=3)/8, cv2.Sobel(smooth, cv2.CV_32F, 0, 1, ksize=3)/8)
+    sharpness = float(np.percentile(gradient, 99)) / max(contrast, 1.0)
+    # outline of the region on the nozzle side of the mid level that contains the center
+    binary = np.where((patch - (inside + outside)/2)*(inside - outside) > 0, 255, 0).astype(np.uint8)
+    contours, hierarchy = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+    circularity = 0.0
+    for contour in contours:
+        if cv2.pointPolygonTest(contour, (u - x0, v - y0), False) >= 0:
+            perimeter = cv2.arcLength(contour, True)
+            if perimeter > 0:
+                circularity = 4*np.pi*cv2.contourArea(contour) / perimeter**2
+            break
+    components = {
+        'contrast': float(np.clip(contrast/noise/30, 0, 1)),
+        'sharpness': float(np.clip(sharpness/0.25, 0, 1)),
+        'circularity': float(np.clip((circularity - 0.5)/0.35, 0, 1))
+    }
+    score = float(np.prod(list(components.values())) ** (1/3))
+    return score, components
+
+class BlobDetector:
+    # engine name used in settings.json and by the benchmark
+    name = 'blob'
+
+    def __init__(self, th1=1, th2=50, thstep=1, minArea=600, minCircularity=0.8, gamma=1.2, scale=1.0, roi=1.0):
+        # detection resolution relative to the frame (0.5 bins 2x2 pixels) and the central fraction of
+        # the frame searched first. Keypoints are always returned in frame coordinates.
+        self.scale = float(scale)
+        self.roi = float(roi)
+        # top left corner of the last detection region in the frame
+        self.origin = (0, 0)
+        self.detect_th1 = th1
+        self.detect_th2 = th2
+        self.detect_thstep = thstep
+        self.detect_minArea = minArea
+        self.detect_minCircularity = minCircularity
+        self.gamma = gamma
+        # per-stage processing time (seconds) of the last processed frame
+        self.stage_times = {}
+        # gamma correction lookup table, only rebuilt if gamma changes
+        self._gamma_table = None
+        self._gamma_value = None
+        self.createDetector()
+
+    def forget(self):
+        # drop anything learned from earlier frames (e.g. on a tool change). The blob detector learns nothing.
+        return
+
+    def setCircularity(self, minCircularity):
+        # Only rebuild the OpenCV detector if the parameter actually changed
+        if minCircularity != self.detect_minCircularity:
+            self.detect_minCircularity = minCircularity
+            self.createDetector()
+
+    def createDetector(self):
+        # Setup SimpleBlobDetector parameters.
+        params = cv2.SimpleBlobDetector_Params()
+        # Thresholds
+        params.minThreshold = self.detect_th1
+        params.maxThreshold = self.detect_th2
+        params.thresholdStep = self.detect_thstep
+
+        # Area
+        params.filterByArea = True         # Filter by Area.
+        params.minArea = self.detect_minArea * self.scale**2
+
+        # Circularity
+        params.filterByCircularity = True  # Filter by Circularity
+        params.minCircularity = self.detect_minCircularity
+        params.maxCircularity= 1
+
+        # Convexity
+        params.filterByConvexity = True    # Filter by Convexity
+        params.minConvexity = 0.3
+        params.maxConvexity = 1
+
+        # Inertia
+        params.filterByInertia = True      # Filter by Inertia
+        params.minInertiaRatio = 0.3
+
+        # create detector
+        self.detector = cv2.SimpleBlobDetector_create(params)
+
+    def adjust_gamma(self, image, gamma=1.2):
+        # build a lookup table mapping the pixel values [0, 255] to
+        # their adjusted gamma values
+        if self._gamma_table is None or self._gamma_value != gamma:
+            invGamma = 1.0 / gamma
+            self._gamma_table = np.array([((i / 255.0) ** invGamma) * 255
+                for i in np.arange(0, 256)]).astype('uint8')
+            self._gamma_value = gamma
+        # apply gamma correction using the lookup table
+        return cv2.LUT(image, self._gamma_table)
+
+    def preprocess(self, frame, roi=None):
+        # Detection algorithm 1:
+        #    Y (luma) channel -> gamma correction -> GaussianBlur (7,7),6 -> adaptive threshold
+        # Everything runs on the single luma plane. Grayscale frames (see FrameSource.setGray) are used as they are.
+        times = {}
+        start = time.perf_counter()
+        if len(frame.shape) > 2:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        # full resolution luma, used to score detections
+        self.luma = frame
+        times['luma'] = time.perf_counter() - start
+        start = time.perf_counter()
+        frame, self.origin = detectionRegion(frame, self.scale, self.roi if roi is None else roi)
+        times['region'] = time.perf_counter() - start
+        start = time.perf_counter()
+        frame = self.adjust_gamma(image=frame, gamma=self.gamma)
+        times['gamma'] = time.perf_counter() - start
+        start = time.perf_counter()
+        # blur and threshold windows follow the detection resolution (odd sizes)
+        blur = max(3, 2*int(3.5*self.scale) + 1)
+        frame = cv2.GaussianBlur(frame,(blur,blur),6*self.scale)
+        times['blur'] = time.perf_counter() - start
+        start = time.perf_counter()
+        block = max(3, 2*int(17.5*self.scale) + 1)
+        frame = cv2.adaptiveThreshold(frame,255,cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY,block,1)
+        times['threshold'] = time.perf_counter() - start
+        self.stage_times = times
+        return frame
+
+    def detect(self, frame):
+        # returns the list of keypoints found (frame coordinates) and the preprocessed (binary, single
+        # channel) detection region. The whole frame is searched if nothing is found in the ROI.
+        # The quality score of each keypoint (see detectionQuality) is stored in keypoint.response.
+        processed = self.preprocess(frame)
+        start = time.perf_counter()
+        keypoints = self.detector.detect(processed)
+        if len(keypoints) == 0 and self.roi < 1.0:
+            times = self.stage_times
+            times['detect'] = time.perf_counter() - start
+            processed = self.preprocess(frame, roi=1.0)
+            # restart the timer: preprocessing is timed by its own stages
+            start = time.perf_counter()
+            keypoints = self.detector.detect(processed)
+            for stage, value in times.items():
+                self.stage_times[stage] = self.stage_times.get(stage, 0) + value
+        self.stage_times['detect'] = self.stage_times.get('detect', 0) + time.perf_counter() - start
+        start = time.perf_counter()
+        keypoints = frameKeypoints(keypoints, self.scale, self.origin)
+        for keypoint in keypoints:
+            keypoint.response = detectionQuality(self.luma, keypoint)[0]
+        self.stage_times['quality'] = time.perf_counter() - start
+        return keypoints, processed
+
+    def expand(self, processed, width, height):
+        # The preprocessed detection region of the last frame scaled and placed in a frame of the given size, for display
+        if processed.shape[1] == width and processed.shape[0] == height:
+            return processed
+        region = cv2.resize(processed, None, fx=1/self.scale, fy=1/self.scale, interpolation=cv2.INTER_NEAREST)
+        frame = np.zeros((height, width), dtype=np.uint8)
+        (x0, y0) = self.origin
+        h = min(region.shape[0], height - y0)
+        w = min(region.shape[1], width - x0)
+        frame[y0:y0+h, x0:x0+w] = region[:h, :w]
+        return frame
+
+class HoughDetector(BlobDetector):
+    # engine name used in settings.json and by the benchmark
+    name = 'hough'
+
+    def __init__(self, th1=1, th2=50, thstep=1, minArea=600, minCircularity=0.8, gamma=1.2, scale=1.0, roi=1.0, maxArea=5000, edgeThreshold=60, perfectness=0.8, loosePerfectness=0.65):
+        # nozzle size range, same meaning (pixel area) as the blob detector's area filter
+        self.detect_maxArea = maxArea
+        # upper Canny threshold used to find the edges of the nozzle
+        self.edgeThreshold = edgeThreshold
+        # minimum circle "perfectness" (HOUGH_GRADIENT_ALT param2, 0..1) of a nozzle, and the one used
+        # for loose detection. This is a property of the edges, not the blob circularity.
+        self.perfectness = perfectness
+        self.loosePerfectness = loosePerfectness
+        super().__init__(th1, th2, thstep, minArea, minCircularity, gamma, scale, roi)
+
+    def setCircularity(self, minCircularity):
+        # only used to tell loose detection (the GUI lowers the circularity from 0.8 to 0.3) from strict
+        self.detect_minCircularity = minCircularity
+
+    def circlePerfectness(self):
+        return self.loosePerfectness if self.detect_minCircularity < 0.8 else self.perfectness
+
+    def createDetector(self):
+        # HoughCircles has no detector object: only derive the radius range in detection pixels
+        self.minRadius = max(2, int(np.sqrt(self.detect_minArea/np.pi)*self.scale))
+        self.maxRadius = max(self.minRadius + 1, int(np.ceil(np.sqrt(self.detect_maxArea/np.pi)*self.scale)))
+
+    def preprocess(self, frame, roi=None):
+        # Detection algorithm 2:
+        #    Y (luma) channel -> median blur -> Hough circle transform (gradient based)
+        times = {}
+        start = time.perf_counter()
+        if len(frame.shape) > 2:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        self.luma = frame
+        times['luma'] = time.perf_counter() - start
+        start = time.perf_counter()
+        frame, self.origin = detectionRegion(frame, self.scale, self.roi if roi is None else roi)
+        times['region'] = time.perf_counter() - start
+        start = time.perf_counter()
+        frame = cv2.medianBlur(frame, 5)
+        times['blur'] = time.perf_counter() - start
+        self.stage_times = times
+        return frame
+
+    def findCircles(self, blurred):
+        # Circles as keypoints in detection region coordinates
+        circles = cv2.HoughCircles(blurred, cv2.HOUGH_GRADIENT_ALT, dp=1, minDist=self.minRadius,
+            param1=self.edgeThreshold*2, param2=self.circlePerfectness(), minRadius=self.minRadius, maxRadius=self.maxRadius)
+        if circles is None:
+            return []
+        # circles around the same center are the nozzle and the rings/body around it: keep the innermost
+        nozzles = []
+        for (u, v, r) in sorted(circles[0], key=lambda c: c[2]):
+            if all(np.hypot(u - n[0], v - n[1]) > n[2] for n in nozzles):
+                nozzles.append((u, v, r))
+        return [cv2.KeyPoint(float(u), float(v), float(2*r)) for (u, v, r) in nozzles]
+
+    def refine(self, image, u, v, r):
+        # Hough centers are only as precise as the accumulator: use the centroid of the nozzle darkness
+        # inside the circle (full resolution luma, frame coordinates) instead, and its area for the radius.
+        # Returns (u, v, radius), or None for circles that are not darker than their surroundings.
+        half = int(np.ceil(1.6*r))
+        x0 = max(0, int(round(u)) - half)
+        y0 = max(0, int(round(v)) - half)
+        patch = image[y0:int(round(v)) + half + 1, x0:int(round(u)) + half + 1].astype(np.float32)
+        ys, xs = np.mgrid[0:patch.shape[0], 0:patch.shape[1]]
+        distance = np.hypot(xs - (u - x0), ys - (v - y0))
+        inside = patch[distance < 0.7*r]
+        outside = patch[(distance > 1.2*r) & (distance < 1.5*r)]
+        if len(inside) == 0 or len(outside) == 0:
+            return None
+        (dark, bright) = (float(np.mean(inside)), float(np.median(outside)))
+        if bright - dark < 10:
+            return None
+        weights = np.clip((bright - patch)/(bright - dark), 0, 1) * (distance < 1.2*r)
+        total = np.sum(weights)
+        return (float(x0 + np.sum(weights*xs)/total), float(y0 + np.sum(weights*ys)/total), float(np.sqrt(total/np.pi)))
+
+    def detect(self, frame):
+        # returns the list of keypoints found (frame coordinates) and the edge image of the detection region
+        blurred = self.preprocess(frame)
+        start = time.perf_counter()
+        keypoints = self.findCircles(blurred)
+        if len(keypoints) == 0 and self.roi < 1.0:
+            times = self.stage_times
+            times['detect'] = time.perf_counter() - start
+            blurred = self.preprocess(frame, roi=1.0)
+            # restart the timer: preprocessing is timed by its own stages
+            start = time.perf_counter()
+            keypoints = self.findCircles(blurred)
+            for stage, value in times.items():
+                self.stage_times[stage] = self.stage_times.get(stage, 0) + value
+        self.stage_times['detect'] = self.stage_times.get('detect', 0) + time.perf_counter() - start
+        start = time.perf_counter()
+        keypoints = frameKeypoints(keypoints, self.scale, self.origin)
+        refined = []
+        for keypoint in keypoints:
+            circle = (keypoint.pt[0], keypoint.pt[1], keypoint.size/2)
+            # twice: the second pass is centered on the first estimate
+            for i in range(2):
+                if circle is not None:
+                    circle = self.refine(self.luma, circle[0], circle[1], circle[2])
+            if circle is not None:
+                refined.append(cv2.KeyPoint(circle[0], circle[1], 2*circle[2]))
+        self.stage_times['refine'] = time.perf_counter() - start
+        start = time.perf_counter()
+        keypoints = refined
+        for keypoint in keypoints:
+            keypoint.response = detectionQuality(self.luma, keypoint)[0]
+        self.stage_times['quality'] = time.perf_counter() - start
+        # edges the Hough transform works on, for display
+        processed = cv2.Canny(blurred, self.edgeThreshold, self.edgeThreshold*2)
+        return keypoints, processed
+
+class TemplateDetector(BlobDetector):
+    # engine name used in settings.json and by the benchmark
+    name = 'template'
+
+    def __init__(self, th1=1, th2=50, thstep=1, minArea=600, minCircularity=0.8, gamma=1.2, scale=1.0, roi=1.0, searchRadius=40, matchThreshold=0.7, learnQuality=0.5):
+        # The nozzle is found once with the blob detector, then its image is used as a template and
+        # searched for by normalized cross-correlation in a small window around its last position.
+        # half size (pixels) of the search window around the last position
+        self.searchRadius = searchRadius
+        # minimum normalized correlation of a match
+        self.matchThreshold = matchThreshold
+        # minimum detection quality (see detectionQuality) of a blob detection to learn the template from
+        self.learnQuality = learnQuality
+        self.forget()
+        super().__init__(th1, th2, thstep, minArea, minCircularity, gamma, scale, roi)
+
+    def forget(self):
+        # drop the learned template, e.g. for a different nozzle (tool change or new session)
+        self.template = None
+        self.center = None
+        self.position = None
+        self.radius = None
+
+    def learn(self, keypoint):
+        # Cut the template out of the full resolution luma around a detected nozzle
+        r = keypoint.size/2
+        half = int(np.ceil(1.5*r))
+        (u, v) = keypoint.pt
+        x0 = int(round(u)) - half
+        y0 = int(round(v)) - half
+        if x0 < 0 or y0 < 0 or x0 + 2*half >= self.luma.shape[1] or y0 + 2*half >= self.luma.shape[0]:
+            return
+        # copy: the frame may be reused by the caller (e.g. a DetectionPool shared memory slot)
+        self.template = self.luma[y0:y0+2*half+1, x0:x0+2*half+1].copy()
+        # nozzle center inside the template (sub-pixel)
+        self.center = (u - x0, v - y0)
+        self.radius = r
+        self.position = (u, v)
+
+    def match(self):
+        # Search the window around the last position. Returns a keypoint, or None if the nozzle isn't there.
+        (u, v) = self.position
+        (th, tw) = self.template.shape
+        x0 = max(0, int(round(u - self.center[0])) - self.searchRadius)
+        y0 = max(0, int(round(v - self.center[1])) - self.searchRadius)
+        x1 = min(self.luma.shape[1], int(round(u - self.center[0])) + self.searchRadius + tw)
+        y1 = min(self.luma.shape[0], int(round(v - self.center[1])) + self.searchRadius + th)
+        if x1 - x0 < tw + 2 or y1 - y0 < th + 2:
+            return None
+        scores = cv2.matchTemplate(self.luma[y0:y1, x0:x1], self.template, cv2.TM_CCOEFF_NORMED)
+        self.scores = (scores, (x0, y0))
+        (low, peak, lowLocation, (px, py)) = cv2.minMaxLoc(scores)
+        if peak < self.matchThreshold:
+            return None
+        if px == 0 or py == 0 or px == scores.shape[1] - 1 or py == scores.shape[0] - 1:
+            # best match on the border of the window: the nozzle is probably outside of it
+            return None
+        # sub-pixel peak from a parabola through the neighbouring scores
+        dx = dy = 0.0
+        (left, right) = (scores[py, px-1], scores[py, px+1])
+        curvature = left - 2*peak + right
+        if curvature < 0:
+            dx = 0.5*(left - right)/curvature
+        (up, down) = (scores[py-1, px], scores[py+1, px])
+        curvature = up - 2*peak + down
+        if curvature < 0:
+            dy = 0.5*(up - down)/curvature
+        u = x0 + px + dx + self.center[0]
+        v = y0 + py + dy + self.center[1]
+        return cv2.KeyPoint(float(u), float(v), float(2*self.radius))
+
+    def detect(self, frame):
+        # returns the list of keypoints found (frame coordinates) and, when the template was used, the
+        # correlation scores of the search window in a full frame image (the blob detector's otherwise)
+        if self.template is None:
+            return self.detectBlob(frame)
+        start = time.perf_counter()
+        self.luma = frame if len(frame.shape) == 2 else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        self.stage_times = {'luma': time.perf_counter() - start}
+        start = time.perf_counter()
+        keypoint = self.match()
+        self.stage_times['match'] = time.perf_counter() - start
+        if keypoint is None:
+            # lost (moved further than the search window) or a different nozzle
+            times = self.stage_times
+            keypoints, processed = self.detectBlob(frame)
+            for stage, value in times.items():
+                self.stage_times[stage] = self.stage_times.get(stage, 0) + value
+            return keypoints, processed
+        start = time.perf_counter()
+        keypoint.response = detectionQuality(self.luma, keypoint)[0]
+        self.position = keypoint.pt
+        self.stage_times['quality'] = time.perf_counter() - start
+        (scores, (x0, y0)) = self.scores
+        processed = np.zeros(self.luma.shape, dtype=np.uint8)
+        x0 += int(round(self.center[0]))
+        y0 += int(round(self.center[1]))
+        processed[y0:y0+scores.shape[0], x0:x0+scores.shape[1]] = np.clip(scores*255, 0, 255).astype(np.uint8)
+        return [keypoint], processed
+
+    def detectBlob(self, frame):
+        # blob detection, (re)learning the template from a single good detection
+        keypoints, processed = super().detect(frame)
+        if len(keypoints) == 1 and keypoints[0].response >= self.learnQuality:
+            self.learn(keypoints[0])
+        return keypoints, processed
+
+# Registry of available detection engines, keyed by engine name
+detectors = {
+    BlobDetector.name: BlobDetector,
+    HoughDetector.name: HoughDetector,
+    TemplateDetector.name: TemplateDetector
+}
+
+def getDetector(name='blob', **kwargs):
+    try:
+        engine = detectors[name]
+    except KeyError:
+        raise ValueError('Unknown detection engine: ' + str(name) + '. Available engines: ' + ', '.join(detectors.keys()))
+    return engine(**kwargs)
@@ -0,0 +1,169 @@
+# NozzleTracker: Kalman filter over successive nozzle detections.
+#
+# NozzleTracker fuses successive nozzle detections with a Kalman filter. The nozzle is static
+# between moves, so the state is just its position in the image (pixels). Commanded moves are
+# fed in as a known displacement with an uncertainty that grows with the move length.
+# Detections that do not fit the prediction (reflections, a second blob, frames captured while
+# the carriage was still moving) are rejected, and the estimate is declared "settled" once its
+# standard deviation drops below a threshold. Detections can carry a quality score: good ones
+# are trusted more, so a clean image settles after fewer detections than a noisy one.
+#
+#   tracker = NozzleTracker()
+#   tracker.update(u, v)        # for every detection, or
+#   tracker.update(u, v, tracker.score(u, v, radius, detectorQuality), radius)
+#   tracker.move(du, dv)        # for every commanded move, or tracker.reset() if unknown
+#   if tracker.settled(): u, v = tracker.position()
+#
+# Released under The MIT License. Full text available via https://opensource.org/licenses/MIT
+#
+# Requires numpy to be installed
+
+import numpy as np
+
+class NozzleTracker:
+    # 99% chi-square limit for 2 degrees of freedom, used to gate detections
+    gate_limit = 9.21
+
+    def __init__(self, noise=0.5, drift=0.05, settleStd=0.4, minUpdates=2, moveError=0.1, maxRejects=3):
+        # detection noise (pixels, 1 sigma)
+        self.noise = noise
+        # random drift of the nozzle between frames (pixels, 1 sigma), e.g. thermal growth
+        self.drift = drift
+        # estimate is settled when its standard deviation is below settleStd pixels on both axes
+        self.settleStd = settleStd
+        # minimum number of accepted detections after a move before the estimate can settle
+        self.minUpdates = minUpdates
+        # relative error of a commanded move (fraction of its length)
+        self.moveError = moveError
+        # consecutive rejected detections before the tracker restarts from the detection
+        self.maxRejects = maxRejects
+        # total accepted/rejected detections, for diagnostics
+        self.accepted_count = 0
+        self.rejected_count = 0
+        # radii of recent detections, kept across moves (the nozzle doesn't change size)
+        self.radii = []
+        self.reset()
+
+    def reset(self):
+        # forget the current estimate (e.g. after a move of unknown size)
+        self.x = None
+        self.P = None
+        self.updates = 0
+        self.rejects = 0
+        # accepted detections since the estimate was (re)started
+        self.track_length = 0
+        # accepted detections since the last move, used to measure the detection noise
+        self.measurements = []
+
+    def initialized(self):
+        return self.x is not None
+
+    def move(self, du, dv):
+        # Shift the prediction by a commanded displacement (pixels)
+        if self.x is None:
+            return
+        self.x = self.x + np.array([du, dv], dtype=float)
+        sigma = self.moveError * np.hypot(du, dv) + self.noise
+        self.P = self.P + np.eye(2) * sigma**2
+        self.updates = 0
+        self.rejects = 0
+        self.measurements = []
+
+    def predict(self):
+        # Time update between frames: the nozzle may drift slightly
+        if self.x is not None:
+            self.P = self.P + np.eye(2) * self.drift**2
+
+    def distance(self, u, v):
+        # Squared Mahalanobis distance of a detection from the prediction
+        if self.x is None:
+            return 0.0
+        innovation = np.array([u, v], dtype=float) - self.x
+        S = self.P + np.eye(2) * self.noise**2
+        return float(innovation @ np.linalg.solve(S, innovation))
+
+    def gate(self, points):
+        # Return the detections (list of (u,v)) consistent with the prediction
+        if self.x is None:
+            return list(points)
+        return [p for p in points if self.distance(p[0], p[1]) <= self.gate_limit]
+
+    def score(self, u, v, radius, quality=1.0):
+        # Overall quality (0..1) of a detection: the detector's score of the image (see
+        # NozzleDetector.detectionQuality), times how well its radius matches recent detections
+        # and how close it is to the predicted position. Pass the radius to update() as well, so
+        # accepted detections set the typical radius.
+        if len(self.radii) >= 3:
+            typical = float(np.median(self.radii))
+            quality *= np.exp(-0.5*((radius - typical)/(0.1*typical))**2)
+        if self.x is not None:
+            quality *= np.exp(-self.distance(u, v)/self.gate_limit)
+        return float(np.clip(quality, 0, 1))
+
+    def update(self, u, v, quality=None, radius=None):
+        # Measurement update. Returns True if the detection was accepted.
+        # With a quality score the detection noise ranges from 0.5x (quality 1) to 1.5x (quality 0) the configured noise.
+        # The radius of accepted detections is kept for score().
+        z = np.array([u, v], dtype=float)
+        sigma = self.noise if quality is None else self.noise*(1.5 - quality)
+        if self.x is None:
+            self.addRadius(radius)
+            self.x = z
+            self.P = np.eye(2) * sigma**2
+            self.updates = 1
+            self.track_length = 1
+            self.measurements = [z]
+            self.accepted_count += 1
+            return True
+        self.predict()
+        if self.distance(u, v) > self.gate_limit:
+            self.rejects += 1
+            self.rejected_count += 1
+            # a track started from a single detection is not trusted over new ones
+            if self.rejects >= min(self.maxRejects, self.track_length):
+                # the prediction is wrong (missed or unexpected move): restart from the detections
+                self.reset()
+                return self.update(u, v, quality, radius)
+            return False
+        self.addRadius(radius)
+        R = np.eye(2) * sigma**2
+        S = self.P + R
+        K = self.P @ np.linalg.inv(S)
+        self.x = self.x + K @ (z - self.x)
+        self.P = (np.eye(2) - K) @ self.P
+        self.updates += 1
+        self.track_length += 1
+        self.measurements.append(z)
+        self.rejects = 0
+        self.accepted_count += 1
+        return True
+
+    def addRadius(self, radius):
+        if radius is not None:
+            self.radii = (self.radii + [float(radius)])[-20:]
+
+    def position(self):
+        if self.x is None:
+            return None
+        return (float(self.x[0]), float(self.x[1]))
+
+    def covariance(self):
+        return self.P
+
+    def std(self):
+        if self.P is None:
+            return None
+        return (float(np.sqrt(self.P[0,0])), float(np.sqrt(self.P[1,1])))
+
+    def measuredNoise(self):
+        # Detection noise (pixels, 1 sigma) measured from the detections since the last move,
+        # or the configured noise if there are too few of them
+        if len(self.measurements) < 3:
+            return self.noise
+        return float(np.sqrt(np.mean(np.var(np.array(self.measurements), axis=0, ddof=1))))
+
+    def settled(self):
+        if self.x is None or self.updates < self.minUpdates:
+            return False
+        std = self.std()
+        return std[0] <= self.settleStd and std[1] <= self.settleStd
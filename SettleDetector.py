@@ -0,0 +1,93 @@
+# SettleDetector: tells from the image when the carriage has stopped moving.
+#
+# Under the microscope the image itself shows when the carriage has stopped moving. The
+# settle detector compares consecutive downscaled grayscale frames and reports "stable" once
+# the scene has not changed for a number of frames. A reference frame taken when the move
+# was commanded makes sure the move has actually happened, so a still image before the
+# carriage starts moving is not mistaken for the end of the move.
+#
+#   settle = SettleDetector()
+#   settle.start(frame)
+#   while not settle.update(frame): frame = next frame
+#
+# Released under The MIT License. Full text available via https://opensource.org/licenses/MIT
+#
+# Requires OpenCV to be installed
+
+import cv2
+import numpy as np
+import time
+
+class SettleDetector:
+    def __init__(self, scale=0.25, pixelThreshold=8, minChanged=0.001, stableFrames=2, motionTimeout=0.5):
+        # frames are downscaled by this factor before comparing, which averages out sensor noise
+        self.scale = scale
+        # gray level change of a downscaled pixel that counts as motion
+        self.pixelThreshold = pixelThreshold
+        # fraction of downscaled pixels that must change for a frame to count as moving
+        self.minChanged = minChanged
+        # consecutive still frames needed before the scene is stable
+        self.stableFrames = stableFrames
+        # seconds to wait for visible motion before a still scene is accepted anyway
+        self.motionTimeout = motionTimeout
+        self.reset()
+
+    def reset(self):
+        self._reference = None
+        self._previous = None
+        self.expectMotion = True
+        self.moved = False
+        self.still_count = 0
+        self.start_time = time.time()
+        # fraction of changed pixels between the last two frames, for diagnostics
+        self.motion = 0.0
+
+    def start(self, frame=None, expectMotion=True):
+        # Call when a move is commanded. expectMotion=False for moves too small to see in the image.
+        self.reset()
+        self.expectMotion = expectMotion
+        if frame is not None:
+            self._reference = self._shrink(frame)
+            self._previous = self._reference
+
+    def _shrink(self, frame):
+        if len(frame.shape) > 2:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        return cv2.resize(frame, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+
+    def _changed(self, a, b):
+        # fraction of pixels that changed by more than the threshold
+        difference = cv2.absdiff(a, b)
+        return np.count_nonzero(difference > self.pixelThreshold) / difference.size
+
+    def update(self, frame):
+        # Feed the next frame. Returns True once the scene is stable after the move.
+        small = self._shrink(frame)
+        if self._reference is None:
+            self._reference = small
+            self._previous = small
+            return False
+        if self._reference.shape != small.shape:
+            # resolution changed, start over
+            self.start(frame, self.expectMotion)
+            return False
+        self.motion = self._changed(self._previous, small)
+        self._previous = small
+        if self.motion > self.minChanged:
+            self.moved = True
+            self.still_count = 0
+            return False
+        self.still_count += 1
+        if self.still_count < self.stableFrames:
+            return False
+        if not self.moved and self.expectMotion:
+            # the scene may not have started moving yet: compare with the reference frame
+            if self._changed(self._reference, small) > self.minChanged:
+                self.moved = True
+            elif time.time() - self.start_time < self.motionTimeout:
+                return False
+        return True
+
+    def restart(self):
+        # the scene looked stable but the move wasn't finished: wait for more still frames
+        self.still_count = 0
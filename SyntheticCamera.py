@@ -0,0 +1,224 @@
+# SyntheticCamera: renders nozzle images for running TAMV without a microscope.
+#
+# SyntheticCamera renders microscope-like nozzle images at a commanded sub-pixel position.
+# It follows the cv2.VideoCapture interface (open/isOpened/read/set/get/release), so it can
+# be used anywhere TAMV opens a camera. Use "synthetic" as the video_src in settings.json.
+#
+# The nozzle position either comes from setPosition() (in pixels), or from an attached
+# printer (see DuetSimulator.py), in which case the image follows the simulated machine.
+#
+# Released under The MIT License. Full text available via https://opensource.org/licenses/MIT
+#
+# Requires OpenCV to be installed
+
+import cv2
+import numpy as np
+import time
+
+class SyntheticCamera:
+    # sub-pixel drawing precision used for cv2 drawing functions (2^4 = 1/16th pixel)
+    _shift = 4
+
+    def __init__(self, src='synthetic', width=640, height=480, fps=30,
+                radius=18, rings=2, blur=1.2, noise=1.5, vignetting=0.35,
+                distortion=0.0, debris=3, mpp=0.01, rotation=0.0, seed=0):
+        # image geometry
+        self.width = int(width)
+        self.height = int(height)
+        self.fps = fps
+        # nozzle appearance
+        self.radius = radius
+        self.rings = rings
+        self.blur = blur
+        self.noise = noise
+        self.vignetting = vignetting
+        self.distortion = distortion
+        self.debris = debris
+        # camera to machine relationship used when a printer is attached
+        self.mpp = mpp
+        self.rotation = rotation
+        self.seed = seed
+        self._rng = np.random.default_rng(seed)
+        self._opened = False
+        self._last_frame_time = 0
+        self.exposure_time = 0
+        self._printer = None
+        # commanded nozzle center in undistorted pixel coordinates
+        self.position = (self.width/2, self.height/2)
+        # camera properties that can be set/read through set()/get()
+        self._properties = {
+            cv2.CAP_PROP_BRIGHTNESS: 0,
+            cv2.CAP_PROP_CONTRAST: 0,
+            cv2.CAP_PROP_SATURATION: 0,
+            cv2.CAP_PROP_HUE: 0,
+            cv2.CAP_PROP_BUFFERSIZE: 1
+        }
+        self.open(src)
+
+    def open(self, src='synthetic'):
+        self.src = src
+        self._buildMaps()
+        self._buildDebris()
+        self._opened = True
+        return True
+
+    def isOpened(self):
+        return self._opened
+
+    def release(self):
+        self._opened = False
+
+    def getBackendName(self):
+        return 'SYNTHETIC'
+
+    def set(self, propId, value):
+        if propId == cv2.CAP_PROP_FRAME_WIDTH:
+            if int(value) != self.width:
+                self.width = int(value)
+                self._buildMaps()
+            return True
+        if propId == cv2.CAP_PROP_FRAME_HEIGHT:
+            if int(value) != self.height:
+                self.height = int(value)
+                self._buildMaps()
+            return True
+        if propId == cv2.CAP_PROP_FPS:
+            self.fps = value
+            return True
+        self._properties[propId] = value
+        return True
+
+    def get(self, propId):
+        if propId == cv2.CAP_PROP_FRAME_WIDTH:
+            return float(self.width)
+        if propId == cv2.CAP_PROP_FRAME_HEIGHT:
+            return float(self.height)
+        if propId == cv2.CAP_PROP_FPS:
+            return float(self.fps)
+        return float(self._properties.get(propId, -1))
+
+    def attachPrinter(self, printer, cameraCoords=None):
+        # Follow a simulated printer. cameraCoords is the machine XY position seen at the image center.
+        self._printer = printer
+        if cameraCoords is None:
+            cameraCoords = printer.camera_coords
+        self.camera_coords = cameraCoords
+
+    def setPosition(self, u, v):
+        # Set the commanded nozzle center in (undistorted) pixel coordinates
+        self.position = (float(u), float(v))
+
+    def machineToPixel(self, x, y):
+        # Map a machine XY position to undistorted image coordinates
+        dx = (x - self.camera_coords[0]) / self.mpp
+        dy = (y - self.camera_coords[1]) / self.mpp
+        theta = np.radians(self.rotation)
+        u = self.width/2 + np.cos(theta)*dx - np.sin(theta)*dy
+        v = self.height/2 + np.sin(theta)*dx + np.cos(theta)*dy
+        return (u, v)
+
+    def truePosition(self):
+        # Ground truth nozzle center in the output (distorted) image
+        if self._printer is not None:
+            nozzle = self._printer.getNozzlePosition()
+            if nozzle is None:
+                return None
+            u, v = self.machineToPixel(nozzle[0], nozzle[1])
+        else:
+            u, v = self.position
+        return self._distortPoint(u, v)
+
+    def read(self):
+        if not self._opened:
+            return (False, None)
+        # pace frames like a real camera
+        if self.fps > 0:
+            wait = self._last_frame_time + 1.0/self.fps - time.time()
+            if wait > 0:
+                time.sleep(wait)
+        self._last_frame_time = time.time()
+        # the image shows the nozzle where it is now, so this is the exposure time of the frame
+        self.exposure_time = self._last_frame_time
+        focus = 0
+        if self._printer is not None:
+            nozzle = self._printer.getNozzlePosition()
+            if nozzle is None:
+                return (True, self._render(None))
+            u, v = self.machineToPixel(nozzle[0], nozzle[1])
+            focus = nozzle[2]
+        else:
+            u, v = self.position
+        return (True, self._render((u, v), focus))
+
+    def _buildMaps(self):
+        # Precompute the lens distortion remap tables and vignetting mask for the current resolution
+        cx, cy = self.width/2, self.height/2
+        norm = max(cx, cy)
+        xs, ys = np.meshgrid(np.arange(self.width, dtype=np.float32), np.arange(self.height, dtype=np.float32))
+        r2 = ((xs - cx)**2 + (ys - cy)**2) / norm**2
+        if self.distortion != 0:
+            # each output pixel samples the undistorted scene at p_u = c + (p_d - c)*(1 + k*r^2)
+            scale = 1 + self.distortion * r2
+            self._map_x = (cx + (xs - cx) * scale).astype(np.float32)
+            self._map_y = (cy + (ys - cy) * scale).astype(np.float32)
+        else:
+            self._map_x = None
+            self._map_y = None
+        self._vignette = (1 - self.vignetting * r2).clip(0, 1).astype(np.float32)
+
+    def _distortPoint(self, u, v):
+        if self.distortion == 0:
+            return (u, v)
+        # invert p_u = c + (p_d - c)*(1 + k*r_d^2) by fixed point iteration
+        cx, cy = self.width/2, self.height/2
+        norm = max(cx, cy)
+        du, dv = u - cx, v - cy
+        for i in range(20):
+            r2 = (du**2 + dv**2) / norm**2
+            du = (u - cx) / (1 + self.distortion * r2)
+            dv = (v - cy) / (1 + self.distortion * r2)
+        return (cx + du, cy + dv)
+
+    def _buildDebris(self):
+        # Filament debris stuck to the nozzle face: offsets relative to the nozzle center, size and angle
+        rng = np.random.default_rng(self.seed + 1)
+        self._debris = []
+        for i in range(int(self.debris)):
+            distance = rng.uniform(2.4, 4.0) * self.radius
+            angle = rng.uniform(0, 2*np.pi)
+            size = rng.uniform(0.15, 0.45) * self.radius
+            self._debris.append( (distance*np.cos(angle), distance*np.sin(angle), size, size*rng.uniform(0.3, 1.0), rng.uniform(0, 180)) )
+
+    def _point(self, u, v):
+        return (int(round(u * (1 << self._shift))), int(round(v * (1 << self._shift))))
+
+    def _length(self, value):
+        return int(round(value * (1 << self._shift)))
+
+    def _render(self, position, focus=0):
+        # scene is drawn as a single (luma) plane, then tinted to BGR
+        scene = np.full((self.height, self.width), 70, dtype=np.uint8)
+        if position is not None:
+            center = self._point(position[0], position[1])
+            # nozzle face
+            cv2.circle(scene, center, self._length(self.radius*4.5), 165, -1, cv2.LINE_AA, self._shift)
+            # ring reflections off the nozzle tip chamfer
+            for i in range(int(self.rings)):
+                cv2.circle(scene, center, self._length(self.radius*(2.0 + 0.8*i)), 225 - 25*i, 2, cv2.LINE_AA, self._shift)
+            # filament debris
+            for (dx, dy, a, b, angle) in self._debris:
+                cv2.ellipse(scene, self._point(position[0]+dx, position[1]+dy), (self._length(a), self._length(b)), angle, 0, 360, 40, -1, cv2.LINE_AA, self._shift)
+            # nozzle orifice
+            cv2.circle(scene, center, self._length(self.radius), 25, -1, cv2.LINE_AA, self._shift)
+        if self._map_x is not None:
+            scene = cv2.remap(scene, self._map_x, self._map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+        # optical blur, growing with distance from the focal plane
+        sigma = self.blur + abs(focus) * 2
+        if sigma > 0:
+            scene = cv2.GaussianBlur(scene, (0, 0), sigma)
+        image = scene.astype(np.float32) * self._vignette
+        if self.noise > 0:
+            image += self._rng.normal(0, self.noise, image.shape).astype(np.float32)
+        image = image.clip(0, 255).astype(np.uint8)
+        # brass tint
+        return cv2.merge([ (image*0.75).astype(np.uint8), (image*0.92).astype(np.uint8), image ])
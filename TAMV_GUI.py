@@ -55,10 +55,21 @@ import cv2
 import numpy as np
 import math
 import DuetWebAPI as DWA
+import NozzleDetector
+import FrameSource
+import DetectionPool
+import NozzleTracker
+import CameraModel
+import SettleDetector
+import FrameAverager
+import DuetSimulator
 from time import sleep, time
 import datetime
 import json
 import time
+import random
+import queue
+import threading
 
 # graphing imports
 import matplotlib
@@ -111,12 +122,12 @@ class CPDialog(QDialog):
         self.button_x5.setFixedSize(60,60)
         self.button_x6.setFixedSize(60,60)
         # attach actions
-        self.button_x1.clicked.connect(lambda: self.parent().printer.gCode('G91 G1 X-1 G90'))
-        self.button_x2.clicked.connect(lambda: self.parent().printer.gCode('G91 G1 X-0.1 G90'))
-        self.button_x3.clicked.connect(lambda: self.parent().printer.gCode('G91 G1 X-0.01 G90'))
-        self.button_x4.clicked.connect(lambda: self.parent().printer.gCode('G91 G1 X0.01 G90'))
-        self.button_x5.clicked.connect(lambda: self.parent().printer.gCode('G91 G1 X0.1 G90'))
-        self.button_x6.clicked.connect(lambda: self.parent().printer.gCode('G91 G1 X1 G90'))
+        self.button_x1.clicked.connect(lambda: self.printer.gCode('G91 G1 X-1 G90'))
+        self.button_x2.clicked.connect(lambda: self.printer.gCode('G91 G1 X-0.1 G90'))
+        self.button_x3.clicked.connect(lambda: self.printer.gCode('G91 G1 X-0.01 G90'))
+        self.button_x4.clicked.connect(lambda: self.printer.gCode('G91 G1 X0.01 G90'))
+        self.button_x5.clicked.connect(lambda: self.printer.gCode('G91 G1 X0.1 G90'))
+        self.button_x6.clicked.connect(lambda: self.printer.gCode('G91 G1 X1 G90'))
         # add buttons to window
         x_label = QLabel('X')
         buttons_layout.addWidget(x_label,0,0)
@@ -142,12 +153,12 @@ class CPDialog(QDialog):
         self.button_y5.setFixedSize(60,60)
         self.button_y6.setFixedSize(60,60)
         # attach actions
-        self.button_y1.clicked.connect(lambda: self.parent().printer.gCode('G91 G1 Y-1 G90'))
-        self.button_y2.clicked.connect(lambda: self.parent().printer.gCode('G91 G1 Y-0.1 G90'))
-        self.button_y3.clicked.connect(lambda: self.parent().printer.gCode('G91 G1 Y-0.01 G90'))
-        self.button_y4.clicked.connect(lambda: self.parent().printer.gCode('G91 G1 Y0.01 G90'))
-        self.button_y5.clicked.connect(lambda: self.parent().printer.gCode('G91 G1 Y0.1 G90'))
-        self.button_y6.clicked.connect(lambda: self.parent().printer.gCode('G91 G1 Y1 G90'))
+        self.button_y1.clicked.connect(lambda: self.printer.gCode('G91 G1 Y-1 G90'))
+        self.button_y2.clicked.connect(lambda: self.printer.gCode('G91 G1 Y-0.1 G90'))
+        self.button_y3.clicked.connect(lambda: self.printer.gCode('G91 G1 Y-0.01 G90'))
+        self.button_y4.clicked.connect(lambda: self.printer.gCode('G91 G1 Y0.01 G90'))
+        self.button_y5.clicked.connect(lambda: self.printer.gCode('G91 G1 Y0.1 G90'))
+        self.button_y6.clicked.connect(lambda: self.printer.gCode('G91 G1 Y1 G90'))
         # add buttons to window
         y_label = QLabel('Y')
         buttons_layout.addWidget(y_label,1,0)
@@ -173,12 +184,12 @@ class CPDialog(QDialog):
         self.button_z5.setFixedSize(60,60)
         self.button_z6.setFixedSize(60,60)
         # attach actions
-        self.button_z1.clicked.connect(lambda: self.parent().printer.gCode('G91 G1 Z-1 G90'))
-        self.button_z2.clicked.connect(lambda: self.parent().printer.gCode('G91 G1 Z-0.1 G90'))
-        self.button_z3.clicked.connect(lambda: self.parent().printer.gCode('G91 G1 Z-0.01 G90'))
-        self.button_z4.clicked.connect(lambda: self.parent().printer.gCode('G91 G1 Z0.01 G90'))
-        self.button_z5.clicked.connect(lambda: self.parent().printer.gCode('G91 G1 Z0.1 G90'))
-        self.button_z6.clicked.connect(lambda: self.parent().printer.gCode('G91 G1 Z1 G90'))
+        self.button_z1.clicked.connect(lambda: self.printer.gCode('G91 G1 Z-1 G90'))
+        self.button_z2.clicked.connect(lambda: self.printer.gCode('G91 G1 Z-0.1 G90'))
+        self.button_z3.clicked.connect(lambda: self.printer.gCode('G91 G1 Z-0.01 G90'))
+        self.button_z4.clicked.connect(lambda: self.printer.gCode('G91 G1 Z0.01 G90'))
+        self.button_z5.clicked.connect(lambda: self.printer.gCode('G91 G1 Z0.1 G90'))
+        self.button_z6.clicked.connect(lambda: self.printer.gCode('G91 G1 Z1 G90'))
         # add buttons to window
         z_label = QLabel('Z')
         buttons_layout.addWidget(z_label,2,0)
@@ -259,10 +270,7 @@ class CameraSettingsDialog(QDialog):
 
         # Camera Combobox
         self.camera_combo = QComboBox()
-        camera_description = str(video_src) + ': ' \
-            + str(self.parent().video_thread.cap.get(cv2.CAP_PROP_FRAME_WIDTH)) \
-            + 'x' + str(self.parent().video_thread.cap.get(cv2.CAP_PROP_FRAME_HEIGHT)) + ' @ ' \
-            + str(self.parent().video_thread.cap.get(cv2.CAP_PROP_FPS)) + 'fps'
+        camera_description = self.parent().camera_description
         self.camera_combo.addItem(camera_description)
         #self.camera_combo.currentIndexChanged.connect(self.parent().video_thread.changeVideoSrc)
         # Get cameras button
@@ -371,7 +379,7 @@ class CameraSettingsDialog(QDialog):
         #self.layout.addWidget(self.buttonBox)
 
     def resetDefaults(self):
-        self.parent().video_thread.resetProperties()
+        self.parent().video_thread.sendCommand('resetProperties')
         (brightness_input, contrast_input, saturation_input, hue_input) = self.parent().video_thread.getProperties()
         
         brightness_input = int(brightness_input)
@@ -390,7 +398,7 @@ class CameraSettingsDialog(QDialog):
     def changeBrightness(self):
         parameter = int(self.brightness_slider.value())
         try:
-            self.parent().video_thread.setProperty(brightness=parameter)
+            self.parent().video_thread.sendCommand('setProperty', brightness=parameter)
         except:
             None
         self.brightness_label.setText(str(parameter))
@@ -398,7 +406,7 @@ class CameraSettingsDialog(QDialog):
     def changeContrast(self):
         parameter = int(self.contrast_slider.value())
         try:
-            self.parent().video_thread.setProperty(contrast=parameter)
+            self.parent().video_thread.sendCommand('setProperty', contrast=parameter)
         except:
             None
         self.contrast_label.setText(str(parameter))
@@ -406,7 +414,7 @@ class CameraSettingsDialog(QDialog):
     def changeSaturation(self):
         parameter = int(self.saturation_slider.value())
         try:
-            self.parent().video_thread.setProperty(saturation=parameter)
+            self.parent().video_thread.sendCommand('setProperty', saturation=parameter)
         except:
             None
         self.saturation_label.setText(str(parameter))
@@ -414,7 +422,7 @@ class CameraSettingsDialog(QDialog):
     def changeHue(self):
         parameter = int(self.hue_slider.value())
         try:
-            self.parent().video_thread.setProperty(hue=parameter)
+            self.parent().video_thread.sendCommand('setProperty', hue=parameter)
         except:
             None
         self.hue_label.setText(str(parameter))
@@ -425,10 +433,7 @@ class CameraSettingsDialog(QDialog):
         index = 0
         self.camera_combo.clear()
         _cameras = []
-        original_camera_description = str(video_src) + ': ' \
-            + str(self.parent().video_thread.cap.get(cv2.CAP_PROP_FRAME_WIDTH)) \
-            + 'x' + str(self.parent().video_thread.cap.get(cv2.CAP_PROP_FRAME_HEIGHT)) + ' @ ' \
-            + str(self.parent().video_thread.cap.get(cv2.CAP_PROP_FPS)) + 'fps'
+        original_camera_description = self.parent().camera_description
         _cameras.append(original_camera_description)
         while i > 0:
             if index != video_src:
@@ -481,20 +486,42 @@ class CalibrateNozzles(QThread):
     # Signals
     status_update = pyqtSignal(str)
     message_update = pyqtSignal(str)
-    change_pixmap_signal = pyqtSignal(np.ndarray)
+    change_pixmap_signal = pyqtSignal(QImage)
     calibration_complete = pyqtSignal()
     detection_error = pyqtSignal(str)
     result_update = pyqtSignal(object)
+    debug_update = pyqtSignal(str)
+    offset_update = pyqtSignal(int, str, str)
+    source_update = pyqtSignal(str)
 
     alignment = False
     _running = False
     display_crosshair = False
     detection_on = False
+    # tool offsets measured per printer, used to predict where each tool will be found
+    offset_history_file = 'offset_history.json'
+    # results kept per tool, and how many of the most recent ones predict the next
+    offset_history_length = 20
+    offset_prediction_count = 5
+    # camera calibrations saved per printer and camera, reused by later sessions
+    transform_cache_file = 'transform_cache.json'
 
     def __init__(self, parent=None, th1=1, th2=50, thstep=1, minArea=600, minCircularity=0.8,numTools=0,cycles=1, align=False):
         super(QThread,self).__init__(parent=parent)
+        # time the last preview frame was sent to the GUI (see showFrame)
+        self.preview_time = 0
+        # crosshair overlay drawn for the current resolution (see crosshairOverlay)
+        self.crosshair_cache = None
+        # commands from the GUI thread, run by this thread between frames (see sendCommand)
+        self.commands = queue.Queue()
         # transformation matrix
         self.transform_matrix = []
+        # pixel to machine lookup table for the transformation matrix (see CameraModel.py)
+        self.lookup = None
+        # verify run: only align tools whose offset is outside verify_tolerance
+        self.verify = False
+        # refines the transformation matrix from alignment moves
+        self.refiner = None
         self.xray = False
         self.loose = False
         self.detector_changed = False
@@ -522,30 +549,32 @@ class CalibrateNozzles(QThread):
         self.saturation = -1
         self.hue = -1
 
+        # optional multi-process detection (see DetectionPool.py)
+        self.pool = None
+        # nozzle tracker used during alignment (see NozzleTracker.py)
+        self.tracker = None
+        # quality score of the last detection (see NozzleDetector.detectionQuality)
+        self.quality = 0.0
+        # time the machine last finished moving: older frames are not used for alignment
+        self.settle_time = 0
+        # measured image response to alignment moves relative to the camera calibration (1 = as calibrated)
+        self.plant_response = None
+        # detects the end of moves from the image (see SettleDetector.py)
+        self.settle = SettleDetector.SettleDetector()
+        # last camera frame read before a move, used as the settle reference
+        self.last_frame = None
+        # averages frames at each alignment position before detection (see FrameAverager.py)
+        self.averager = None
+        # GUI state this thread works with. The GUI changes it through sendCommand only.
+        self.printer = None
+        self.printerURL = None
+        self.cp_coords = {}
+        self.crosshair = False
+        # set by shutdown(): run() releases the camera and detection workers and returns
+        self._shutdown = False
+
         # Start Video feed
-        self.cap = cv2.VideoCapture(video_src)
-        self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, camera_width)
-        self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, camera_height)
-        self.cap.set(cv2.CAP_PROP_BUFFERSIZE,1)
-        #self.cap.set(cv2.CAP_PROP_FPS,25)
-        self.brightness_default = self.cap.get(cv2.CAP_PROP_BRIGHTNESS)
-        self.contrast_default = self.cap.get(cv2.CAP_PROP_CONTRAST)
-        self.saturation_default = self.cap.get(cv2.CAP_PROP_SATURATION)
-        self.hue_default = self.cap.get(cv2.CAP_PROP_HUE)
-
-        self.ret, self.cv_img = self.cap.read()
-        if self.ret:
-            local_img = self.cv_img
-            self.change_pixmap_signal.emit(local_img)
-        else:
-            self.cap.open(video_src)
-            self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, camera_width)
-            self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, camera_height)
-            self.cap.set(cv2.CAP_PROP_BUFFERSIZE,1)
-            #self.cap.set(cv2.CAP_PROP_FPS,25)
-            self.ret, self.cv_img = self.cap.read()
-            local_img = self.cv_img
-            self.change_pixmap_signal.emit(local_img)
+        self.openSource(video_src)
 
     def toggleXray(self):
         if self.xray:
@@ -562,25 +591,25 @@ class CalibrateNozzles(QThread):
         try:
             if int(brightness) >= 0:
                 self.brightness = brightness
-                self.cap.set(cv2.CAP_PROP_BRIGHTNESS,self.brightness)
+                self.source.set(cv2.CAP_PROP_BRIGHTNESS,self.brightness)
         except Exception as b1: 
             print('Brightness exception: ', b1 )
         try:
             if int(contrast) >= 0:
                 self.contrast = contrast
-                self.cap.set(cv2.CAP_PROP_CONTRAST,self.contrast)
+                self.source.set(cv2.CAP_PROP_CONTRAST,self.contrast)
         except Exception as c1:
             print('Contrast exception: ', c1 )
         try:
             if int(saturation) >= 0:
                 self.saturation = saturation
-                self.cap.set(cv2.CAP_PROP_SATURATION,self.saturation)
+                self.source.set(cv2.CAP_PROP_SATURATION,self.saturation)
         except Exception as s1:
             print('Saturation exception: ', s1 )
         try:
             if int(hue) >= 0:
                 self.hue = hue
-                self.cap.set(cv2.CAP_PROP_HUE,self.hue)
+                self.source.set(cv2.CAP_PROP_HUE,self.hue)
         except Exception as h1:
             print('Hue exception: ', h1 )
 
@@ -591,8 +620,11 @@ class CalibrateNozzles(QThread):
         self.setProperty(brightness=self.brightness_default, contrast = self.contrast_default, saturation=self.saturation_default, hue=self.hue_default)
 
     def run(self):
+        # the source was opened before the GUI connected to source_update
+        self.source_update.emit(self.source.describe())
         self.createDetector()
-        while True:
+        self.startPool()
+        while not self._shutdown:
             if self.detection_on:
                 if self.alignment:
                     try:
@@ -604,63 +636,57 @@ class CalibrateNozzles(QThread):
                             self.detector_changed = False
                         self._running = True
                         while self._running:
-                            self.cycles = self.parent().cycles
-                            for rep in range(self.cycles):
-                                for tool in range(self.parent().num_tools):
-                                    # process GUI events
-                                    app.processEvents()
-                                    # Update status bar
-                                    self.status_update.emit('Calibrating T' + str(tool) + ', cycle: ' + str(rep+1) + '/' + str(self.cycles))
-                                    # Load next tool for calibration
-                                    self.parent().printer.gCode('T'+str(tool))
-                                    # Move tool to CP coordinates
-                                    self.parent().printer.gCode('G1 X' + str(self.parent().cp_coords['X']))
-                                    self.parent().printer.gCode('G1 Y' + str(self.parent().cp_coords['Y']))
-                                    self.parent().printer.gCode('G1 Z' + str(self.parent().cp_coords['Z']))
-                                    # Wait for moves to complete
-                                    while self.parent().printer.getStatus() not in 'idle':
-                                        # process GUI events
-                                        app.processEvents()
-                                        self.ret, self.cv_img = self.cap.read()
-                                        if self.ret:
-                                            local_img = self.cv_img
-                                            self.change_pixmap_signal.emit(local_img)
-                                        else:
-                                            self.cap.open(video_src)
-                                            self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, camera_width)
-                                            self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, camera_height)
-                                            self.cap.set(cv2.CAP_PROP_BUFFERSIZE,1)
-                                            #self.cap.set(cv2.CAP_PROP_FPS,25)
-                                            self.ret, self.cv_img = self.cap.read()
-                                            local_img = self.cv_img
-                                            self.change_pixmap_signal.emit(local_img)
-                                            continue
-                                    # Update message bar
-                                    self.message_update.emit('Searching for nozzle..')
-                                    # Process runtime algorithm changes
-                                    if self.loose:
-                                        self.detect_minCircularity = 0.3
-                                    else: self.detect_minCircularity = 0.8
-                                    if self.detector_changed:
-                                        self.createDetector()
-                                        self.detector_changed = False
-                                    # Analyze frame for blobs
-                                    (c, transform, mpp) = self.calibrateTool(tool, rep)
-                                    # process GUI events
-                                    app.processEvents()
-                                    # apply offsets to machine
-                                    self.parent().printer.gCode( 'G10 P' + str(tool) + ' X' + str(c['X']) + ' Y' + str(c['Y']) )
+                            # order of the tool alignments, see alignmentOrder()
+                            loadedTool = None
+                            # new session: don't look for the nozzle seen last time
+                            self.forgetNozzle()
+                            for (rep, tool) in self.alignmentOrder(self.cycles, self.numTools):
+                                # run commands from the GUI
+                                self.processCommands()
+                                if self._shutdown:
+                                    break
+                                # Update status bar
+                                self.status_update.emit('Calibrating T' + str(tool) + ', cycle: ' + str(rep+1) + '/' + str(self.cycles))
+                                # Load next tool for calibration, or reseat it if it is already loaded
+                                if tool != loadedTool:
+                                    self.printer.gCode('T'+str(tool))
+                                    # a different nozzle: drop what the detector learned from the previous one
+                                    self.forgetNozzle()
+                                elif alignment_reseat:
+                                    self.printer.gCode('T-1')
+                                    self.printer.gCode('T'+str(tool))
+                                loadedTool = tool
+                                # Move tool to CP coordinates, corrected by the offset predicted from earlier results
+                                start = self.startPosition(tool)
+                                self.printer.moveTo(x=start['X'], y=start['Y'], z=self.cp_coords['Z'])
+                                # Wait for moves to complete, the image can't tell when a tool change is finished
+                                self.waitForMove(useImage=False)
+                                # Update message bar
+                                self.message_update.emit('Searching for nozzle..')
+                                # Process runtime algorithm changes
+                                if self.loose:
+                                    self.detect_minCircularity = 0.3
+                                else: self.detect_minCircularity = 0.8
+                                if self.detector_changed:
+                                    self.createDetector()
+                                    self.detector_changed = False
+                                # Analyze frame for blobs
+                                (c, transform, mpp) = self.calibrateTool(tool, rep)
+                                self.saveOffsetResult(tool, c)
+                                # run commands from the GUI
+                                self.processCommands()
+                                # apply offsets to machine (verified tools keep their offsets)
+                                if not c['verified']:
+                                    self.printer.gCode( 'G10 P' + str(tool) + ' X' + str(c['X']) + ' Y' + str(c['Y']) )
                             # signal end of execution
                             self._running = False
                         # Update status bar
                         self.status_update.emit('Calibration complete: Resetting machine.')
                         # HBHBHB
                         # Update debug window with results
-                        # self.parent().debugString += '\nCalibration output:\n'
-                        self.parent().printer.gCode('T-1')
-                        self.parent().printer.gCode('G1 X' + str(self.parent().cp_coords['X']))
-                        self.parent().printer.gCode('G1 Y' + str(self.parent().cp_coords['Y']))
-                        self.parent().printer.gCode('G1 Z' + str(self.parent().cp_coords['Z']))
+                        # self.debug_update.emit('\nCalibration output:\n')
+                        self.printer.gCode('T-1')
+                        self.printer.moveTo(x=self.cp_coords['X'], y=self.cp_coords['Y'], z=self.cp_coords['Z'])
                         self.status_update.emit('Calibration complete: Done.')
                         self.alignment = False
                         self.detection_on = False
@@ -672,8 +698,9 @@ class CalibrateNozzles(QThread):
                         self.detection_on = False
                         self.display_crosshair = False
                         self._running = False
-                        self.detection_error.emit(str(mn1))
-                        self.cap.release()
+                        if not self._shutdown:
+                            self.detection_error.emit(str(mn1))
+                            self.source.release()
                 else:
                     # don't run alignment - fetch frames and detect only
                     try:
@@ -695,43 +722,34 @@ class CalibrateNozzles(QThread):
                                 self.detector_changed = False
                             # Run detection and update output
                             self.analyzeFrame()
-                            # process GUI events
-                            app.processEvents()
+                            # run commands from the GUI
+                            self.processCommands()
                     except Exception as mn1:
                         self._running = False
                         self.detection_error.emit(str(mn1))
-                        self.cap.release()
+                        self.source.release()
             else:
-                while not self.detection_on:
+                while not self.detection_on and not self._shutdown:
                     try:
-                        self.ret, self.cv_img = self.cap.read()
+                        # run commands from the GUI
+                        self.processCommands()
+                        # the frame source reconnects by itself if the camera dropped out
+                        self.ret, self.cv_img, self.frame_time = self.source.read()
                         if self.ret:
-                            local_img = self.cv_img
-                            self.change_pixmap_signal.emit(local_img)
-                        else:
-                            # reset capture
-                            self.cap.open(video_src)
-                            self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, camera_width)
-                            self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, camera_height)
-                            self.cap.set(cv2.CAP_PROP_BUFFERSIZE,1)
-                            #self.cap.set(cv2.CAP_PROP_FPS,25)
-                            self.ret, self.cv_img = self.cap.read()
-                            if self.ret:
-                                local_img = self.cv_img
-                                self.change_pixmap_signal.emit(local_img)
-                            continue
-                        app.processEvents()
+                            self.showFrame(self.cv_img)
+                        elif self.source.finished:
+                            # end of a file or directory: keep handling commands (e.g. a new source) without spinning
+                            time.sleep(0.1)
                     except Exception as mn2:
                         self.status_update( 'Error: ' + str(mn2) )
                         print('Error: ' + str(mn2))
-                        self.cap.release()
+                        self.source.release()
                         self.detection_on = False
                         self._running = False
                         exit()
-                    app.processEvents()
-                app.processEvents()
                 continue
-        self.cap.release()
+        self.stopPool()
+        self.source.release()
 
     def analyzeFrame(self):
         # Placeholder coordinates
@@ -740,43 +758,9 @@ class CalibrateNozzles(QThread):
         nocircle = 0
         # Random time offset
         rd = int(round(time.time()*1000))
-        # reset capture
-        #self.cap.open(video_src)
-        #self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, camera_width)
-        #self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, camera_height)
-        #self.cap.set(cv2.CAP_PROP_BUFFERSIZE,1)
-        #self.cap.set(cv2.CAP_PROP_FPS,25)
 
         while True and self.detection_on:
-            app.processEvents()
-            self.ret, self.frame = self.cap.read()
-            if not self.ret:
-                # reset capture
-                self.cap.open(video_src)
-                self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, camera_width)
-                self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, camera_height)
-                self.cap.set(cv2.CAP_PROP_BUFFERSIZE,1)
-                #self.cap.set(cv2.CAP_PROP_FPS,25)
-                continue
-            if self.alignment:
-                try:
-                    # capture tool location in machine space before processing
-                    toolCoordinates = self.parent().printer.getCoords()
-                except Exception as c1:
-                    toolCoordinates = None
-            # capture first clean frame for display
-            cleanFrame = self.frame
-            # apply nozzle detection algorithm
-            # Detection algorithm 1:
-            #    gamma correction -> use Y channel from YUV -> GaussianBlur (7,7),6 -> adaptive threshold
-            gammaInput = 1.2
-            self.frame = self.adjust_gamma(image=self.frame, gamma=gammaInput)
-            yuv = cv2.cvtColor(self.frame, cv2.COLOR_BGR2YUV)
-            yuvPlanes = cv2.split(yuv)
-            yuvPlanes[0] = cv2.GaussianBlur(yuvPlanes[0],(7,7),6)
-            yuvPlanes[0] = cv2.adaptiveThreshold(yuvPlanes[0],255,cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY,35,1)
-            self.frame = cv2.cvtColor(yuvPlanes[0],cv2.COLOR_GRAY2BGR)
-            target = [int(np.around(self.frame.shape[1]/2)),int(np.around(self.frame.shape[0]/2))]
+            self.processCommands()
             # Process runtime algorithm changes
             if self.loose:
                 self.detect_minCircularity = 0.3
@@ -784,20 +768,57 @@ class CalibrateNozzles(QThread):
             if self.detector_changed:
                 self.createDetector()
                 self.detector_changed = False
-            # run nozzle detection for keypoints
-            keypoints = self.detector.detect(self.frame)
-            # draw the timestamp on the frame AFTER the circle detector! Otherwise it finds the circles in the numbers.
-            if self.xray:
+            if self.pool is not None:
+                # detection workers return keypoints and an annotated preview
+                (self.ret, keypoints, self.frame, toolCoordinates, target) = self.detectPooled(self.settle_time)
+                if not self.ret:
+                    if self.source.finished and self.pool.inFlight() == 0:
+                        self.sourceEnded()
+                    continue
+                cleanFrame = self.frame
+            else:
+                self.ret, self.frame, self.frame_time = self.source.read()
+                if not self.ret:
+                    if self.source.finished:
+                        self.sourceEnded()
+                    continue
+                self.last_frame = self.frame
+                if self.alignment and self.frame_time < self.settle_time:
+                    # frame was exposed before the last move finished
+                    self.showFrame(self.frame)
+                    continue
+                if self.alignment and self.averager is not None:
+                    # detect once enough frames of this position have been averaged
+                    self.frame = self.averager.add(self.frame)
+                    if not self.averager.ready():
+                        self.showFrame(self.frame)
+                        continue
+                    # next average from new frames only: overlapping windows aren't independent detections
+                    self.averager.reset()
+                if self.alignment:
+                    try:
+                        # capture tool location in machine space before processing
+                        toolCoordinates = self.printer.getCoords()
+                    except Exception as c1:
+                        toolCoordinates = None
+                # capture first clean frame for display
                 cleanFrame = self.frame
+                target = [int(np.around(self.frame.shape[1]/2)),int(np.around(self.frame.shape[0]/2))]
+                # run nozzle detection for keypoints
+                keypoints, self.frame = self.detector.detect(self.frame)
+                # draw the timestamp on the frame AFTER the circle detector! Otherwise it finds the circles in the numbers.
+                if self.xray:
+                    cleanFrame = self.detector.expand(self.frame, cleanFrame.shape[1], cleanFrame.shape[0])
+            # detection runs on a single luma plane, the display overlay is drawn in color
+            if len(cleanFrame.shape) < 3:
+                cleanFrame = cv2.cvtColor(cleanFrame, cv2.COLOR_GRAY2BGR)
             # check if we are displaying a crosshair
             if self.display_crosshair:
                 self.frame = cv2.line(cleanFrame, (target[0],    target[1]-25), (target[0],    target[1]+25), (0, 255, 0), 1)
                 self.frame = cv2.line(self.frame, (target[0]-25, target[1]   ), (target[0]+25, target[1]   ), (0, 255, 0), 1)
             else: self.frame = cleanFrame
-            # update image
-            local_img = self.frame
-            self.change_pixmap_signal.emit(local_img)
             if(nocircle> 25):
+                self.showFrame(self.frame)
                 self.message_update.emit( 'Error in detecting nozzle.' )
                 nocircle = 0
                 continue
@@ -807,31 +828,37 @@ class CalibrateNozzles(QThread):
                     nocircle += 1
                     self.frame = self.putText(self.frame,'No circles found',offsety=3)
                     self.message_update.emit( 'No circles found.' )
-                    local_img = self.frame
-                    self.change_pixmap_signal.emit(local_img)
+                self.showFrame(self.frame)
                 continue
+            if (num_keypoints > 1) and self.alignment and self.tracker is not None and self.tracker.initialized():
+                # keep the only circle that matches the tracked nozzle position, if there is one
+                candidates = [k for k in keypoints if self.tracker.distance(k.pt[0], k.pt[1]) <= self.tracker.gate_limit]
+                if len(candidates) == 1:
+                    keypoints = candidates
+                    num_keypoints = 1
             if (num_keypoints > 1):
                 if (25 < (int(round(time.time() * 1000)) - rd)):
                     self.message_update.emit( 'Too many circles found. Please stop and clean the nozzle.' )
                     self.frame = self.putText(self.frame,'Too many circles found '+str(num_keypoints),offsety=3, color=(255,255,255))
-                    self.frame = cv2.drawKeypoints(self.frame, keypoints, np.array([]), (255,255,255), cv2.DRAW_MATCHES_FLAGS_DRAW_RICH_KEYPOINTS)
-                    local_img = self.frame
-                    self.change_pixmap_signal.emit(local_img)
+                    if self.pool is None:
+                        self.frame = cv2.drawKeypoints(self.frame, keypoints, np.array([]), (255,255,255), cv2.DRAW_MATCHES_FLAGS_DRAW_RICH_KEYPOINTS)
+                self.showFrame(self.frame)
                 continue
             # Found one and only one circle.  Put it on the frame.
             nocircle = 0 
-            xy = np.around(keypoints[0].pt)
+            xy = keypoints[0].pt
             r = np.around(keypoints[0].size/2)
+            # detection quality score (see NozzleDetector.detectionQuality)
+            self.quality = keypoints[0].response
             # draw the blobs that look circular
-            self.frame = cv2.drawKeypoints(self.frame, keypoints, np.array([]), (0,0,255), cv2.DRAW_MATCHES_FLAGS_DRAW_RICH_KEYPOINTS)
+            if self.pool is None:
+                self.frame = cv2.drawKeypoints(self.frame, keypoints, np.array([]), (0,0,255), cv2.DRAW_MATCHES_FLAGS_DRAW_RICH_KEYPOINTS)
             # Note its radius and position
-            ts =  'U{0:3.0f} V{1:3.0f} R{2:2.0f}'.format(xy[0],xy[1],r)
-            xy = np.uint16(xy)
+            ts =  'U{0:3.0f} V{1:3.0f} R{2:2.0f} Q{3:1.2f}'.format(xy[0],xy[1],r,self.quality)
             #self.frame = self.putText(self.frame, ts, offsety=2, color=(0, 255, 0), stroke=2)
             self.message_update.emit(ts)
             # show the frame
-            local_img = self.frame
-            self.change_pixmap_signal.emit(local_img)
+            self.showFrame(self.frame)
             rd = int(round(time.time() * 1000))
             #end the loop
             break
@@ -844,8 +871,6 @@ class CalibrateNozzles(QThread):
     def calibrateTool(self, tool, rep):
         # timestamp for caluclating tool calibration runtime
         self.startTime = time.time()
-        # average location of keypoints in frame
-        self.average_location=[0,0]
         # current location
         self.current_location = {'X':0,'Y':0}
         # guess position used for camera calibration
@@ -859,44 +884,125 @@ class CalibrateNozzles(QThread):
         # detected blob counter
         self.detect_count = 0
         # Save CP coordinates to local class
-        self.cp_coordinates = self.parent().cp_coords
-        # number of average position loops
-        self.position_iterations = 5
+        self.cp_coordinates = self.cp_coords
+        # filtered nozzle position, settles after a few consistent detections
+        # with quality scores, a single good detection can settle the estimate
+        minUpdates = 1 if quality_acceptance else 2
+        if denoise_frames > 1:
+            # one detection on the average of denoise_frames frames is as good as that many detections.
+            # The averager is reset after every average, so each detection comes from different frames.
+            self.averager = FrameAverager.FrameAverager(denoise_frames, denoise_mode)
+            self.tracker = NozzleTracker.NozzleTracker(noise=0.5/np.sqrt(denoise_frames), minUpdates=1)
+        else:
+            self.averager = None
+            self.tracker = NozzleTracker.NozzleTracker(minUpdates=minUpdates)
         # calibration move set (0.5mm radius circle over 10 moves)
         self.calibrationCoordinates = [ [0,-0.5], [0.294,-0.405], [0.476,-0.155], [0.476,0.155], [0.294,0.405], [0,0.5], [-0.294,0.405], [-0.476,0.155], [-0.476,-0.155], [-0.294,-0.405] ]
 
+        # carriage move used to validate a saved camera calibration (0.5mm diagonal)
+        self.validationMove = [0.354, 0.354]
+        # largest error (pixels) between the move seen by the camera and the saved calibration
+        self.validation_tolerance = 1.0
+        # sweep calibration: circle radius (mm) and feedrate (mm/min) of the outer circle.
+        # At 60mm/min the sweep takes about 7 seconds, a few hundred frames at 30fps.
+        self.sweepRadius = 0.5
+        self.sweepFeed = 60
+        # frames buffered during the sweep, at most sweepMaxFrames and sweepMemory bytes
+        self.sweepMaxFrames = 300
+        self.sweepMemory = 256*1024*1024
+        # minimum number of detections for a sweep calibration
+        self.sweepMinSamples = 60
+        self.sweep_failed = False
+
         # Check if camera calibration matrix is already defined
         if len(self.transform_matrix) > 1:
             # set state flag to Step 2: nozzle alignment stage
             self.state = 200
-            self.parent().debugString += '\nCalibrating T'+str(tool)+':C'+str(rep)+': '
+            self.debug_update.emit('\nCalibrating T'+str(tool)+':C'+str(rep)+': ')
+        elif self.loadTransformCache():
+            # camera calibration saved by an earlier session: validate it with one move before using it
+            self.state = 100
         
         # Space coordinates
         self.space_coordinates = []
         self.camera_coordinates = []
         self.calibration_moves = 0
+        # no alignment move made yet for this tool
+        self.displacement = None
+        # set when a verify run accepts the tool without aligning it
+        self.verified = False
+        if self.plant_response is None:
+            self.gain = alignment_gain
+        else:
+            self.gain = float(np.clip(0.9 / self.plant_response, 0.2, 1.0))
 
         while True:
             (self.xy, self.target, self.tool_coordinates, self.radius) = self.analyzeFrame()
-            # analyzeFrame has returned our target coordinates, average its location and process according to state
-            self.average_location[0] += self.xy[0]
-            self.average_location[1] += self.xy[1]
-            
+            # analyzeFrame has returned our target coordinates, fuse it with the previous detections
             self.detect_count += 1
-
-            # check if we've reached our number of detections for average positioning
-            if self.detect_count >= self.position_iterations:
-                # calculate average X Y position from detection
-                self.average_location[0] /= self.detect_count
-                self.average_location[1] /= self.detect_count
-                # round to 3 decimal places
-                self.average_location = np.around(self.average_location,3)
-                # get another detection validated
-                (self.xy, self.target, self.tool_coordinates, self.radius) = self.analyzeFrame()
-                
+            if quality_acceptance:
+                score = self.tracker.score(self.xy[0], self.xy[1], self.radius, self.quality)
+                accepted = self.tracker.update(self.xy[0], self.xy[1], score, self.radius)
+            else:
+                accepted = self.tracker.update(self.xy[0], self.xy[1])
+
+            # check if the tracker has settled on the nozzle position, and process according to state
+            if accepted and self.tracker.settled():
+                self.xy = self.tracker.position()
+
+                #### Step 0: validate the saved camera calibration
+                if self.state == 100:
+                    self.status_update.emit('Validating saved camera calibration..')
+                    self.message_update.emit('Validating saved camera calibration..')
+                    # save position before the validation move
+                    self.validation_start = (self.xy, self.tool_coordinates)
+                    self.printer.gCode('G91 G1 X' + str(self.validationMove[0]) + ' Y' + str(self.validationMove[1]) +' F3000 G90 ')
+                    self.waitForMove()
+                    self.tracker.reset()
+                    self.state = 101
+                    continue
+                elif self.state == 101:
+                    (startxy, startCoordinates) = self.validation_start
+                    # carriage move predicted by the saved calibration from the nozzle positions in the image
+                    predicted = CameraModel.evaluate(self.cached_transform, [self.normalize_coords(self.xy)])[0] - CameraModel.evaluate(self.cached_transform, [self.normalize_coords(startxy)])[0]
+                    actual = [self.tool_coordinates['X'] - startCoordinates['X'], self.tool_coordinates['Y'] - startCoordinates['Y']]
+                    error = np.around(np.hypot(predicted[0] - actual[0], predicted[1] - actual[1]) / self.cached_mpp, 2)
+                    if error <= self.validation_tolerance:
+                        self.mpp = self.cached_mpp
+                        self.useTransform(self.cached_transform, self.cached_points)
+                        self.debug_update.emit('Using saved camera calibration (validation error ' + str(error) + ' pixels).\n')
+                        self.debug_update.emit('Millimeters per pixel: ' + str(self.mpp) + '\n')
+                        print('Using saved camera calibration, validation error: ' + str(error) + ' pixels.')
+                        self.message_update.emit('Saved camera calibration is valid - MPP = ' + str(self.mpp))
+                        self.status_update.emit('Calibrating T' + str(tool) + ', cycle: ' + str(rep+1) + '/' + str(self.cycles))
+                        self.state = 200
+                        # start tool calibration timer
+                        self.startTime = time.time()
+                        self.debug_update.emit('\nCalibrating T'+str(tool)+':C'+str(rep)+': ')
+                    else:
+                        self.debug_update.emit('Saved camera calibration is off by ' + str(error) + ' pixels, recalibrating.\n')
+                        print('Saved camera calibration is off by ' + str(error) + ' pixels, recalibrating.')
+                        self.message_update.emit('Camera has moved, recalibrating..')
+                        self.state = 0
+                    continue
                 #### Step 1: camera calibration and transformation matrix calculation
-                if self.state == 0:
-                    self.parent().debugString += 'Calibrating camera...\n'
+                elif self.state == 0 and calibration_mode == 'sweep' and not self.sweep_failed:
+                    self.debug_update.emit('Calibrating camera (sweep)...\n')
+                    self.status_update.emit('Calibrating camera..')
+                    self.message_update.emit('Calibrating rotation.. (sweeping)')
+                    if self.sweepCalibration():
+                        # the sweep has collected the calibration points, finish with the center point
+                        self.state = len(self.calibrationCoordinates)
+                    else:
+                        self.debug_update.emit('Sweep calibration failed, calibrating with steps.\n')
+                        print('Sweep calibration failed, calibrating with steps.')
+                        self.sweep_failed = True
+                    # the sweep ends back at the center once the controller is idle
+                    self.waitForMove(useImage=False)
+                    self.tracker.reset()
+                    continue
+                elif self.state == 0:
+                    self.debug_update.emit('Calibrating camera...\n')
                     # Update GUI thread with current status and percentage complete
                     self.status_update.emit('Calibrating camera..')
                     self.message_update.emit('Calibrating rotation.. (10%)')
@@ -912,7 +1018,9 @@ class CalibrateNozzles(QThread):
                     # move carriage for calibration
                     self.offsetX = self.calibrationCoordinates[0][0]
                     self.offsetY = self.calibrationCoordinates[0][1]
-                    self.parent().printer.gCode('G91 G1 X' + str(self.offsetX) + ' Y' + str(self.offsetY) +' F3000 G90 ')
+                    self.printer.gCode('G91 G1 X' + str(self.offsetX) + ' Y' + str(self.offsetY) +' F3000 G90 ')
+                    self.waitForMove()
+                    self.tracker.reset()
                     # Update state tracker to second nozzle calibration move
                     self.state = 1
                     continue
@@ -920,10 +1028,15 @@ class CalibrateNozzles(QThread):
                 elif self.state >= 1 and self.state < len(self.calibrationCoordinates):
                     # Update GUI thread with current status and percentage complete
                     self.status_update.emit('Calibrating camera..')
-                    self.message_update.emit('Calibrating rotation.. (' + str(self.state*10) + '%)')
+                    self.message_update.emit('Calibrating rotation.. (' + str(int(100*self.state/len(self.calibrationCoordinates))) + '%)')
                     # check if we've already moved, and calculate mpp value
                     if self.state == 1:
                         self.mpp = np.around(0.5/self.getDistance(self.oldxy[0],self.oldxy[1],self.xy[0],self.xy[1]),4)
+                        if calibration_grid == 'grid' or calibration_order > 2:
+                            # now the image scale is known, add a 5x5 grid of points across the field of view
+                            # (points on a single circle can't constrain the higher order terms)
+                            spacing = 0.35*min(camera_width, camera_height)*self.mpp/2
+                            self.calibrationCoordinates = self.calibrationCoordinates + [ [np.around(i*spacing,3), np.around(j*spacing,3)] for j in range(-2,3) for i in range(-2,3) if (i,j) != (0,0) ]
                     # save position as previous position
                     self.oldxy = self.xy
                     # save machine coordinates for detected nozzle
@@ -933,19 +1046,21 @@ class CalibrateNozzles(QThread):
                     # return carriage to relative center of movement
                     self.offsetX = -1*self.offsetX
                     self.offsetY = -1*self.offsetY
-                    self.parent().printer.gCode('G91 G1 X' + str(self.offsetX) + ' Y' + str(self.offsetY) +' F3000 G90 ')
+                    self.printer.gCode('G91 G1 X' + str(self.offsetX) + ' Y' + str(self.offsetY) +' F3000 G90 ')
                     # move carriage a random amount in X&Y to collect datapoints for transform matrix
                     self.offsetX = self.calibrationCoordinates[self.state][0]
                     self.offsetY = self.calibrationCoordinates[self.state][1]
-                    self.parent().printer.gCode('G91 G1 X' + str(self.offsetX) + ' Y' + str(self.offsetY) +' F3000 G90 ')
+                    self.printer.gCode('G91 G1 X' + str(self.offsetX) + ' Y' + str(self.offsetY) +' F3000 G90 ')
+                    self.waitForMove()
+                    self.tracker.reset()
                     # increment state tracker to next calibration move
                     self.state += 1
                     continue
                 # check if final calibration move has been completed
                 elif self.state == len(self.calibrationCoordinates):
                     calibration_time = np.around(time.time() - self.startTime,1)
-                    self.parent().debugString += 'Camera calibration completed in ' + str(calibration_time) + ' seconds.\n'
-                    self.parent().debugString += 'Millimeters per pixel: ' + str(self.mpp) + '\n\n'
+                    self.debug_update.emit('Camera calibration completed in ' + str(calibration_time) + ' seconds.\n')
+                    self.debug_update.emit('Millimeters per pixel: ' + str(self.mpp) + '\n\n')
                     print('Millimeters per pixel: ' + str(self.mpp))
                     print('Camera calibration completed in ' + str(calibration_time) + ' seconds.')
                     # Update GUI thread with current status and percentage complete
@@ -959,17 +1074,23 @@ class CalibrateNozzles(QThread):
                     self.camera_coordinates.append( (self.xy[0],self.xy[1]) )
                     # calculate camera transformation matrix
                     self.transform_input = [(self.space_coordinates[i], self.normalize_coords(camera)) for i, camera in enumerate(self.camera_coordinates)]
-                    self.transform_matrix, self.transform_residual = self.least_square_mapping(self.transform_input)
+                    transform, self.transform_residuals = self.least_square_mapping(self.transform_input)
+                    self.useTransform(transform, [self.normalize_coords(camera) for camera in self.camera_coordinates])
+                    residuals = np.hypot(self.transform_residuals[:,0], self.transform_residuals[:,1]) * 1000
+                    self.debug_update.emit('Camera model fit error: ' + str(np.around(np.sqrt(np.mean(residuals**2)),1)) + ' microns RMS, ' + str(np.around(np.max(residuals),1)) + ' microns max over ' + str(len(residuals)) + ' points.\n')
+                    self.saveTransformCache()
                     # define camera center in machine coordinate space
-                    self.newCenter = self.transform_matrix.T @ np.array([0, 0, 0, 0, 0, 1])
+                    self.newCenter = CameraModel.evaluate(self.transform_matrix, [(0, 0)])[0]
                     self.guess_position[0]= np.around(self.newCenter[0],3)
                     self.guess_position[1]= np.around(self.newCenter[1],3)
-                    self.parent().printer.gCode('G90 G1 X{0:-1.3f} Y{1:-1.3f} F1000 G90 '.format(self.guess_position[0],self.guess_position[1]))
+                    self.printer.gCode('G90 G1 X{0:-1.3f} Y{1:-1.3f} F1000 G90 '.format(self.guess_position[0],self.guess_position[1]))
+                    self.waitForMove()
+                    self.tracker.reset()
                     # update state tracker to next phase
                     self.state = 200
                     # start tool calibration timer
                     self.startTime = time.time()
-                    self.parent().debugString += '\nCalibrating T'+str(tool)+':C'+str(rep)+': '
+                    self.debug_update.emit('\nCalibrating T'+str(tool)+':C'+str(rep)+': ')
                     continue
                 #### Step 2: nozzle alignment stage
                 elif self.state == 200:
@@ -979,24 +1100,61 @@ class CalibrateNozzles(QThread):
                     # increment moves counter
                     self.calibration_moves += 1
                     # nozzle detected, frame rotation is set, start
-                    self.cx,self.cy = self.normalize_coords(self.xy)
-                    self.v = [self.cx**2, self.cy**2, self.cx*self.cy, self.cx, self.cy, 0]
-                    self.offsets = -1*(0.55*self.transform_matrix.T @ self.v)
-                    self.offsets[0] = np.around(self.offsets[0],3)
-                    self.offsets[1] = np.around(self.offsets[1],3)
-                    # Move it a bit
-                    self.parent().printer.gCode( 'M564 S1' )
-                    self.parent().printer.gCode( 'G91 G1 X{0:-1.3f} Y{1:-1.3f} F1000 G90 '.format(self.offsets[0],self.offsets[1]) )
+                    self.refineTransform()
+                    if alignment_mode in ['oneshot', 'adaptive']:
+                        # full correction predicted from the sub-pixel nozzle position, stop when it is within tolerance
+                        self.residual = -1*np.array(self.pixelOffset(self.xy[0], self.xy[1]))
+                        aligned = np.hypot(self.residual[0], self.residual[1])*1000 <= self.alignmentThreshold()
+                        if alignment_mode == 'adaptive':
+                            self.updateGain()
+                            self.offsets = np.around(self.gain*self.residual,3)
+                        else:
+                            self.offsets = np.around(self.residual,3)
+                        # a correction smaller than the machine resolution can't be made
+                        aligned = aligned or ( self.offsets[0] == 0.0 and self.offsets[1] == 0.0 )
+                    else:
+                        # moves stop once the nozzle is within half a pixel of the target
+                        (u, v) = np.around(self.xy)
+                        self.residual = np.zeros(2)
+                        self.offsets = -1*(alignment_gain*np.array(self.pixelOffset(u, v)))
+                        self.offsets[0] = np.around(self.offsets[0],3)
+                        self.offsets[1] = np.around(self.offsets[1],3)
+                        aligned = ( self.offsets[0] == 0.0 and self.offsets[1] == 0.0 )
+                    if self.verify and self.calibration_moves == 1:
+                        # verify only: accept the tool where it is if its offset is within tolerance of the current G10 offset
+                        verifyResidual = -1*np.array(self.pixelOffset(self.xy[0], self.xy[1]))
+                        deviation = np.around(np.hypot(self.cp_coordinates['X'] - self.tool_coordinates['X'] - verifyResidual[0], self.cp_coordinates['Y'] - self.tool_coordinates['Y'] - verifyResidual[1])*1000,1)
+                        if deviation <= verify_tolerance:
+                            self.debug_update.emit('within tolerance (' + str(deviation) + ' microns), ')
+                            self.residual = verifyResidual
+                            self.verified = True
+                            aligned = True
+                        else:
+                            self.debug_update.emit('off by ' + str(deviation) + ' microns, aligning.. ')
+                            print('T' + str(tool) + ' is off by ' + str(deviation) + ' microns, aligning.')
+                    if not aligned and self.calibration_moves > alignment_max_moves:
+                        self.debug_update.emit('T' + str(tool) + ' did not converge in ' + str(alignment_max_moves) + ' moves. ')
+                        print('Warning: T' + str(tool) + ' did not converge in ' + str(alignment_max_moves) + ' moves, using the last position.')
+                        aligned = True
+                    if not aligned:
+                        # Move it a bit
+                        self.printer.gCode( 'M564 S1' )
+                        self.printer.gCode( 'G91 G1 X{0:-1.3f} Y{1:-1.3f} F1000 G90 '.format(self.offsets[0],self.offsets[1]) )
+                        # predict where the nozzle will be seen after the move
+                        self.displacement = self.pixelDisplacement(self.xy, self.offsets)
+                        self.tracker.move(*self.displacement)
+                        self.last_move = np.array(self.offsets, dtype=float)
                     # save position as previous position
                     self.oldxy = self.xy
-                    if ( self.offsets[0] == 0.0 and self.offsets[1] == 0.0 ):
-                        self.parent().debugString += str(self.calibration_moves) + ' moves.\n'
-                        self.parent().printer.gCode( 'G1 F13200' )
+                    if aligned:
+                        self.debug_update.emit(str(self.calibration_moves) + ' moves.\n')
+                        self.printer.gCode( 'G1 F13200' )
                         # Update GUI with progress
                         # calculate final offsets and return results
-                        self.tool_offsets = self.parent().printer.getG10ToolOffset(tool)
-                        final_x = np.around( (self.cp_coordinates['X'] + self.tool_offsets['X']) - self.tool_coordinates['X'], 3 )
-                        final_y = np.around( (self.cp_coordinates['Y'] + self.tool_offsets['Y']) - self.tool_coordinates['Y'], 3 )
+                        # (the residual left within tolerance by a one-shot alignment is added without moving, + 0.0 avoids printing -0.000)
+                        self.tool_offsets = self.printer.getG10ToolOffset(tool)
+                        final_x = np.around( (self.cp_coordinates['X'] + self.tool_offsets['X']) - (self.tool_coordinates['X'] + self.residual[0]), 3 ) + 0.0
+                        final_y = np.around( (self.cp_coordinates['Y'] + self.tool_offsets['Y']) - (self.tool_coordinates['Y'] + self.residual[1]), 3 ) + 0.0
                         string_final_x = "{:.3f}".format(final_x)
                         string_final_y = "{:.3f}".format(final_y)
                         # Save offset to output variable
@@ -1006,49 +1164,400 @@ class CalibrateNozzles(QThread):
                         _return['Y'] = final_y
                         _return['MPP'] = self.mpp
                         _return['time'] = np.around(time.time() - self.startTime,1)
+                        _return['moves'] = self.calibration_moves
+                        _return['verified'] = self.verified
                         self.message_update.emit('Nozzle calibrated: offset coordinates X' + str(_return['X']) + ' Y' + str(_return['Y']) )
-                        self.parent().debugString += 'T' + str(tool) + ', cycle ' + str(rep+1) + ' completed in ' + str(_return['time']) + ' seconds.\n'
+                        self.debug_update.emit('T' + str(tool) + ', cycle ' + str(rep+1) + ' completed in ' + str(_return['time']) + ' seconds.\n')
                         print('T' + str(tool) + ', cycle ' + str(rep+1) + ' completed in ' + str(_return['time']) + ' seconds.')
                         self.message_update.emit('T' + str(tool) + ', cycle ' + str(rep+1) + ' completed in ' + str(_return['time']) + ' seconds.')
-                        self.parent().printer.gCode( 'G1 F13200' )
-
-                        self.parent().debugString += 'G10 P' + str(tool) + ' X' + string_final_x + ' Y' + string_final_y + '\n'
-                        x_tableitem = QTableWidgetItem(string_final_x)
-                        x_tableitem.setBackground(QColor(100,255,100,255))
-                        y_tableitem = QTableWidgetItem(string_final_y)
-                        y_tableitem.setBackground(QColor(100,255,100,255))
-                        self.parent().offsets_table.setItem(tool,0,x_tableitem)
-                        self.parent().offsets_table.setItem(tool,1,y_tableitem)
+                        self.printer.gCode( 'G1 F13200' )
+
+                        self.debug_update.emit('G10 P' + str(tool) + ' X' + string_final_x + ' Y' + string_final_y + '\n')
+                        self.offset_update.emit(tool, string_final_x, string_final_y)
                         self.result_update.emit({
                             'tool': str(tool),
                             'cycle': str(rep),
                             'mpp': str(self.mpp),
                             'X': string_final_x,
-                            'Y': string_final_y
+                            'Y': string_final_y,
+                            'moves': str(self.calibration_moves),
+                            'detections': str(self.detect_count),
+                            'time': str(_return['time']),
+                            'verified': str(self.verified),
+                            'schedule': self.scheduleName()
                         })
                         return(_return, self.transform_matrix, self.mpp)
                     else:
+                        # moves under a pixel don't show in the image
+                        self.waitForMove(expectMotion=(np.hypot(*self.displacement) >= 1.0))
                         self.state = 200
                         continue
                 self.avg = [0,0]
                 self.location = {'X':0,'Y':0}
                 self.count = 0
 
+    def alignmentThreshold(self):
+        # Distance from the camera center (microns) accepted as aligned. The nozzle position can't be
+        # resolved better than the noise of the averaged detections, so the tolerance is widened to
+        # twice the standard error of the estimate when the detections are noisy.
+        noise = self.tracker.measuredNoise() / np.sqrt(max(1, self.tracker.updates))
+        return max(alignment_tolerance, 2*noise*self.mpp*1000)
+
+    def updateGain(self):
+        # Adapt the alignment gain to the response of the last move. The image displacement seen after
+        # a move is compared with the one predicted by the camera calibration; the gain is set to remove
+        # 90% of the error with the next move.
+        if self.displacement is None:
+            return
+        predicted = np.array(self.displacement)
+        if np.hypot(*predicted) < 2.0:
+            # too small to measure reliably
+            return
+        observed = np.array(self.xy) - np.array(self.oldxy)
+        response = np.clip(observed @ predicted / (predicted @ predicted), 0.25, 4.0)
+        if self.plant_response is None:
+            self.plant_response = response
+        else:
+            self.plant_response = 0.5*(self.plant_response + response)
+        self.gain = float(np.clip(0.9 / self.plant_response, 0.2, 1.0))
+
+    def sweepCalibration(self):
+        # Collect camera calibration points while the nozzle moves around two circles.
+        # Machine positions are polled in their own thread (see pollPositions) while this thread
+        # buffers timestamped frames, so neither waits for the other. The nozzle is detected in the
+        # buffered frames once the sweep is done, and every detection is matched to the machine
+        # position at the time of its frame. The circles are run in opposite directions at the same
+        # angular speed, so a timing error between frames and positions rotates both the same amount
+        # in opposite ways.
+        center = (self.tool_coordinates['X'], self.tool_coordinates['Y'])
+        r = self.sweepRadius
+        feed = self.sweepFeed
+        self.printer.gCodeBatch([
+            'G90',
+            'G1 X{0:-1.3f} Y{1:-1.3f} F{2}'.format(center[0] + r, center[1], feed),
+            'G2 X{0:-1.3f} Y{1:-1.3f} I{2:-1.3f} J0 F{3}'.format(center[0] + r, center[1], -r, feed),
+            'G1 X{0:-1.3f} Y{1:-1.3f} F{2}'.format(center[0] + r/2, center[1], feed),
+            'G3 X{0:-1.3f} Y{1:-1.3f} I{2:-1.3f} J0 F{3}'.format(center[0] + r/2, center[1], -r/2, feed/2),
+            'G1 X{0:-1.3f} Y{1:-1.3f} F{2}'.format(center[0], center[1], feed)
+        ])
+        # time for the sweep at the commanded feedrates
+        duration = (2*r + 4*np.pi*r) / (feed/60)
+        positions = []
+        stopPolling = threading.Event()
+        poller = threading.Thread(target=self.pollPositions, args=(positions, stopPolling), daemon=True)
+        poller.start()
+        # keep frames evenly spread over the sweep, within the frame count and memory limits
+        maxFrames = max(1, min(self.sweepMaxFrames, int(self.sweepMemory / (camera_width*camera_height))))
+        frameInterval = duration / maxFrames
+        frames = []
+        sweepStart = time.time()
+        try:
+            while True:
+                # run commands from the GUI
+                self.processCommands()
+                if self._shutdown:
+                    return False
+                ret, frame, frame_time = self.source.read()
+                if ret:
+                    self.last_frame = frame
+                    if len(frames) < maxFrames and (len(frames) == 0 or frame_time - frames[-1][0] >= frameInterval):
+                        # detection only needs the luma, which also keeps the buffer small
+                        luma = frame.copy() if len(frame.shape) == 2 else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+                        frames.append( (frame_time, luma) )
+                    self.showFrame(frame)
+                elif self.source.finished:
+                    self.sourceEnded()
+                elapsed = time.time() - sweepStart
+                if elapsed > duration and self.printer.getStatus() in 'idle':
+                    break
+                if elapsed > 3*duration + 10:
+                    print('Sweep calibration timed out.')
+                    break
+        finally:
+            stopPolling.set()
+            poller.join()
+        coords = self.printer.getCoordsLive()
+        if coords is not None:
+            positions.append( (time.time(), coords['X'], coords['Y']) )
+        self.message_update.emit('Calibrating rotation.. (detecting ' + str(len(frames)) + ' frames)')
+        samples = self.detectFrames(frames)
+        if samples is None:
+            return False
+        if len(positions) < 2:
+            return False
+        # machine position at each frame exposure, for frames between the first and last position sample
+        positions = np.array(positions)
+        samples = np.array(samples).reshape(-1, 3)
+        samples = samples[(samples[:,0] >= positions[0,0]) & (samples[:,0] <= positions[-1,0])]
+        if len(samples) < self.sweepMinSamples:
+            print('Sweep calibration found ' + str(len(samples)) + ' nozzle positions, ' + str(self.sweepMinSamples) + ' are needed.')
+            return False
+        # interpolate around the sweep center: linear interpolation of X and Y would cut across the circles
+        angle = np.unwrap(np.arctan2(positions[:,2] - center[1], positions[:,1] - center[0]))
+        radius = np.hypot(positions[:,1] - center[0], positions[:,2] - center[1])
+        angle = np.interp(samples[:,0], positions[:,0], angle)
+        radius = np.interp(samples[:,0], positions[:,0], radius)
+        machineX = center[0] + radius*np.cos(angle)
+        machineY = center[1] + radius*np.sin(angle)
+        self.space_coordinates = [ (x, y) for (x, y) in zip(machineX, machineY) ]
+        self.camera_coordinates = [ (u, v) for (u, v) in samples[:,1:] ]
+        transform, residuals = self.least_square_mapping([(self.space_coordinates[i], self.normalize_coords(camera)) for i, camera in enumerate(self.camera_coordinates)])
+        # drop the few samples the model can't explain (positions interpolated across a change of direction)
+        errors = np.hypot(residuals[:,0], residuals[:,1])
+        keep = errors <= 3*np.sqrt(np.mean(errors**2))
+        self.space_coordinates = [ point for (point, kept) in zip(self.space_coordinates, keep) if kept ]
+        self.camera_coordinates = [ point for (point, kept) in zip(self.camera_coordinates, keep) if kept ]
+        transform, residuals = self.least_square_mapping([(self.space_coordinates[i], self.normalize_coords(camera)) for i, camera in enumerate(self.camera_coordinates)])
+        # millimeters per pixel from the linear part of the mapping at the image center
+        self.mpp = np.around(CameraModel.scaleAndRotation(transform, camera_width, camera_height)[0],4)
+        self.debug_update.emit('Sweep calibration used ' + str(len(self.camera_coordinates)) + ' nozzle positions from ' + str(len(frames)) + ' frames.\n')
+        print('Sweep calibration used ' + str(len(self.camera_coordinates)) + ' nozzle positions from ' + str(len(frames)) + ' frames.')
+        return True
+
+    def pollPositions(self, positions, stop):
+        # Runs in its own thread during a sweep calibration: append machine positions, timestamped
+        # half way through each request, until stop is set. At most one request every 20ms.
+        while not stop.is_set():
+            requestStart = time.time()
+            coords = self.printer.getCoordsLive()
+            if coords is not None:
+                positions.append( ((requestStart + time.time())/2, coords['X'], coords['Y']) )
+            stop.wait(max(0, requestStart + 0.02 - time.time()))
+
+    def detectFrames(self, frames):
+        # Nozzle positions (timestamp, u, v) in the frames (timestamp, frame) with exactly one detection.
+        # The nozzle only moves a few pixels between frames, so once it is found only a window around
+        # its last position is searched, which is many times cheaper than the whole frame.
+        # Returns None if the thread was shut down meanwhile.
+        samples = []
+        last = None
+        for (frame_time, frame) in frames:
+            # run commands from the GUI
+            self.processCommands()
+            if self._shutdown:
+                return None
+            keypoints = []
+            if last is not None:
+                (u, v, half) = last
+                x0 = max(0, u - half)
+                y0 = max(0, v - half)
+                keypoints, processed = self.detector.detect(frame[y0:v+half, x0:u+half])
+                keypoints = [cv2.KeyPoint(k.pt[0] + x0, k.pt[1] + y0, k.size, -1, k.response) for k in keypoints]
+            if len(keypoints) != 1:
+                keypoints, processed = self.detector.detect(frame)
+            last = None
+            if len(keypoints) == 1:
+                (u, v) = keypoints[0].pt
+                samples.append( (frame_time, u, v) )
+                # window of four nozzle radii around the nozzle
+                last = (int(u), int(v), int(max(2*keypoints[0].size, 40)))
+        # engines that learn the nozzle (template) have seen it in window coordinates
+        self.detector.forget()
+        return samples
+
     def normalize_coords(self,coords):
         xdim, ydim = camera_width, camera_height
         return (coords[0] / xdim - 0.5, coords[1] / ydim - 0.5)
 
+    def transformCacheKey(self):
+        # saved calibrations are only valid for the same printer and camera
+        return str(self.printerURL) + ' ' + str(video_src)
+
+    def loadTransformCache(self):
+        # Load the camera calibration saved for this printer and camera, if any
+        try:
+            with open(self.transform_cache_file,'r') as inputfile:
+                cache = json.load(inputfile)
+            entry = cache[self.transformCacheKey()]
+            if int(entry['camera_width']) != camera_width or int(entry['camera_height']) != camera_height:
+                # resolution changed since the calibration was saved
+                return False
+            self.cached_transform = np.array(entry['transform'])
+            if CameraModel.modelOrder(self.cached_transform) != calibration_order:
+                # saved with a different camera model
+                return False
+            self.cached_mpp = float(entry['mpp'])
+            # image positions of the calibration points, used to weigh later refinements
+            self.cached_points = [ self.normalize_coords((point[0], point[1])) for point in entry.get('residual_map', []) ]
+            return True
+        except FileNotFoundError:
+            return False
+        except Exception as tc1:
+            print('Error reading saved camera calibration: ' + str(tc1))
+            return False
+
+    def saveTransformCache(self):
+        # Save the camera calibration for later sessions
+        try:
+            try:
+                with open(self.transform_cache_file,'r') as inputfile:
+                    cache = json.load(inputfile)
+            except FileNotFoundError:
+                cache = {}
+            cache[self.transformCacheKey()] = {
+                'transform': np.array(self.transform_matrix).tolist(),
+                'mpp': float(self.mpp),
+                # fit error of each calibration point: image position and real space residual
+                'residual_map': [ [float(u), float(v), float(r[0]), float(r[1])] for ((u, v), r) in zip(self.camera_coordinates, self.transform_residuals) ],
+                'camera_width': camera_width,
+                'camera_height': camera_height,
+                'cp_coords': self.cp_coordinates,
+                'date': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            }
+            with open(self.transform_cache_file,'w') as outputfile:
+                json.dump(cache, outputfile, indent=2)
+        except Exception as tc1:
+            print('Error saving camera calibration: ' + str(tc1))
+
+    def alignmentOrder(self, cycles, numTools):
+        # List of (cycle, tool) alignments in the order set by alignment_schedule:
+        # "cycle" aligns every tool once per cycle (a tool change for every alignment, measures pickup repeatability),
+        # "tool" runs all cycles of T0, then T1.. (fewest tool changes, measures vision and motion repeatability),
+        # "random" shuffles all alignments.
+        if alignment_schedule == 'tool':
+            order = [ (rep, tool) for tool in range(numTools) for rep in range(cycles) ]
+        else:
+            order = [ (rep, tool) for rep in range(cycles) for tool in range(numTools) ]
+            if alignment_schedule == 'random':
+                random.shuffle(order)
+        return order
+
+    def scheduleName(self):
+        # alignment order recorded with every result
+        if alignment_reseat:
+            return alignment_schedule + '+reseat'
+        return alignment_schedule
+
+    def loadOffsetHistory(self):
+        # Tool offsets measured on this printer by earlier runs: {tool: [{'X', 'Y', 'date'}, ..]}
+        try:
+            with open(self.offset_history_file,'r') as inputfile:
+                history = json.load(inputfile)
+            return history.get(str(self.printerURL), {})
+        except FileNotFoundError:
+            return {}
+        except Exception as oh1:
+            print('Error reading tool offset history: ' + str(oh1))
+            return {}
+
+    def saveOffsetResult(self, tool, result):
+        # Add a measured tool offset to the history of this printer
+        try:
+            try:
+                with open(self.offset_history_file,'r') as inputfile:
+                    history = json.load(inputfile)
+            except FileNotFoundError:
+                history = {}
+            printer = history.setdefault(str(self.printerURL), {})
+            entries = printer.setdefault(str(tool), [])
+            entries.append({
+                'X': float(result['X']),
+                'Y': float(result['Y']),
+                'date': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            })
+            printer[str(tool)] = entries[-self.offset_history_length:]
+            with open(self.offset_history_file,'w') as outputfile:
+                json.dump(history, outputfile, indent=2)
+        except Exception as oh1:
+            print('Error saving tool offset history: ' + str(oh1))
+
+    def predictedOffset(self, tool):
+        # Median of the most recent offsets measured for a tool, or None if there are none
+        entries = self.loadOffsetHistory().get(str(tool), [])[-self.offset_prediction_count:]
+        if len(entries) == 0:
+            return None
+        return (float(np.median([entry['X'] for entry in entries])), float(np.median([entry['Y'] for entry in entries])))
+
+    def startPosition(self, tool):
+        # Position where the tool's nozzle is expected at the camera center: CP + current G10 offset - predicted offset
+        start = {'X': self.cp_coords['X'], 'Y': self.cp_coords['Y']}
+        if not predict_start or self.verify:
+            # a verify run checks the current G10 offsets, so tools start at the CP
+            return start
+        predicted = self.predictedOffset(tool)
+        if predicted is None:
+            return start
+        try:
+            toolOffsets = self.printer.getG10ToolOffset(tool)
+            start['X'] = np.around(start['X'] + toolOffsets['X'] - predicted[0], 3)
+            start['Y'] = np.around(start['Y'] + toolOffsets['Y'] - predicted[1], 3)
+        except Exception as sp1:
+            print('Error predicting tool start position: ' + str(sp1))
+        return start
+
+    def pixelDisplacement(self, xy, offsets):
+        # Image displacement (pixels) caused by a carriage move (mm) with the nozzle seen at xy
+        cx, cy = self.normalize_coords(xy)
+        # derivatives of the camera model terms with respect to x and y
+        (dvx, dvy) = CameraModel.gradients(cx, cy, CameraModel.modelOrder(self.transform_matrix))
+        jacobian = np.vstack([self.transform_matrix.T @ dvx, self.transform_matrix.T @ dvy]).T
+        try:
+            delta = np.linalg.solve(jacobian, np.array([offsets[0], offsets[1]], dtype=float))
+        except np.linalg.LinAlgError:
+            return (0.0, 0.0)
+        return (delta[0]*camera_width, delta[1]*camera_height)
+
     def least_square_mapping(self,calibration_points):
-        # Compute a 2x2 map from displacement vectors in screen space to real space.
+        # Fit the camera model from normalized screen space to real space (see CameraModel.py).
+        # Returns the transform and the residual of each point in real space.
         n = len(calibration_points)
         real_coords, pixel_coords = np.empty((n,2)),np.empty((n,2))
         for i, (r,p) in enumerate(calibration_points):
             real_coords[i] = r
             pixel_coords[i] = p
-        x,y = pixel_coords[:,0],pixel_coords[:,1]
-        A = np.vstack([x**2,y**2,x * y, x,y,np.ones(n)]).T
-        transform = np.linalg.lstsq(A, real_coords, rcond = None)
-        return transform[0], transform[1].mean()
+        return CameraModel.fit(pixel_coords, real_coords, calibration_order)
+
+    def useTransform(self, transform, points=None):
+        # Start using a camera calibration: precompute the pixel to machine lookup table.
+        # points are the normalized image positions it was calibrated with.
+        self.transform_matrix = np.array(transform)
+        self.lookup = CameraModel.PixelLookup(self.transform_matrix, camera_width, camera_height)
+        self.plant_response = None
+        if refine_transform:
+            self.refiner = CameraModel.RecursiveRefiner(self.transform_matrix, camera_width, camera_height, points)
+        else:
+            self.refiner = None
+        self.calibrated_mpp = self.mpp
+        # errors (pixels) of the moves predicted by the transform, and whether it no longer fits
+        self.move_errors = []
+        self.model_degraded = False
+
+    def refineTransform(self):
+        # Fold the last alignment move into the camera transform, and check it still fits
+        if self.refiner is None or self.displacement is None:
+            return
+        if np.hypot(self.xy[0] - self.oldxy[0], self.xy[1] - self.oldxy[1]) < 2.0:
+            # too small to measure reliably
+            return
+        p0 = self.normalize_coords(self.oldxy)
+        p1 = self.normalize_coords(self.xy)
+        error = np.hypot(*(self.last_move - self.refiner.predict(p0, p1))) / self.mpp
+        self.move_errors.append(error)
+        # moves that don't fit at all (e.g. the nozzle was lost) are not used
+        if error <= 5*model_tolerance:
+            self.refiner.update(p0, p1, self.last_move)
+            self.transform_matrix = self.refiner.transform
+            # the lookup table no longer matches: evaluate the refined model directly (see pixelOffset)
+            self.lookup = None
+            (scale, rotation) = self.refiner.drift()
+            self.mpp = np.around(self.calibrated_mpp*(1 + scale),4)
+        else:
+            (scale, rotation) = self.refiner.drift()
+        recent = self.move_errors[-5:]
+        if not self.model_degraded and ((len(recent) >= 3 and np.median(recent) > model_tolerance) or abs(scale) > 0.02 or abs(rotation) > 0.5):
+            self.model_degraded = True
+            warning = 'Camera calibration has drifted (scale ' + str(np.around(scale*100,2)) + '%, rotation ' + str(np.around(rotation,2)) + ' degrees, move error ' + str(np.around(np.median(recent),2)) + ' pixels), please recalibrate the camera.'
+            self.debug_update.emit('\n' + warning + '\n')
+            print('Warning: ' + warning)
+            self.message_update.emit(warning)
+
+    def pixelOffset(self, u, v):
+        # Machine offset from the image center to pixel (u, v): from the lookup table of the calibration,
+        # or from the model once refineTransform has changed it. Rebuilding the table after every
+        # alignment move would cost a full frame evaluation per move.
+        if self.lookup is None:
+            return CameraModel.pixelOffset(self.transform_matrix, camera_width, camera_height, u, v)
+        return self.lookup.offset(u, v)
 
     def getDistance(self, x1, y1, x0, y0 ):
         x1_float = float(x1)
@@ -1061,56 +1570,153 @@ class CalibrateNozzles(QThread):
         return np.around(retVal,3)
 
     def stop(self):
+        # Called from the GUI thread: ask this thread to shut down (see shutdown) and wait for it
+        self.sendCommand('shutdown')
+        if not self.wait(10000):
+            print('Video thread did not stop in time.')
+
+    def shutdown(self):
+        # leave the current alignment or detection loop, run() then releases the camera and workers
+        self._shutdown = True
         self._running = False
         self.detection_on = False
-        try:
-            tempCoords = self.printer.getCoords()
-            if self.printer.isIdle():
-                self.parent().printer.gCode('T-1')
-                self.parent().printer.gCode('G1 X' + str(tempCoords['X']) + ' Y' + str(tempCoords['Y']))
-                while self.parent().printer.getStatus() not in 'idle':
-                    time.sleep(1)
-        except: None
-        self.cap.release()
-        self.exit()
+        self.alignment = False
 
     def createDetector(self):
-        # Setup SimpleBlobDetector parameters.
-        params = cv2.SimpleBlobDetector_Params()
-        # Thresholds
-        params.minThreshold = self.detect_th1
-        params.maxThreshold = self.detect_th2
-        params.thresholdStep = self.detect_thstep
-
-        # Area
-        params.filterByArea = True         # Filter by Area.
-        params.minArea = self.detect_minArea
-
-        # Circularity
-        params.filterByCircularity = True  # Filter by Circularity
-        params.minCircularity = self.detect_minCircularity
-        params.maxCircularity= 1
-
-        # Convexity
-        params.filterByConvexity = True    # Filter by Convexity
-        params.minConvexity = 0.3
-        params.maxConvexity = 1
-
-        # Inertia
-        params.filterByInertia = True      # Filter by Inertia
-        params.minInertiaRatio = 0.3
-
-        # create detector
-        self.detector = cv2.SimpleBlobDetector_create(params)
-
-    def adjust_gamma(self, image, gamma=1.2):
-        # build a lookup table mapping the pixel values [0, 255] to
-        # their adjusted gamma values
-        invGamma = 1.0 / gamma
-        table = np.array([((i / 255.0) ** invGamma) * 255
-            for i in np.arange(0, 256)]).astype('uint8')
-        # apply gamma correction using the lookup table
-        return cv2.LUT(image, table)
+        # Setup nozzle detection engine (see NozzleDetector.py)
+        self.detector = NozzleDetector.getDetector(
+            detection_engine,
+            th1=self.detect_th1,
+            th2=self.detect_th2,
+            thstep=self.detect_thstep,
+            minArea=self.detect_minArea,
+            minCircularity=self.detect_minCircularity,
+            scale=detection_scale,
+            roi=detection_roi
+        )
+        if self.pool is not None:
+            self.pool.setCircularity(self.detect_minCircularity)
+
+    def forgetNozzle(self):
+        # Detection engines that learn the nozzle (e.g. the template engine) start over, in the workers too
+        self.detector.forget()
+        if self.pool is not None:
+            self.pool.forget()
+
+    def startPool(self):
+        # Start detection worker processes if enabled in settings.json
+        self.stopPool()
+        if detection_workers < 1:
+            return
+        try:
+            self.pool = DetectionPool.DetectionPool(
+                workers=detection_workers,
+                width=self.source.width,
+                height=self.source.height,
+                engine=detection_engine,
+                th1=self.detect_th1,
+                th2=self.detect_th2,
+                thstep=self.detect_thstep,
+                minArea=self.detect_minArea,
+                minCircularity=self.detect_minCircularity,
+                scale=detection_scale,
+                roi=detection_roi
+            )
+            print('Started ' + str(detection_workers) + ' detection worker(s).')
+        except Exception as p1:
+            print('Error starting detection workers, using single process detection.')
+            print(p1)
+            self.pool = None
+
+    def stopPool(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+    def waitForMove(self, expectMotion=True, useImage=True):
+        # Wait for the machine to finish moving, showing frames meanwhile.
+        # Alignment only uses frames exposed after this point.
+        if self.averager is not None:
+            self.averager.reset()
+        if useImage and settle_mode == 'image':
+            # watch the image settle. The controller is only asked to confirm it is idle
+            # if the move could not be seen in the image.
+            self.settle.start(self.last_frame, expectMotion)
+            while True:
+                # run commands from the GUI
+                self.processCommands()
+                if self._shutdown:
+                    return
+                self.ret, self.cv_img, self.frame_time = self.source.read()
+                if not self.ret:
+                    if self.source.finished:
+                        self.sourceEnded()
+                    continue
+                self.showFrame(self.cv_img)
+                if self.settle.update(self.cv_img):
+                    if self.settle.moved or self.printer.getStatus() in 'idle':
+                        break
+                    self.settle.restart()
+            self.settle_time = self.frame_time
+            return
+        while self.printer.getStatus() not in 'idle':
+            # run commands from the GUI
+            self.processCommands()
+            if self._shutdown:
+                return
+            self.ret, self.cv_img, self.frame_time = self.source.read()
+            if self.ret:
+                self.showFrame(self.cv_img)
+        self.settle_time = time.time()
+
+    def detectPooled(self, after=0):
+        # Keep the detection workers busy with new frames, then return the next finished one
+        while self.pool.available() and self.pool.inFlight() <= self.pool.workers:
+            ret, frame, frame_time = self.source.read()
+            if not ret:
+                break
+            self.last_frame = frame
+            if self.alignment and frame_time < after:
+                # frame was exposed before the last move finished
+                continue
+            if self.alignment and self.averager is not None:
+                # submit once enough frames of this position have been averaged
+                frame = self.averager.add(frame)
+                if not self.averager.ready():
+                    continue
+                # next average from new frames only: overlapping windows aren't independent detections
+                self.averager.reset()
+            if frame.shape[:2] != (self.pool.height, self.pool.width):
+                # source changed resolution: restart the workers for the new frame size
+                self.startPool()
+                if self.pool is None:
+                    return (False, None, None, None, None)
+            toolCoordinates = None
+            if self.alignment:
+                try:
+                    # capture tool location in machine space before processing
+                    toolCoordinates = self.printer.getCoords()
+                except Exception as c1:
+                    toolCoordinates = None
+            self.pool.submit(frame, (frame_time, toolCoordinates), xray=self.xray)
+        result = self.pool.result()
+        if result is None:
+            return (False, None, None, None, None)
+        (frame_time, toolCoordinates) = result.meta
+        if self.alignment and frame_time < after:
+            # frame was submitted before the last move finished
+            return (False, None, None, None, None)
+        self.frame_time = frame_time
+        # scale the preview back up to the frame size for display
+        frame = cv2.resize(result.preview, (self.pool.width, self.pool.height), interpolation=cv2.INTER_LINEAR)
+        target = [int(np.around(self.pool.width/2)),int(np.around(self.pool.height/2))]
+        return (True, result.keypoints, frame, toolCoordinates, target)
+
+    def sourceEnded(self):
+        # A file or directory source has no more frames: stop detection and report it
+        # (the alignment and detection loops in run() emit the error) instead of polling it.
+        self.detection_on = False
+        raise Exception('Video source ended.')
 
     def putText(self, frame,text,color=(0, 0, 255),offsetx=0,offsety=0,stroke=1):  # Offsets are in character box size in pixels. 
         if (text == 'timestamp'): text = datetime.datetime.now().strftime('%m-%d-%Y %H:%M:%S')
@@ -1131,41 +1737,158 @@ class CalibrateNozzles(QThread):
             cv2.FONT_HERSHEY_SIMPLEX, fontScale, color, stroke)
         return(frame)
 
+    def openSource(self, src):
+        # Create the frame source (camera, network stream, file, directory or synthetic) and show its first frame
+        global camera_width, camera_height
+        self.source = FrameSource.createFrameSource(src, camera_width, camera_height, gray=capture_gray)
+        # keep the rest of the program in sync with the resolution the source negotiated
+        camera_width, camera_height = self.source.width, self.source.height
+        self.brightness_default = self.source.get(cv2.CAP_PROP_BRIGHTNESS)
+        self.contrast_default = self.source.get(cv2.CAP_PROP_CONTRAST)
+        self.saturation_default = self.source.get(cv2.CAP_PROP_SATURATION)
+        self.hue_default = self.source.get(cv2.CAP_PROP_HUE)
+        # the GUI shows the source description in the camera settings
+        self.source_update.emit(self.source.describe())
+
+        self.ret, self.cv_img, self.frame_time = self.source.read()
+        if self.ret:
+            self.showFrame(self.cv_img)
+
+    def crosshairOverlay(self, width, height):
+        # Alignment crosshair drawn on a blank image, and the mask of the pixels it covers.
+        # Drawn once per resolution, with the bounding box (x, y, w, h) of the mask.
+        if self.crosshair_cache is not None and self.crosshair_cache[0] == (width, height):
+            return self.crosshair_cache[1]
+        center = ( int(width/2), int(height/2) )
+        overlay = np.zeros((height, width, 3), dtype=np.uint8)
+        mask = np.zeros((height, width), dtype=np.uint8)
+        cv2.circle(overlay, center, 6, (0,255,0), int( width/1.75 ))
+        cv2.circle(mask, center, 6, 255, int( width/1.75 ))
+        cv2.circle(overlay, center, 5, (0,0,255), 2)
+        cv2.circle(mask, center, 5, 255, 2)
+        for i in range(0,8):
+            cv2.circle(overlay, center, 25*i, (0,0,0), 1)
+            cv2.circle(mask, center, 25*i, 255, 1)
+        cv2.line(overlay, (center[0],center[1]-int( width/3 )), (center[0],center[1]+int( width/3 )), (128, 128, 128), 1)
+        cv2.line(mask, (center[0],center[1]-int( width/3 )), (center[0],center[1]+int( width/3 )), 255, 1)
+        cv2.line(overlay, (center[0]-int( width/3 ),center[1]), (center[0]+int( width/3 ),center[1]), (128, 128, 128), 1)
+        cv2.line(mask, (center[0]-int( width/3 ),center[1]), (center[0]+int( width/3 ),center[1]), 255, 1)
+        self.crosshair_cache = ((width, height), (overlay, mask, cv2.boundingRect(mask)))
+        return self.crosshair_cache[1]
+
+    def showFrame(self, cv_img):
+        # Send a frame to the GUI preview, at most preview_fps frames per second. The overlay,
+        # scaling and color conversion are done here so the GUI thread only draws the image.
+        now = time.time()
+        if preview_fps > 0 and now - self.preview_time < 1.0/preview_fps:
+            return
+        self.preview_time = now
+        if self.crosshair:
+            # blend the crosshair into the part of the image it covers
+            if len(cv_img.shape) < 3:
+                cv_img = cv2.cvtColor(cv_img, cv2.COLOR_GRAY2BGR)
+            else:
+                cv_img = cv_img.copy()
+            (overlay, mask, (x, y, w, h)) = self.crosshairOverlay(cv_img.shape[1], cv_img.shape[0])
+            roi = cv_img[y:y+h, x:x+w]
+            blended = cv2.addWeighted(overlay[y:y+h, x:x+w], 0.5, roi, 0.5, 0)
+            cv2.copyTo(blended, mask[y:y+h, x:x+w], roi)
+        # scale to the preview size before converting, which is much cheaper at full resolution
+        scale = min(display_width/cv_img.shape[1], display_height/cv_img.shape[0])
+        if scale < 1:
+            cv_img = cv2.resize(cv_img, (int(cv_img.shape[1]*scale), int(cv_img.shape[0]*scale)), interpolation=cv2.INTER_AREA)
+        elif scale > 1:
+            cv_img = cv2.resize(cv_img, (int(cv_img.shape[1]*scale), int(cv_img.shape[0]*scale)), interpolation=cv2.INTER_LINEAR)
+        if len(cv_img.shape) < 3:
+            rgb_image = cv2.cvtColor(cv_img, cv2.COLOR_GRAY2RGB)
+        else:
+            rgb_image = cv2.cvtColor(cv_img, cv2.COLOR_BGR2RGB)
+        h, w, ch = rgb_image.shape
+        bytes_per_line = ch * w
+        # copy so the image owns its pixels when it reaches the GUI thread
+        qt_img = QImage(rgb_image.data, w, h, bytes_per_line, QImage.Format_RGB888).copy()
+        self.change_pixmap_signal.emit(qt_img)
+
+    def sendCommand(self, command, *args, **kwargs):
+        # Called from the GUI thread: queue a call to one of this thread's methods (e.g. 'setProperty'),
+        # so the camera and detector are only used from this thread.
+        self.commands.put((command, args, kwargs))
+
+    def processCommands(self):
+        # Run the commands queued by sendCommand
+        while True:
+            try:
+                (command, args, kwargs) = self.commands.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                getattr(self, command)(*args, **kwargs)
+            except Exception as c1:
+                print('Error running ' + str(command) + ': ' + str(c1))
+
+    def setPrinter(self, printer, printerURL=None, numTools=0):
+        self.printer = printer
+        self.printerURL = printerURL
+        self.numTools = numTools
+        # synthetic camera follows the simulated machine
+        if printer is not None and isinstance(self.source, FrameSource.SyntheticSource):
+            self.source.attachPrinter(printer)
+
+    def setCrosshair(self, crosshair):
+        # controlled point crosshair overlay on the preview (see showFrame)
+        self.crosshair = crosshair
+
+    def setDetection(self, detection):
+        # detection mode checkbox
+        self.display_crosshair = detection
+        self.detection_on = detection
+
+    def startAlignment(self, cpCoords, cycles=1, verify=False):
+        # align all tools at the controlled point cpCoords, see run()
+        self.cp_coords = dict(cpCoords)
+        self.cycles = cycles
+        self.verify = verify
+        self.display_crosshair = True
+        self.detection_on = True
+        self.xray = False
+        self.loose = False
+        self.alignment = True
+
+    def stopAlignment(self):
+        self.alignment = False
+
+    def stopDetection(self):
+        # back to the plain video feed
+        self.detection_on = False
+        self.display_crosshair = False
+        self.loose = False
+        self.xray = False
+        self.alignment = False
+
     def changeVideoSrc(self, newSrc=-1):
-        self.cap.release()
+        global video_src
+        poolRunning = self.pool is not None
+        self.stopPool()
+        self.source.release()
         video_src = newSrc
         # Start Video feed
-        self.cap.open(video_src)
-        self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, camera_width)
-        self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, camera_height)
-        self.cap.set(cv2.CAP_PROP_BUFFERSIZE,1)
-        #self.cap.set(cv2.CAP_PROP_FPS,25)
-        self.brightness_default = self.cap.get(cv2.CAP_PROP_BRIGHTNESS)
-        self.contrast_default = self.cap.get(cv2.CAP_PROP_CONTRAST)
-        self.saturation_default = self.cap.get(cv2.CAP_PROP_SATURATION)
-        self.hue_default = self.cap.get(cv2.CAP_PROP_HUE)
-
-        self.ret, self.cv_img = self.cap.read()
-        if self.ret:
-            local_img = self.cv_img
-            self.change_pixmap_signal.emit(local_img)
-        else:
-            self.cap.open(video_src)
-            self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, camera_width)
-            self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, camera_height)
-            self.cap.set(cv2.CAP_PROP_BUFFERSIZE,1)
-            #self.cap.set(cv2.CAP_PROP_FPS,25)
-            self.ret, self.cv_img = self.cap.read()
-            local_img = self.cv_img
-            self.change_pixmap_signal.emit(local_img)
+        self.openSource(video_src)
+        if poolRunning:
+            self.startPool()
 
 class App(QMainWindow):
     cp_coords = {}
     numTools = 0
     current_frame = np.ndarray
+    # draw the alignment crosshair on the video preview
+    crosshair = False
     mutex = QMutex()
     debugString = ''
     calibrationResults = []
+    # description of the video thread's frame source, see updateCameraDescription
+    camera_description = ''
+    # index in calibrationResults of the first result of the current alignment run
+    runStart = 0
 
     def __init__(self, parent=None):
         super().__init__()
@@ -1333,6 +2056,12 @@ class App(QMainWindow):
         #self.calibration_button.setStyleSheet(style_disabled)
         self.calibration_button.setDisabled(True)
         self.calibration_button.setFixedWidth(170)
+
+        self.verify_button = QPushButton('Verify Offsets')
+        self.verify_button.setToolTip('Check the current tool offsets and only align tools that have moved.\nMAKE SURE YOUR CARRIAGE IS CLEAR TO MOVE ABOUT WITHOUT COLLISIONS!')
+        self.verify_button.clicked.connect(self.runVerification)
+        self.verify_button.setDisabled(True)
+        self.verify_button.setFixedWidth(170)
         # Jog Panel
         self.jogpanel_button = QPushButton('Jog Panel')
         self.jogpanel_button.setToolTip('Open a control panel to move carriage.')
@@ -1426,6 +2155,7 @@ class App(QMainWindow):
         grid.addWidget(self.calibration_button,7,2,1,1)
         grid.addWidget(self.repeat_label,7,3,1,1)
         grid.addWidget(self.repeatSpinBox,7,4,1,1)
+        grid.addWidget(self.verify_button,7,5,1,1)
         # set the grid layout as the widgets layout
         self.centralWidget.setLayout(grid)
         # start video feed
@@ -1434,9 +2164,9 @@ class App(QMainWindow):
         self.crosshair = False
 
     def toggle_detect(self):
-        self.video_thread.display_crosshair = not self.video_thread.display_crosshair
-        self.video_thread.detection_on = not self.video_thread.detection_on
-        if self.video_thread.detection_on:
+        detection = self.detect_box.isChecked()
+        self.video_thread.sendCommand('setDetection', detection)
+        if detection:
             self.xray_box.setDisabled(False)
             self.xray_box.setVisible(True)
             self.loose_box.setDisabled(False)
@@ -1456,7 +2186,10 @@ class App(QMainWindow):
         u = urlparse(inputString)
         scheme = u[0]
         netlocation = u[1]
-        if len(scheme) < 4 or scheme.lower() not in ['http']:
+        if scheme.lower() == 'sim':
+            # simulated printer (see DuetSimulator.py)
+            _printerURL = 'sim://' + (netlocation if len(netlocation) > 0 else 'localhost')
+        elif len(scheme) < 4 or scheme.lower() not in ['http']:
             _errCode = 1
             _errMsg = 'Invalid scheme. Please only use http connections.'
         elif len(netlocation) < 1:
@@ -1470,7 +2203,53 @@ class App(QMainWindow):
         return( _errCode, _errMsg, _printerURL )
 
     def loadUserParameters(self):
-        global camera_width, camera_height, video_src
+        global camera_width, camera_height, video_src, detection_workers, settle_mode, calibration_mode, alignment_mode, alignment_tolerance, alignment_gain, alignment_max_moves, calibration_order, calibration_grid, refine_transform, model_tolerance, predict_start, verify_tolerance, alignment_schedule, alignment_reseat, preview_fps, capture_gray, detection_scale, detection_roi, denoise_frames, denoise_mode, quality_acceptance, detection_engine
+        # number of detection worker processes, 0 runs detection in the video thread
+        detection_workers = 0
+        # how the end of a move is detected: "image" (camera, confirmed by the controller) or "status" (controller polling)
+        settle_mode = 'image'
+        # camera calibration: "steps" (stop and detect at 10 points) or "sweep" (detect while moving around circles)
+        calibration_mode = 'steps'
+        # camera model: 2 (quadratic) or 3 (cubic, follows lens distortion further from the center; uses the grid)
+        calibration_order = 2
+        # step calibration points: "circle" (10 points 0.5mm from the center) or "grid" (adds a 5x5 grid across the image)
+        calibration_grid = 'circle'
+        # nozzle alignment: "iterative" (partial moves until the nozzle is centered), "oneshot" (one full move, then verify)
+        # or "adaptive" (gain adjusted to the measured response of each move)
+        alignment_mode = 'iterative'
+        # largest distance (microns) from the camera center accepted by one-shot and adaptive alignment
+        alignment_tolerance = 5
+        # fraction of the measured offset moved per iterative alignment step (initial value for adaptive alignment)
+        alignment_gain = 0.55
+        # alignment moves per tool before giving up and using the last position
+        alignment_max_moves = 30
+        # refine the camera calibration from alignment moves, and warn when moves are off by more than model_tolerance pixels
+        refine_transform = True
+        model_tolerance = 1.5
+        # start each tool where earlier results predict its nozzle will be centered (see offset_history.json)
+        predict_start = True
+        # largest deviation (microns) from the current G10 offset accepted without aligning the tool by a verify run
+        verify_tolerance = 20
+        # order of repeated alignments: "cycle" (all tools each cycle), "tool" (all cycles of each tool) or "random"
+        alignment_schedule = 'cycle'
+        # unload and reload a tool between consecutive alignments of the same tool
+        alignment_reseat = False
+        # most video preview frames shown per second, other frames are only used for detection
+        preview_fps = 15
+        # capture grayscale frames (the Y plane of YUYV cameras), detection only uses luma
+        capture_gray = False
+        # detection resolution relative to the capture resolution (0.5 bins 2x2 pixels), and the central
+        # fraction of the image searched for the nozzle first (1 = whole image)
+        detection_scale = 1.0
+        detection_roi = 1.0
+        # during alignment, detect once on the mean or median of this many frames per position (0 = off)
+        denoise_frames = 0
+        denoise_mode = 'mean'
+        # trust detections by their quality score: clean images settle after fewer detections.
+        # Off by default, so a position is always settled from at least two detections unless enabled.
+        quality_acceptance = False
+        # nozzle detection engine, see NozzleDetector.detectors ('blob', 'hough' or 'template')
+        detection_engine = 'blob'
         try:
             with open('settings.json','r') as inputfile:
                 options = json.load(inputfile)
@@ -1479,6 +2258,32 @@ class App(QMainWindow):
             camera_width = int( camera_settings['display_width'] )
             video_src = camera_settings['video_src']
             if len(str(video_src)) == 1: video_src = int(video_src)
+            detection_workers = int( camera_settings.get('detection_workers', 0) )
+            settle_mode = camera_settings.get('settle_mode', 'image')
+            calibration_mode = camera_settings.get('calibration_mode', 'steps')
+            calibration_order = int( camera_settings.get('calibration_order', 2) )
+            calibration_grid = camera_settings.get('calibration_grid', 'circle')
+            refine_transform = bool( camera_settings.get('refine_transform', True) )
+            model_tolerance = float( camera_settings.get('model_tolerance', 1.5) )
+            predict_start = bool( camera_settings.get('predict_start', True) )
+            verify_tolerance = float( camera_settings.get('verify_tolerance', 20) )
+            alignment_schedule = camera_settings.get('alignment_schedule', 'cycle')
+            alignment_reseat = bool( camera_settings.get('alignment_reseat', False) )
+            preview_fps = float( camera_settings.get('preview_fps', 15) )
+            capture_gray = bool( camera_settings.get('capture_gray', False) )
+            detection_scale = min(1.0, max(0.1, float( camera_settings.get('detection_scale', 1.0) )))
+            detection_roi = min(1.0, max(0.1, float( camera_settings.get('detection_roi', 1.0) )))
+            denoise_frames = int( camera_settings.get('denoise_frames', 0) )
+            denoise_mode = camera_settings.get('denoise_mode', 'mean')
+            quality_acceptance = bool( camera_settings.get('quality_acceptance', False) )
+            detection_engine = camera_settings.get('detection_engine', 'blob')
+            if detection_engine not in NozzleDetector.detectors:
+                print('Unknown detection engine "' + str(detection_engine) + '", using "blob". Available engines: ' + ', '.join(NozzleDetector.detectors.keys()))
+                detection_engine = 'blob'
+            alignment_mode = camera_settings.get('alignment_mode', 'iterative')
+            alignment_tolerance = float( camera_settings.get('alignment_tolerance', 5) )
+            alignment_gain = float( camera_settings.get('alignment_gain', 0.55) )
+            alignment_max_moves = int( camera_settings.get('alignment_max_moves', 30) )
             printer_settings = options['printer'][0]
             tempURL = printer_settings['address']
             ( _errCode, _errMsg, self.printerURL ) = self.cleanPrinterURL(tempURL)
@@ -1512,7 +2317,7 @@ class App(QMainWindow):
                 print(e1)
 
     def saveUserParameters(self, cameraSrc=-2):
-        global camera_width, camera_height, video_src
+        global camera_width, camera_height, video_src, detection_workers, settle_mode, calibration_mode, alignment_mode, alignment_tolerance, alignment_gain, alignment_max_moves, calibration_order, calibration_grid, refine_transform, model_tolerance, predict_start, verify_tolerance, alignment_schedule, alignment_reseat, preview_fps, capture_gray, detection_scale, detection_roi, denoise_frames, denoise_mode, quality_acceptance, detection_engine
         cameraSrc = int(cameraSrc)
         try:
             if cameraSrc > -2:
@@ -1522,7 +2327,30 @@ class App(QMainWindow):
             options['camera'].append( {
                 'video_src': video_src,
                 'display_width': camera_width,
-                'display_height': camera_height
+                'display_height': camera_height,
+                'detection_workers': detection_workers,
+                'settle_mode': settle_mode,
+                'calibration_mode': calibration_mode,
+                'calibration_order': calibration_order,
+                'calibration_grid': calibration_grid,
+                'refine_transform': refine_transform,
+                'model_tolerance': model_tolerance,
+                'predict_start': predict_start,
+                'verify_tolerance': verify_tolerance,
+                'alignment_schedule': alignment_schedule,
+                'alignment_reseat': alignment_reseat,
+                'preview_fps': preview_fps,
+                'capture_gray': capture_gray,
+                'detection_scale': detection_scale,
+                'detection_roi': detection_roi,
+                'denoise_frames': denoise_frames,
+                'denoise_mode': denoise_mode,
+                'quality_acceptance': quality_acceptance,
+                'detection_engine': detection_engine,
+                'alignment_mode': alignment_mode,
+                'alignment_tolerance': alignment_tolerance,
+                'alignment_gain': alignment_gain,
+                'alignment_max_moves': alignment_max_moves
             } )
             options['printer'] = []
             options['printer'].append( {
@@ -1535,7 +2363,7 @@ class App(QMainWindow):
             print('Error saving user settings file.')
             print(e1)
         if int(video_src) != cameraSrc:
-            self.video_thread.changeVideoSrc(newSrc=cameraSrc)
+            self.video_thread.sendCommand('changeVideoSrc', newSrc=cameraSrc)
         self.updateStatusbar('Current profile saved to settings.json')
 
     def _createMenuBar(self):
@@ -1610,6 +2438,9 @@ class App(QMainWindow):
         self.video_thread.change_pixmap_signal.connect(self.update_image)
         self.video_thread.calibration_complete.connect(self.applyCalibration)
         self.video_thread.result_update.connect(self.addCalibrationResult)
+        self.video_thread.debug_update.connect(self.appendDebug)
+        self.video_thread.offset_update.connect(self.updateOffset)
+        self.video_thread.source_update.connect(self.updateCameraDescription)
 
         # start the thread
         self.video_thread.start()
@@ -1630,6 +2461,8 @@ class App(QMainWindow):
                 self.printer.gCode('T-1')
                 self.printer.gCode('G1 X' + str(tempCoords['X']) + ' Y' + str(tempCoords['Y']))
         except Exception as ce1: None # no printer connected usually.
+        # stop the video thread, which releases the camera and the detection workers
+        self.stopVideo()
         print()
         print('Thank you for using TAMV!')
         print('Check out www.jubilee3d.com')
@@ -1642,6 +2475,7 @@ class App(QMainWindow):
         self.connection_button.setDisabled(True)
         self.disconnection_button.setDisabled(True)
         self.calibration_button.setDisabled(True)
+        self.verify_button.setDisabled(True)
         self.cp_button.setDisabled(True)
         self.jogpanel_button.setDisabled(True)
         self.offsets_box.setVisible(False)
@@ -1694,7 +2528,10 @@ class App(QMainWindow):
         self.statusBar.showMessage('Attempting to connect to: ' + self.printerURL )
         # Attempt connecting to the Duet controller
         try:
-            self.printer = DWA.DuetWebAPI(self.printerURL)
+            if self.printerURL.startswith('sim://'):
+                self.printer = DuetSimulator.SimulatedPrinter(self.printerURL)
+            else:
+                self.printer = DWA.DuetWebAPI(self.printerURL)
             if not self.printer.printerType():
                 # connection failed for some reason
                 self.updateStatusbar('Device at '+self.printerURL+' either did not respond or is not a Duet V2 or V3 printer.')
@@ -1704,7 +2541,7 @@ class App(QMainWindow):
                 # connection succeeded, update objects accordingly
                 self._connected_flag = True
                 self.num_tools = self.printer.getNumTools()
-                self.video_thread.numTools = self.num_tools
+                self.video_thread.sendCommand('setPrinter', self.printer, self.printerURL, self.num_tools)
                 # UPDATE OFFSET INFORMATION
                 self.offsets_box.setVisible(True)
                 self.offsets_table.setRowCount(self.num_tools)
@@ -1749,6 +2586,7 @@ class App(QMainWindow):
         # enable/disable buttons
         self.connection_button.setDisabled(True)
         self.calibration_button.setDisabled(True)
+        self.verify_button.setDisabled(True)
         self.disconnection_button.setDisabled(False)
         self.cp_button.setDisabled(False)
         self.jogpanel_button.setDisabled(False)
@@ -1782,20 +2620,17 @@ class App(QMainWindow):
                 self.toolButtons[int(self.sender().text()[1:])].setChecked(False)
                 if len(self.cp_coords) > 0:
                     self.printer.gCode('T-1')
-                    self.printer.gCode('G1 X' + str(self.cp_coords['X']))
-                    self.printer.gCode('G1 Y' + str(self.cp_coords['Y']))
-                    self.printer.gCode('G1 Z' + str(self.cp_coords['Z']))
+                    self.printer.moveTo(x=self.cp_coords['X'], y=self.cp_coords['Y'], z=self.cp_coords['Z'])
                 else:
                     tempCoords = self.printer.getCoords()
                     self.printer.gCode('T-1')
-                    self.printer.gCode('G1 X' + str(tempCoords['X']))
-                    self.printer.gCode('G1 Y' + str(tempCoords['Y']))
-                    self.printer.gCode('G1 Z' + str(tempCoords['Z']))
+                    self.printer.moveTo(x=tempCoords['X'], y=tempCoords['Y'], z=tempCoords['Z'])
                 # End video threads and restart default thread
-                self.video_thread.alignment = False
+                self.video_thread.sendCommand('stopAlignment')
 
                 # Update GUI for unloading carriage
                 self.calibration_button.setDisabled(False)
+                self.verify_button.setDisabled(False)
                 self.cp_button.setDisabled(False)
                 self.updateMessagebar('Ready.')
                 self.updateStatusbar('Ready.')
@@ -1812,16 +2647,12 @@ class App(QMainWindow):
                 if len(self.cp_coords) > 0:
                     self.printer.gCode('T-1')
                     self.printer.gCode(sender.text())
-                    self.printer.gCode('G1 X' + str(self.cp_coords['X']))
-                    self.printer.gCode('G1 Y' + str(self.cp_coords['Y']))
-                    self.printer.gCode('G1 Z' + str(self.cp_coords['Z']))
+                    self.printer.moveTo(x=self.cp_coords['X'], y=self.cp_coords['Y'], z=self.cp_coords['Z'])
                 else:
                     tempCoords = self.printer.getCoords()
                     self.printer.gCode('T-1')
                     self.printer.gCode(self.sender().text())
-                    self.printer.gCode('G1 X' + str(tempCoords['X']))
-                    self.printer.gCode('G1 Y' + str(tempCoords['Y']))
-                    self.printer.gCode('G1 Z' + str(tempCoords['Z']))
+                    self.printer.moveTo(x=tempCoords['X'], y=tempCoords['Y'], z=tempCoords['Z'])
                 # START DETECTION THREAD HANDLING
                 # close camera settings dialog so it doesn't crash
                 try:
@@ -1832,6 +2663,7 @@ class App(QMainWindow):
                 self.cp_button.setDisabled(True)
                 self.jogpanel_button.setDisabled(False)
                 self.calibration_button.setDisabled(True)
+                self.verify_button.setDisabled(True)
                 self.repeatSpinBox.setDisabled(True)
 
             else:
@@ -1841,6 +2673,7 @@ class App(QMainWindow):
         self.connection_button.setDisabled(False)
         self.disconnection_button.setDisabled(True)
         self.calibration_button.setDisabled(True)
+        self.verify_button.setDisabled(True)
         self.cp_button.setDisabled(True)
         self.jogpanel_button.setDisabled(True)
         self.offsets_box.setVisible(False)
@@ -1858,10 +2691,7 @@ class App(QMainWindow):
         self.loose_box.setDisabled(True)
         self.loose_box.setChecked(False)
         self.loose_box.setVisible(False)
-        self.video_thread.detection_on = False
-        self.video_thread.loose = False
-        self.video_thread.xray = False
-        self.video_thread.alignment = False
+        self.video_thread.sendCommand('stopDetection')
 
         index = self.toolBoxLayout.count()-1
         while index >= 0:
@@ -1879,7 +2709,9 @@ class App(QMainWindow):
             return
         # display crosshair on video feed at center of image
         self.crosshair = True
+        self.video_thread.sendCommand('setCrosshair', True)
         self.calibration_button.setDisabled(True)
+        self.verify_button.setDisabled(True)
 
         if len(self.cp_coords) > 0:
             self.printer.gCode('T-1')
@@ -1892,6 +2724,7 @@ class App(QMainWindow):
         else:
             self.statusBar.showMessage('CP Setup cancelled.')
         self.crosshair = False
+        self.video_thread.sendCommand('setCrosshair', False)
 
     def readyToCalibrate(self):
         self.statusBar.showMessage('Controlled Point coordinates saved.',3000)
@@ -1908,11 +2741,9 @@ class App(QMainWindow):
         self.loose_box.setDisabled(True)
         self.loose_box.setChecked(False)
         self.loose_box.setVisible(False)
-        self.video_thread.detection_on = False
-        self.video_thread.loose = False
-        self.video_thread.xray = False
-        self.video_thread.alignment = False
+        self.video_thread.sendCommand('stopDetection')
         self.calibration_button.setDisabled(False)
+        self.verify_button.setDisabled(False)
         self.cp_button.setDisabled(False)
 
         self.toolBox.setVisible(True)
@@ -1931,6 +2762,15 @@ class App(QMainWindow):
             if self.camera_dialog.isVisible():
                 self.camera_dialog.reject()
         except: None
+        # only apply this run's results: tools accepted by a verify run keep their current offsets
+        newResults = [result for result in self.calibrationResults[self.runStart:] if result.get('verified') != 'True']
+        if len(newResults) == 0:
+            self.debugString += '\nAll tools are within tolerance, offsets unchanged.\n'
+            self.statusBar.showMessage('All tools are within tolerance, offsets unchanged.')
+            print('All tools are within tolerance, offsets unchanged.')
+            self.video_thread.sendCommand('stopDetection')
+            self.analyzeResults()
+            return
         # prompt for user to apply results
         msgBox = QMessageBox(parent=self)
         msgBox.setIcon(QMessageBox.Information)
@@ -1942,14 +2782,14 @@ class App(QMainWindow):
         
         # Update debug string
         self.debugString += '\nCalibration results:\n'
-        for result in self.calibrationResults:
+        for result in newResults:
             calibrationCode = 'G10 P' + str(result['tool']) + ' X' + str(result['X']) + ' Y' + str(result['Y'])
             self.debugString += calibrationCode + '\n'
 
         # Prompt user
         returnValue = msgBox.exec()
         if msgBox.clickedButton() == yes_button:
-            for result in self.calibrationResults:
+            for result in newResults:
                 calibrationCode = 'G10 P' + str(result['tool']) + ' X' + str(result['X']) + ' Y' + str(result['Y'])
                 self.printer.gCode(calibrationCode)
                 self.printer.gCode('M500 P10') # because of Rene.
@@ -1958,9 +2798,7 @@ class App(QMainWindow):
         else:
             self.statusBar.showMessage('Temporary offsets applied. You must manually save these offsets.')
         # Clean up threads and detection
-        self.video_thread.alignment = False
-        self.video_thread.detect_on = False
-        self.video_thread.display_crosshair = False
+        self.video_thread.sendCommand('stopDetection')
         # run stats
         self.analyzeResults()
 
@@ -2129,6 +2967,24 @@ class App(QMainWindow):
             )        
         print('+-------------------------------------------------------------------------------------------------------+')
         print('Note: Repeatability cannot be better than one pixel (MPP=' + str(mpp_value) + ').')
+        # alignment moves and time used per tool (not recorded in older result files)
+        if all('moves' in line for line in self.calibrationResults):
+            print('')
+            print('Alignment moves and time per tool:')
+            print('+-----------------------------------------------+')
+            print('| T | Moves avg | Moves max | Moves min | Time  |')
+            for index in range(self.num_tools):
+                _rawCalibrationData = [line for line in self.calibrationResults if line['tool'] == str(index)]
+                moves_array = [int(line['moves']) for line in _rawCalibrationData]
+                time_array = [float(line['time']) for line in _rawCalibrationData]
+                print('| {0:1.0f} '.format(index)
+                    + '| {0:9.1f} '.format(np.average(moves_array))
+                    + '| {0:9.0f} '.format(np.max(moves_array))
+                    + '| {0:9.0f} '.format(np.min(moves_array))
+                    + '| {0:5.1f} '.format(np.average(time_array))
+                    + '|'
+                )
+            print('+-----------------------------------------------+')
 
     def parseData( self, rawData ):
         # create empty output array
@@ -2178,6 +3034,7 @@ class App(QMainWindow):
         self.connection_button.setDisabled(True)
         self.disconnection_button.setDisabled(True)
         self.calibration_button.setDisabled(True)
+        self.verify_button.setDisabled(True)
         self.cp_button.setDisabled(True)
         self.cp_button.setText('Pending..')
         self.jogpanel_button.setDisabled(True)
@@ -2194,9 +3051,7 @@ class App(QMainWindow):
         self.repaint()
         # End video threads and restart default thread
         # Clean up threads and detection
-        self.video_thread.alignment = False
-        self.video_thread.detect_on = False
-        self.video_thread.display_crosshair = False
+        self.video_thread.sendCommand('stopDetection')
         self.detect_box.setChecked(False)
         self.detect_box.setVisible(True)
 
@@ -2209,13 +3064,9 @@ class App(QMainWindow):
             _ret_error += self.printer.gCode('T-1')
             # return carriage to controlled point position
             if len(self.cp_coords) > 0:
-                _ret_error += self.printer.gCode('G1 X' + str(self.cp_coords['X']))
-                _ret_error += self.printer.gCode('G1 Y' + str(self.cp_coords['Y']))
-                _ret_error += self.printer.gCode('G1 Z' + str(self.cp_coords['Z']))
+                _ret_error += self.printer.moveTo(x=self.cp_coords['X'], y=self.cp_coords['Y'], z=self.cp_coords['Z'])
             else:
-                _ret_error += self.printer.gCode('G1 X' + str(tempCoords['X']))
-                _ret_error += self.printer.gCode('G1 Y' + str(tempCoords['Y']))
-                _ret_error += self.printer.gCode('G1 Z' + str(tempCoords['Z']))
+                _ret_error += self.printer.moveTo(x=tempCoords['X'], y=tempCoords['Y'], z=tempCoords['Z'])
         # update status with disconnection state
         if _ret_error == 0:
             self.updateStatusbar('Disconnected.')
@@ -2226,6 +3077,7 @@ class App(QMainWindow):
             self.statusBar.setStyleSheet(style_red)
         # Reinitialize printer object
         self.printer = None
+        self.video_thread.sendCommand('setPrinter', None)
         
         # Tools unloaded, reset GUI
         self.image_label.setText('Welcome to TAMV. Enter your printer address and click \"Connect..\" to start.')
@@ -2233,6 +3085,7 @@ class App(QMainWindow):
         self.connection_button.setDisabled(False)
         self.disconnection_button.setDisabled(True)
         self.calibration_button.setDisabled(True)
+        self.verify_button.setDisabled(True)
         self.cp_button.setDisabled(True)
         self.cp_button.setText('Set Controlled Point..')
         self.jogpanel_button.setDisabled(True)
@@ -2247,14 +3100,25 @@ class App(QMainWindow):
         self.resetConnectInterface()
 
     def runCalibration(self):
+        self.startAlignment(verify=False)
+
+    def runVerification(self):
+        self.startAlignment(verify=True)
+
+    def startAlignment(self, verify=False):
         # reset debugString
         self.debugString = ''
         # prompt for user to apply results
         msgBox = QMessageBox(parent=self)
         msgBox.setIcon(QMessageBox.Information)
-        msgBox.setText('Do you want to start automated tool alignment?')
-        msgBox.setWindowTitle('Start Calibration')
-        yes_button = msgBox.addButton('Start calibration..',QMessageBox.YesRole)
+        if verify:
+            msgBox.setText('Do you want to verify the tool offsets?\nTools more than ' + str(verify_tolerance) + ' microns off will be aligned.')
+            msgBox.setWindowTitle('Verify Offsets')
+            yes_button = msgBox.addButton('Start verification..',QMessageBox.YesRole)
+        else:
+            msgBox.setText('Do you want to start automated tool alignment?')
+            msgBox.setWindowTitle('Start Calibration')
+            yes_button = msgBox.addButton('Start calibration..',QMessageBox.YesRole)
         yes_button.setObjectName('active')
         yes_button.setStyleSheet(style_green)
         no_button = msgBox.addButton('Cancel',QMessageBox.NoRole)
@@ -2271,6 +3135,7 @@ class App(QMainWindow):
         self.cp_button.setDisabled(True)
         self.jogpanel_button.setDisabled(False)
         self.calibration_button.setDisabled(True)
+        self.verify_button.setDisabled(True)
         self.xray_box.setDisabled(False)
         self.xray_box.setChecked(False)
         self.xray_box.setVisible(True)
@@ -2290,18 +3155,18 @@ class App(QMainWindow):
             self.offsets_table.setItem(i,1,y_tableitem)
         # get number of repeat cycles
         self.repeatSpinBox.setDisabled(True)
-        self.cycles = self.repeatSpinBox.value()
+        if verify:
+            self.cycles = 1
+        else:
+            self.cycles = self.repeatSpinBox.value()
 
-        # create the Nozzle detection capture thread
-        self.video_thread.display_crosshair = True
-        self.video_thread.detection_on = True
-        self.video_thread.xray = False
-        self.video_thread.loose = False
-        self.video_thread.alignment = True
+        # start the alignment in the video thread, results of earlier runs are kept for the analysis
+        self.runStart = len(self.calibrationResults)
+        self.video_thread.sendCommand('startAlignment', self.cp_coords, self.cycles, verify)
 
     def toggle_xray(self):
         try:
-            self.video_thread.toggleXray()
+            self.video_thread.sendCommand('toggleXray')
         except Exception as e1:
             self.updateStatusbar('Detection thread not running.')
             print( 'Detection thread error in XRAY: ')
@@ -2309,7 +3174,7 @@ class App(QMainWindow):
 
     def toggle_loose(self):
         try:
-            self.video_thread.toggleLoose()
+            self.video_thread.sendCommand('toggleLoose')
         except Exception as e1:
             self.updateStatusbar('Detection thread not running.')
             print( 'Detection thread error in LOOSE: ')
@@ -2323,57 +3188,32 @@ class App(QMainWindow):
     def updateMessagebar(self, statusCode ):
         self.image_label.setText(statusCode)
 
-    @pyqtSlot(np.ndarray)
-    def update_image(self, cv_img):
-        #self.mutex.lock()
-        self.current_frame = cv_img
-        if self.crosshair:
-            # Draw alignment circle on image
-            alpha = 0.5
-            beta = 1-alpha
-            center = ( int(camera_width/2), int(camera_height/2) )
-            overlay = cv2.circle( 
-                cv_img.copy(), 
-                center, 
-                6, 
-                (0,255,0), 
-                int( camera_width/1.75 )
-            )
-            overlay = cv2.circle( 
-                overlay.copy(), 
-                center, 
-                5, 
-                (0,0,255), 
-                2
-            )
-            for i in range(0,8):
-                overlay = cv2.circle( 
-                overlay.copy(), 
-                center, 
-                25*i, 
-                (0,0,0), 
-                1
-            )
-            overlay = cv2.line(overlay, (center[0],center[1]-int( camera_width/3 )), (center[0],center[1]+int( camera_width/3 )), (128, 128, 128), 1)
-            overlay = cv2.line(overlay, (center[0]-int( camera_width/3 ),center[1]), (center[0]+int( camera_width/3 ),center[1]), (128, 128, 128), 1)
-            cv_img = cv2.addWeighted(overlay, beta, cv_img, alpha, 0)
-        # Updates the image_label with a new opencv image
-        qt_img = self.convert_cv_qt(cv_img)
-        self.image_label.setPixmap(qt_img)
-        #self.mutex.unlock()
-
-    def convert_cv_qt(self, cv_img):
-        # Convert from an opencv image to QPixmap
-        rgb_image = cv2.cvtColor(cv_img, cv2.COLOR_BGR2RGB)
-        h, w, ch = rgb_image.shape
-        bytes_per_line = ch * w
-        convert_to_Qt_format = QImage(rgb_image.data, w, h, bytes_per_line, QImage.Format_RGB888)
-        p = convert_to_Qt_format.scaled(display_width, display_height, Qt.KeepAspectRatio)
-        return QPixmap.fromImage(p)
+    @pyqtSlot(QImage)
+    def update_image(self, qt_img):
+        # Updates the image_label with a preview image prepared by the video thread
+        self.image_label.setPixmap(QPixmap.fromImage(qt_img))
 
     def addCalibrationResult(self, result={}):
         self.calibrationResults.append(result)
 
+    @pyqtSlot(str)
+    def appendDebug(self, text):
+        self.debugString += text
+
+    @pyqtSlot(int, str, str)
+    def updateOffset(self, tool, offset_x, offset_y):
+        # show a newly calibrated tool offset
+        x_tableitem = QTableWidgetItem(offset_x)
+        x_tableitem.setBackground(QColor(100,255,100,255))
+        y_tableitem = QTableWidgetItem(offset_y)
+        y_tableitem.setBackground(QColor(100,255,100,255))
+        self.offsets_table.setItem(tool,0,x_tableitem)
+        self.offsets_table.setItem(tool,1,y_tableitem)
+
+    @pyqtSlot(str)
+    def updateCameraDescription(self, description):
+        self.camera_description = description
+
 if __name__=='__main__':
     os.putenv("QT_LOGGING_RULES","qt5ct.debug=false")
     app = QApplication(sys.argv)
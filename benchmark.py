@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+# Offline nozzle detection benchmark for TAMV.
+#
+# Runs the TAMV detection engines over a directory of images or a video file of nozzle
+# frames and reports speed and accuracy. Runs headless: no camera, printer or display needed.
+#
+# Ground truth labels (optional) are a JSON file mapping each frame name (the image file
+# name, or the frame index for videos) to the nozzle center in pixels, or null when no
+# nozzle is visible in the frame:
+#   { "frame_0001.png": [320.5, 240.0], "frame_0002.png": null, ... }
+#
+# Released under The MIT License. Full text available via https://opensource.org/licenses/MIT
+#
+# Requires OpenCV to be installed
+
+import os
+import json
+import argparse
+import time
+import cv2
+import numpy as np
+import NozzleDetector
+import FrameSource
+import DetectionPool
+import SyntheticCamera
+
+def init():
+    parser = argparse.ArgumentParser(description='Program to benchmark TAMV nozzle detection engines on recorded frames.', allow_abbrev=False)
+    parser.add_argument('-input',type=str,nargs=1,required=True,help='Directory of images or video file to process, or \"synthetic\" to generate labelled frames with SyntheticCamera.')
+    parser.add_argument('-labels',type=str,nargs=1,default=[None],help='(optional) JSON file with ground truth nozzle centers per frame.')
+    parser.add_argument('-engine',type=str,nargs='+',default=['blob'],help='Detection engine(s) to benchmark. Available: ' + ', '.join(NozzleDetector.detectors.keys()) + '. Default is \"blob\".')
+    parser.add_argument('-loose',action='store_true',help='Use loose detection (minimum circularity 0.3) like the GUI \"Loose detection\" checkbox.')
+    parser.add_argument('-tolerance',type=float,nargs=1,default=[3.0],help='Maximum error in pixels for a detection to count as a hit against the labels. Default is 3.')
+    parser.add_argument('-workers',type=int,nargs=1,default=[0],help='(optional) run detection in this many worker processes (see DetectionPool.py) and report the overall throughput.')
+    parser.add_argument('-gray',action='store_true',help='Feed grayscale frames to the engines, like a camera with "capture_gray" set in settings.json.')
+    parser.add_argument('-scale',type=float,nargs=1,default=[1.0],help='Detection resolution relative to the frame, like "detection_scale" in settings.json. Default is 1.')
+    parser.add_argument('-roi',type=float,nargs=1,default=[1.0],help='Central fraction of the frame searched first, like "detection_roi" in settings.json. Default is 1 (whole frame).')
+    parser.add_argument('-limit',type=int,nargs=1,default=[0],help='(optional) maximum number of frames to process.')
+    parser.add_argument('-output',type=str,nargs=1,default=[None],help='(optional) JSON file to save the benchmark report to.')
+    args=vars(parser.parse_args())
+    return args
+
+def loadLabels(filename):
+    if filename is None:
+        return None
+    try:
+        with open(filename,'r') as inputfile:
+            labels = json.load(inputfile)
+        print( str(filename) + ' has been loaded.')
+        return labels
+    except OSError:
+        print( 'Error opening labels file: \"' + str(filename) + '\"')
+        return None
+
+def loadFrames(path, limit=0, gray=False):
+    # Generator returning (frame name, BGR or grayscale frame, read time in seconds)
+    if not os.path.exists(path):
+        print('Error opening input: \"' + str(path) + '\"')
+        return
+    # directories and video files replay at full speed
+    source = FrameSource.createFrameSource(path, gray=gray)
+    if not source.isOpened():
+        print('Error opening input: \"' + str(path) + '\"')
+        return
+    count = 0
+    while limit == 0 or count < limit:
+        start = time.perf_counter()
+        ret, frame, timestamp = source.read()
+        read_time = time.perf_counter() - start
+        if not ret:
+            break
+        count += 1
+        yield (source.frame_name, frame, read_time)
+    source.release()
+
+def syntheticFrames(count=100, seed=0, gray=False):
+    # Render labelled frames at random sub-pixel positions around the image center
+    camera = SyntheticCamera.SyntheticCamera(fps=0, distortion=0.02, seed=seed)
+    rng = np.random.default_rng(seed)
+    frames = []
+    labels = {}
+    for index in range(count):
+        camera.setPosition(camera.width/2 + rng.uniform(-60, 60), camera.height/2 + rng.uniform(-60, 60))
+        start = time.perf_counter()
+        ret, frame = camera.read()
+        if gray:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        read_time = time.perf_counter() - start
+        name = str(index)
+        frames.append( (name, frame, read_time) )
+        labels[name] = [float(value) for value in camera.truePosition()]
+    return frames, labels
+
+def runEngine(engine, frames, labels=None, tolerance=3.0):
+    stage_times = {'read': []}
+    total_time = []
+    results = []
+    for (name, frame, read_time) in frames:
+        stage_times['read'].append(read_time)
+        start = time.perf_counter()
+        keypoints, processed = engine.detect(frame)
+        total_time.append(time.perf_counter() - start)
+        for stage, value in engine.stage_times.items():
+            stage_times.setdefault(stage, []).append(value)
+        results.append(frameResult(name, keypoints, labels))
+    return summarize(engine.name, results, stage_times, total_time, labels is not None, tolerance)
+
+def runPool(engineName, frames, labels=None, tolerance=3.0, workers=2, minCircularity=0.8, scale=1.0, roi=1.0):
+    # Same as runEngine, with detection spread over worker processes
+    stage_times = {'read': []}
+    total_time = []
+    results = []
+    pool = None
+    start = 0
+    for (name, frame, read_time) in frames:
+        if pool is None:
+            # workers are started before timing begins
+            pool = DetectionPool.DetectionPool(workers=workers, width=frame.shape[1], height=frame.shape[0], engine=engineName, minCircularity=minCircularity, scale=scale, roi=roi)
+            start = time.perf_counter()
+        stage_times['read'].append(read_time)
+        while not pool.available():
+            collectResult(pool, results, stage_times, total_time, labels)
+        pool.submit(frame, (name, time.perf_counter()))
+    if pool is None:
+        return summarize(engineName, results, stage_times, total_time, labels is not None, tolerance)
+    while pool.inFlight() > 0:
+        collectResult(pool, results, stage_times, total_time, labels)
+    elapsed = time.perf_counter() - start
+    pool.close()
+    # results arrive in completion order
+    results.sort(key=lambda r: r['index'])
+    report = summarize(engineName + ' x' + str(workers), results, stage_times, total_time, labels is not None, tolerance)
+    # frames are processed in parallel: throughput comes from wall clock time, latency is per frame
+    report['fps'] = len(results) / elapsed if elapsed > 0 else 0
+    return report
+
+def collectResult(pool, results, stage_times, total_time, labels):
+    result = pool.result()
+    (name, submitted) = result.meta
+    total_time.append(time.perf_counter() - submitted)
+    for stage, value in result.stage_times.items():
+        stage_times.setdefault(stage, []).append(value)
+    entry = frameResult(name, result.keypoints, labels)
+    entry['index'] = result.frameID
+    results.append(entry)
+
+def frameResult(name, keypoints, labels=None):
+    result = {
+        'frame': name,
+        'count': len(keypoints),
+        'center': None
+    }
+    if len(keypoints) == 1:
+        result['center'] = [float(keypoints[0].pt[0]), float(keypoints[0].pt[1])]
+        result['radius'] = float(keypoints[0].size/2)
+    if labels is not None and name in labels:
+        result['truth'] = labels[name]
+    return result
+
+def summarize(engineName, results, stage_times, total_time, labelled, tolerance):
+    report = {'engine': engineName, 'frames': len(results)}
+    if len(results) == 0:
+        return report
+    processing_time = np.sum(total_time)
+    report['fps'] = len(results) / processing_time if processing_time > 0 else 0
+    # per-stage latency in milliseconds
+    report['latency'] = {}
+    for stage, values in stage_times.items():
+        values = np.array(values) * 1000
+        report['latency'][stage] = {
+            'mean': float(np.mean(values)),
+            'median': float(np.median(values)),
+            'p95': float(np.percentile(values, 95))
+        }
+    values = np.array(total_time) * 1000
+    report['latency']['total'] = {
+        'mean': float(np.mean(values)),
+        'median': float(np.median(values)),
+        'p95': float(np.percentile(values, 95))
+    }
+    if labelled:
+        # only frames with a labelled nozzle count towards detection rate
+        scored = [r for r in results if 'truth' in r]
+        present = [r for r in scored if r['truth'] is not None]
+        absent = [r for r in scored if r['truth'] is None]
+    else:
+        # without labels, every frame is assumed to contain the nozzle
+        present = results
+        absent = []
+    singles = [r for r in present if r['count'] == 1]
+    multiples = [r for r in results if r['count'] > 1]
+    report['detection_rate'] = len(singles) / len(present) if len(present) > 0 else 0
+    report['false_multiple_rate'] = len(multiples) / len(results)
+    if len(absent) > 0:
+        report['false_positive_rate'] = len([r for r in absent if r['count'] > 0]) / len(absent)
+    centers = np.array([r['center'] for r in singles])
+    if labelled and len(singles) > 0:
+        errors = centers - np.array([r['truth'] for r in singles])
+        distances = np.sqrt(np.sum(errors**2, axis=1))
+        report['hit_rate'] = float(np.sum(distances <= tolerance)) / len(present)
+        report['mean_error'] = float(np.mean(distances))
+        report['max_error'] = float(np.max(distances))
+        # jitter: spread of the error around its mean (bias removed)
+        report['jitter'] = [float(np.std(errors[:,0])), float(np.std(errors[:,1]))]
+    elif len(singles) > 0:
+        # unlabelled corpus of a static nozzle: jitter is the spread of detected centers
+        report['jitter'] = [float(np.std(centers[:,0])), float(np.std(centers[:,1]))]
+    return report
+
+def printReport(report):
+    print('')
+    print('Engine: ' + str(report['engine']) + ' - ' + str(report['frames']) + ' frames')
+    if report['frames'] == 0:
+        print('   No frames processed.')
+        return
+    print('   Frames per second:     {0:8.1f}'.format(report['fps']))
+    print('   Detection rate:        {0:8.1%}'.format(report['detection_rate']))
+    print('   False multiple rate:   {0:8.1%}'.format(report['false_multiple_rate']))
+    if 'false_positive_rate' in report:
+        print('   False positive rate:   {0:8.1%}'.format(report['false_positive_rate']))
+    if 'hit_rate' in report:
+        print('   Hit rate:              {0:8.1%}'.format(report['hit_rate']))
+        print('   Mean error (px):       {0:8.3f}'.format(report['mean_error']))
+        print('   Max error (px):        {0:8.3f}'.format(report['max_error']))
+    if 'jitter' in report:
+        print('   Center jitter (px):    X{0:7.3f}  Y{1:7.3f}'.format(report['jitter'][0], report['jitter'][1]))
+    print('   +-----------+----------+----------+----------+')
+    print('   | Stage     | Mean ms  | Median   | p95      |')
+    for stage, values in report['latency'].items():
+        print('   | {0:9s} | {1:8.3f} | {2:8.3f} | {3:8.3f} |'.format(stage, values['mean'], values['median'], values['p95']))
+    print('   +-----------+----------+----------+----------+')
+
+def main():
+    args = init()
+    inputPath = args['input'][0]
+    labels = loadLabels(args['labels'][0])
+    tolerance = args['tolerance'][0]
+    limit = args['limit'][0]
+    minCircularity = 0.3 if args['loose'] else 0.8
+    workers = args['workers'][0]
+    gray = args['gray']
+    scale = args['scale'][0]
+    roi = args['roi'][0]
+
+    synthetic = (inputPath.lower() == 'synthetic')
+    if synthetic:
+        frames, labels = syntheticFrames(limit if limit > 0 else 100, gray=gray)
+
+    reports = []
+    for engineName in args['engine']:
+        if workers > 0:
+            if engineName not in NozzleDetector.detectors:
+                print('Unknown detection engine: ' + str(engineName))
+                continue
+            report = runPool(engineName, frames if synthetic else loadFrames(inputPath, limit, gray), labels, tolerance, workers, minCircularity, scale, roi)
+            printReport(report)
+            reports.append(report)
+            continue
+        try:
+            engine = NozzleDetector.getDetector(engineName, minCircularity=minCircularity, scale=scale, roi=roi)
+        except ValueError as e1:
+            print(e1)
+            continue
+        # frames are re-read for every engine so each engine sees identical input
+        if synthetic:
+            report = runEngine(engine, frames, labels, tolerance)
+        else:
+            report = runEngine(engine, loadFrames(inputPath, limit, gray), labels, tolerance)
+        printReport(report)
+        reports.append(report)
+
+    if args['output'][0] is not None:
+        try:
+            with open(args['output'][0],'w') as outputfile:
+                json.dump(reports, outputfile, indent=2)
+            print('')
+            print('Report saved to ' + str(args['output'][0]))
+        except Exception as e1:
+            print('Error saving report:')
+            print(e1)
+
+if __name__ == "__main__":
+    main()
+    exit()
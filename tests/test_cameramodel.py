@@ -0,0 +1,88 @@
+import numpy as np
+import CameraModel
+
+def grid(count=7):
+    values = np.linspace(-0.4, 0.4, count)
+    xs, ys = np.meshgrid(values, values)
+    return np.stack([xs.ravel(), ys.ravel()], axis=1)
+
+def test_fit_recovers_quadratic_transform():
+    rng = np.random.default_rng(0)
+    transform = rng.normal(0, 1, (6, 2))
+    pixels = grid()
+    machine = CameraModel.features(pixels[:,0], pixels[:,1], 2) @ transform
+    fitted, residuals = CameraModel.fit(pixels, machine, order=2)
+    assert np.allclose(fitted, transform)
+    assert np.allclose(residuals, 0)
+    assert np.allclose(CameraModel.evaluate(fitted, pixels), machine)
+
+def test_cubic_model_follows_distortion_the_quadratic_misses():
+    pixels = grid()
+    x, y = pixels[:,0], pixels[:,1]
+    machine = np.stack([6.4*x + 0.5*x**3, 4.8*y + 0.5*y**3], axis=1)
+    quadratic, residuals2 = CameraModel.fit(pixels, machine, order=2)
+    cubic, residuals3 = CameraModel.fit(pixels, machine, order=3)
+    assert CameraModel.modelOrder(quadratic) == 2
+    assert CameraModel.modelOrder(cubic) == 3
+    assert np.abs(residuals3).max() < 1e-9
+    assert np.abs(residuals2).max() > 1e-3
+
+def test_model_order_rejects_unknown_term_count():
+    try:
+        CameraModel.modelOrder(np.zeros((7, 2)))
+    except ValueError:
+        return
+    assert False, 'expected ValueError'
+
+def test_pixel_lookup_matches_model():
+    transform = np.zeros((10, 2))
+    transform[3] = [6.4, 0.1]
+    transform[4] = [-0.1, 4.8]
+    transform[6] = [0.3, 0.0]
+    transform[9] = [0.0, 0.2]
+    lookup = CameraModel.PixelLookup(transform, 640, 480)
+    assert lookup.offset(320, 240) == (0.0, 0.0)
+    for (u, v) in [(10.25, 20.5), (600.75, 470.1), (320.5, 100.0), (-30.0, 500.0)]:
+        center = CameraModel.evaluate(transform, [0, 0])[0]
+        direct = CameraModel.evaluate(transform, [u/640 - 0.5, v/480 - 0.5])[0] - center
+        assert np.allclose(lookup.offset(u, v), direct, atol=1e-4)
+
+def test_scale_and_rotation():
+    mpp = 0.01
+    angle = np.radians(5)
+    transform = np.zeros((6, 2))
+    # 640x480 image, 0.01 mm per pixel, rotated 5 degrees
+    transform[3] = [640*mpp*np.cos(angle), 640*mpp*np.sin(angle)]
+    transform[4] = [-480*mpp*np.sin(angle), 480*mpp*np.cos(angle)]
+    (scale, rotation) = CameraModel.scaleAndRotation(transform, 640, 480)
+    assert abs(scale - mpp) < 1e-12
+    assert abs(rotation - 5) < 1e-9
+
+def test_pixel_offset_matches_lookup():
+    transform = np.zeros((10, 2))
+    transform[3] = [6.4, 0.1]
+    transform[4] = [-0.1, 4.8]
+    transform[6] = [0.3, 0.0]
+    lookup = CameraModel.PixelLookup(transform, 640, 480)
+    for (u, v) in [(320, 240), (10.25, 20.5), (600.75, 470.1)]:
+        assert np.allclose(CameraModel.pixelOffset(transform, 640, 480, u, v), lookup.offset(u, v), atol=1e-4)
+    offsets = CameraModel.pixelOffset(transform, 640, 480, [10.25, 600.75], [20.5, 470.1])
+    assert offsets.shape == (2, 2)
+
+def test_recursive_refiner_follows_a_scale_change():
+    pixels = grid(5)
+    transform = np.zeros((6, 2))
+    transform[3] = [6.4, 0]
+    transform[4] = [0, 4.8]
+    refiner = CameraModel.RecursiveRefiner(transform, 640, 480, pixels=pixels)
+    actual = transform * 1.02
+    rng = np.random.default_rng(1)
+    for i in range(200):
+        p0 = rng.uniform(-0.3, 0.3, 2)
+        p1 = rng.uniform(-0.3, 0.3, 2)
+        move = (CameraModel.features(p1[0], p1[1], 2) - CameraModel.features(p0[0], p0[1], 2)) @ actual
+        refiner.update(p0, p1, move)
+    (scale, rotation) = refiner.drift()
+    assert abs(scale - 0.02) < 1e-3
+    assert abs(rotation) < 0.05
+    assert np.allclose(refiner.predict([0, 0], [0.1, 0.1]), [0.64*1.02, 0.48*1.02], atol=1e-3)
@@ -0,0 +1,59 @@
+import DuetWebAPI
+
+moveCommands = DuetWebAPI.DuetWebAPI.moveCommands
+
+def test_move_commands_in_order():
+    assert moveCommands(1, 2.5, 3) == ['G90', 'G1 X1.000 Y2.500', 'G1 Z3.000']
+    assert moveCommands(1, 2, 3, order='Z XY') == ['G90', 'G1 Z3.000', 'G1 X1.000 Y2.000']
+    assert moveCommands(1, 2, 3, feed=1000, order='XYZ') == ['G90', 'G1 X1.000 Y2.000 Z3.000 F1000']
+
+def test_move_commands_skip_missing_axes():
+    assert moveCommands(x=5) == ['G90', 'G1 X5.000']
+    assert moveCommands(z=1, order='XY') == ['G90', 'G1 Z1.000']
+    assert moveCommands() == ['G90']
+
+class Reply:
+    ok = True
+    status_code = 200
+    text = '{"status": "I", "coords": {"xyz": [1.0, 2.0, 3.0]}, "axisNames": "XYZ"}'
+
+    def json(self):
+        return {'buff': 200}
+
+class Requests:
+    def __init__(self):
+        self.urls = []
+
+    def get(self, url, timeout=8):
+        self.urls.append(url)
+        return Reply()
+
+def printer(rrf2=True):
+    # controller on the RRF2 interface without a network connection
+    api = DuetWebAPI.DuetWebAPI.__new__(DuetWebAPI.DuetWebAPI)
+    api.pt = 2
+    api._rrf2 = rrf2
+    api._base_url = 'http://printer'
+    api.requests = Requests()
+    return api
+
+def test_single_commands_are_sent_as_before():
+    api = printer()
+    api.gCode('G1 X1 Y2')
+    assert api.requests.urls[0] == 'http://printer/rr_gcode?gcode=G1 X1 Y2'
+
+def test_move_to_sends_one_quoted_batch_without_waiting():
+    api = printer()
+    api.getStatus = lambda: 'processing'
+    assert api.moveTo(1, 2, 3) == 0
+    gcode = [url for url in api.requests.urls if 'rr_gcode' in url]
+    assert gcode == ['http://printer/rr_gcode?gcode=G90%0AG1%20X1.000%20Y2.000%0AG1%20Z3.000']
+
+def test_live_coordinates_open_a_session_on_rrf3_boards():
+    api = printer(rrf2=False)
+    assert api.getCoordsLive() == {'X': 1.0, 'Y': 2.0, 'Z': 3.0}
+    pages = [url.split('/')[-1].split('?')[0] for url in api.requests.urls]
+    assert pages == ['rr_connect', 'rr_status', 'rr_reply', 'rr_disconnect']
+    api = printer()
+    assert api.getCoordsLive() == {'X': 1.0, 'Y': 2.0, 'Z': 3.0}
+    assert 'rr_connect' not in ' '.join(api.requests.urls)
@@ -0,0 +1,42 @@
+import numpy as np
+from FrameAverager import FrameAverager
+
+def frame(value, shape=(4, 6)):
+    return np.full(shape, value, dtype=np.uint8)
+
+def test_mean_of_last_frames():
+    averager = FrameAverager(frames=3)
+    averager.add(frame(10))
+    assert not averager.ready()
+    averager.add(frame(20))
+    image = averager.add(frame(30))
+    assert averager.ready()
+    assert np.all(image == 20)
+    # the oldest frame drops out of the window
+    image = averager.add(frame(40))
+    assert averager.count() == 3
+    assert np.all(image == 30)
+
+def test_median_rejects_a_single_outlier():
+    averager = FrameAverager(frames=3, mode='median')
+    averager.add(frame(10))
+    averager.add(frame(250))
+    image = averager.add(frame(12))
+    assert np.all(image == 12)
+
+def test_color_frames_are_averaged_as_luma():
+    averager = FrameAverager(frames=2)
+    image = averager.add(np.full((4, 6, 3), 100, dtype=np.uint8))
+    assert image.shape == (4, 6)
+    assert np.all(image == 100)
+
+def test_reset_and_resolution_change_start_over():
+    averager = FrameAverager(frames=2)
+    averager.add(frame(10))
+    averager.add(frame(10))
+    averager.reset()
+    assert averager.count() == 0 and not averager.ready()
+    averager.add(frame(10))
+    image = averager.add(frame(50, (8, 8)))
+    assert averager.count() == 1
+    assert np.all(image == 50)
@@ -0,0 +1,39 @@
+import cv2
+import numpy as np
+import FrameSource
+
+def test_synthetic_source():
+    source = FrameSource.createFrameSource('synthetic', 320, 240)
+    try:
+        assert isinstance(source, FrameSource.SyntheticSource)
+        ret, frame, timestamp = source.read()
+        assert ret
+        assert frame.shape == (240, 320, 3)
+    finally:
+        source.release()
+
+def test_gray_frames():
+    source = FrameSource.createFrameSource('synthetic', 320, 240, gray=True)
+    try:
+        ret, frame, timestamp = source.read()
+        assert ret
+        assert frame.shape == (240, 320)
+    finally:
+        source.release()
+
+def test_directory_source_replays_images_in_name_order(tmp_path):
+    for (name, value) in [('b.png', 20), ('a.png', 10), ('notes.txt', None)]:
+        if value is None:
+            (tmp_path / name).write_text('not an image')
+        else:
+            cv2.imwrite(str(tmp_path / name), np.full((8, 8, 3), value, dtype=np.uint8))
+    source = FrameSource.createFrameSource(str(tmp_path))
+    assert isinstance(source, FrameSource.DirectorySource)
+    values = []
+    while True:
+        ret, frame, timestamp = source.read()
+        if not ret:
+            break
+        values.append((source.frame_name, int(frame[0, 0, 0])))
+    assert values == [('a.png', 10), ('b.png', 20)]
+    assert source.finished
@@ -0,0 +1,37 @@
+import pytest
+import NozzleDetector
+import SyntheticCamera
+
+def nozzleFrame(seed=0):
+    camera = SyntheticCamera.SyntheticCamera(width=640, height=480, noise=1.0, debris=0, seed=seed)
+    camera.position = (301.3, 247.6)
+    ret, frame = camera.read()
+    assert ret
+    return frame, camera.position
+
+def test_registry():
+    assert sorted(NozzleDetector.detectors.keys()) == ['blob', 'hough', 'template']
+    for (name, engine) in NozzleDetector.detectors.items():
+        assert isinstance(NozzleDetector.getDetector(name), engine)
+    with pytest.raises(ValueError):
+        NozzleDetector.getDetector('unknown')
+
+@pytest.mark.parametrize('name', sorted(NozzleDetector.detectors.keys()))
+def test_engines_find_the_nozzle(name):
+    detector = NozzleDetector.getDetector(name)
+    # twice: the template engine learns on the first frame and matches on the second
+    for seed in (0, 1):
+        frame, (u, v) = nozzleFrame(seed)
+        keypoints, processed = detector.detect(frame)
+        assert len(keypoints) == 1
+        assert abs(keypoints[0].pt[0] - u) < 0.5
+        assert abs(keypoints[0].pt[1] - v) < 0.5
+        assert 0 <= keypoints[0].response <= 1
+
+def test_template_forget():
+    detector = NozzleDetector.getDetector('template')
+    frame, position = nozzleFrame()
+    detector.detect(frame)
+    assert detector.template is not None
+    detector.forget()
+    assert detector.template is None and detector.position is None
@@ -0,0 +1,66 @@
+import numpy as np
+from NozzleTracker import NozzleTracker
+
+def test_settles_only_after_min_updates():
+    tracker = NozzleTracker(noise=0.1, minUpdates=2)
+    assert tracker.update(100.0, 50.0)
+    assert not tracker.settled()
+    assert tracker.update(100.1, 50.0)
+    assert tracker.settled()
+    (u, v) = tracker.position()
+    assert 100.0 <= u <= 100.1 and v == 50.0
+
+def test_gate_rejects_outliers_and_restarts_after_max_rejects():
+    tracker = NozzleTracker(noise=0.5, maxRejects=3)
+    for i in range(3):
+        assert tracker.update(100.0, 100.0)
+    assert not tracker.update(130.0, 100.0)
+    assert not tracker.update(130.0, 100.0)
+    assert tracker.rejected_count == 2
+    # the third consecutive reject restarts the track from the detection
+    assert tracker.update(130.0, 100.0)
+    assert tracker.position() == (130.0, 100.0)
+    assert tracker.track_length == 1
+
+def test_move_shifts_prediction_and_resets_settling():
+    tracker = NozzleTracker(noise=0.2, minUpdates=2)
+    tracker.update(100.0, 100.0)
+    tracker.update(100.0, 100.0)
+    assert tracker.settled()
+    tracker.move(20.0, -10.0)
+    assert tracker.position() == (120.0, 90.0)
+    assert not tracker.settled()
+    # the moved nozzle is inside the gate, an unmoved one is not
+    assert tracker.distance(120.5, 90.0) < tracker.gate_limit
+    assert tracker.distance(100.0, 100.0) > tracker.gate_limit
+
+def test_gate_keeps_points_near_prediction():
+    tracker = NozzleTracker(noise=0.5)
+    assert tracker.gate([(1, 2), (3, 4)]) == [(1, 2), (3, 4)]
+    tracker.update(50.0, 50.0)
+    assert tracker.gate([(50.5, 50.0), (80.0, 50.0)]) == [(50.5, 50.0)]
+
+def test_quality_scales_measurement_noise():
+    good = NozzleTracker(noise=0.5)
+    poor = NozzleTracker(noise=0.5)
+    good.update(10.0, 10.0, 1.0)
+    poor.update(10.0, 10.0, 0.0)
+    assert np.isclose(good.std()[0], 0.25)
+    assert np.isclose(poor.std()[0], 0.75)
+
+def test_only_accepted_detections_set_the_typical_radius():
+    tracker = NozzleTracker(noise=0.5)
+    for i in range(3):
+        tracker.update(100.0, 100.0, tracker.score(100.0, 100.0, 18.0), 18.0)
+    assert not tracker.update(200.0, 100.0, tracker.score(200.0, 100.0, 40.0), 40.0)
+    assert tracker.radii == [18.0, 18.0, 18.0]
+    # a detection with the usual radius at the predicted position scores higher than an odd sized one
+    assert tracker.score(100.0, 100.0, 18.0) > 0.9
+    assert tracker.score(100.0, 100.0, 25.0) < 0.1
+
+def test_measured_noise():
+    tracker = NozzleTracker(noise=0.5)
+    assert tracker.measuredNoise() == 0.5
+    for (u, v) in [(10.0, 10.0), (10.2, 10.0), (10.0, 10.2), (10.2, 10.2)]:
+        tracker.update(u, v)
+    assert np.isclose(tracker.measuredNoise(), np.sqrt(0.04/3))
@@ -0,0 +1,38 @@
+import numpy as np
+from SettleDetector import SettleDetector
+
+def scene(shift=0):
+    image = np.full((120, 160), 200, dtype=np.uint8)
+    image[40:80, 60+shift:100+shift] = 20
+    return image
+
+def test_stable_after_the_scene_moved_and_stopped():
+    settle = SettleDetector(stableFrames=2, motionTimeout=10)
+    settle.start(scene(0))
+    assert not settle.update(scene(20))
+    assert settle.moved
+    assert not settle.update(scene(40))
+    assert not settle.update(scene(40))
+    assert settle.update(scene(40))
+
+def test_still_scene_waits_for_motion_until_timeout():
+    settle = SettleDetector(stableFrames=1, motionTimeout=10)
+    settle.start(scene(0))
+    assert not settle.update(scene(0))
+    assert not settle.update(scene(0))
+    settle.motionTimeout = 0
+    assert settle.update(scene(0))
+
+def test_small_moves_dont_wait_for_motion():
+    settle = SettleDetector(stableFrames=1, motionTimeout=10)
+    settle.start(scene(0), expectMotion=False)
+    assert settle.update(scene(0))
+
+def test_restart_needs_new_still_frames():
+    settle = SettleDetector(stableFrames=2, motionTimeout=10)
+    settle.start(scene(0), expectMotion=False)
+    settle.update(scene(0))
+    assert settle.update(scene(0))
+    settle.restart()
+    assert not settle.update(scene(0))
+    assert settle.update(scene(0))